@@ -0,0 +1,127 @@
+'''
+Compares writing heartbeats to mongodb one update_one at a time with
+writing them as unordered bulk_write batches.
+
+By default the writes go to an in-process stand-in that pays
+--round-trip milliseconds per call, like a mongodb on the local
+network would. Pass --mongodb to use a real server instead.
+
+Sample run:
+python benchmarks/heartbeat_ingest.py run --components 5000 --heartbeats 20000
+python benchmarks/heartbeat_ingest.py run --mongodb host=localhost:port=27017:db=logagg_bench
+'''
+import time
+
+from basescript import BaseScript
+from pymongo import MongoClient
+import pymongo
+
+from logagg_master.heartbeat import HeartbeatWriter
+
+class LocalMongo():
+    '''
+    Stand-in for a components collection on a mongodb in the local
+    network: documents are kept in a dict keyed by the upsert filter and
+    every call pays a fixed round trip
+    '''
+    def __init__(self, round_trip):
+        self.round_trip = round_trip
+        self.docs = dict()
+
+
+    def _upsert(self, key, update):
+        self.docs.setdefault(tuple(sorted(key.items())), dict()).update(update['$set'])
+
+
+    def update_one(self, key, update, upsert=False):
+        time.sleep(self.round_trip)
+        self._upsert(key, update)
+
+
+    def bulk_write(self, requests, ordered=True):
+        time.sleep(self.round_trip)
+        for r in requests:
+            self._upsert(r._filter, r._doc)
+
+
+class HeartbeatIngestBenchmark(BaseScript):
+    DESC = 'Heartbeat ingest rate, per document vs bulk_write'
+
+    def _collection(self):
+        if not self.args.mongodb:
+            return LocalMongo(self.args.round_trip / 1000.0)
+
+        mongodb = dict(a.split('=') for a in self.args.mongodb.split(':'))
+        client = MongoClient(mongodb['host'], int(mongodb['port']))
+        collection = client[mongodb['db']]['components']
+
+        collection.drop()
+        collection.create_index([
+            ('namespace', pymongo.ASCENDING),
+            ('host', pymongo.ASCENDING),
+            ('port', pymongo.ASCENDING),
+            ('cluster_name', pymongo.ASCENDING)],
+            unique=True)
+
+        return collection
+
+
+    def _heartbeats(self):
+        for i in range(self.args.heartbeats):
+            n = i % self.args.components
+            yield {'cluster_name': 'bench',
+                    'namespace': 'collector',
+                    'host': 'host-{}'.format(n),
+                    'port': '1088',
+                    'timestamp': time.time()}
+
+
+    def _measure(self, batch_size):
+        writer = HeartbeatWriter(self._collection(),
+                                self.log,
+                                batch_size=batch_size,
+                                batch_interval=self.args.batch_interval)
+
+        start = time.time()
+        for heartbeat in self._heartbeats():
+            writer.add(heartbeat)
+        writer.flush()
+        elapsed = time.time() - start
+
+        self.log.info('heartbeat_ingest_benchmark',
+                    batch_size=batch_size,
+                    heartbeats=self.args.heartbeats,
+                    components=self.args.components,
+                    seconds=elapsed,
+                    heartbeats_per_second=self.args.heartbeats / elapsed)
+
+        return elapsed
+
+
+    def run(self):
+        per_document = self._measure(1)
+        batched = self._measure(self.args.batch_size)
+
+        self.log.info('heartbeat_ingest_speedup', speedup=per_document / batched)
+
+
+    def define_args(self, parser):
+        parser.add_argument('--mongodb', '-d', default=None,
+                help='Real mongodb to write to, format: <host=localhost:port=27017:db=name>, default: in-process stand-in')
+        parser.add_argument('--round-trip', type=float, default=0.2,
+                help='Milliseconds each call to the stand-in takes, default: %(default)s')
+        parser.add_argument('--components', '-c', type=int, default=5000,
+                help='Number of distinct components heartbeating, default: %(default)s')
+        parser.add_argument('--heartbeats', '-n', type=int, default=20000,
+                help='Number of heartbeats to write, default: %(default)s')
+        parser.add_argument('--batch-size', '-b', type=int, default=HeartbeatWriter.BATCH_SIZE,
+                help='Heartbeats per bulk_write, default: %(default)s')
+        parser.add_argument('--batch-interval', type=float, default=HeartbeatWriter.BATCH_INTERVAL,
+                help='Most seconds a heartbeat waits before being written, default: %(default)s')
+
+
+def main():
+    HeartbeatIngestBenchmark().start()
+
+if __name__ == '__main__':
+    main()
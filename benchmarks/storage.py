@@ -0,0 +1,273 @@
+'''
+Compares the storages of the master on what registering a component
+and scanning the components cost when they reach the database, with
+the cluster cache and the component registry out of the way:
+
+register_component: read the cluster by name, then upsert the
+component by (cluster_name, namespace, host, port) like a registry
+flush does.
+
+registry_scan: read every component of a cluster, the scan a registry
+does when it loads or refreshes. get_components itself is answered by
+the registry from memory and never reaches the database.
+
+SQLite is always measured, mongodb on --mongodb or else on mongomock,
+which only shows how it compares with an in-process dict. Latency
+percentiles of both are saved as JSON.
+
+check runs the master's own queries on a master of each storage,
+through its API and the parts of it that make them, and fails if they
+read back anything different.
+
+Sample run:
+python benchmarks/storage.py run --clusters 20 --components 10000 --output storage.json
+python benchmarks/storage.py run --mongodb host=localhost:port=27017:db=logagg_bench
+python benchmarks/storage.py check --mongodb host=localhost:port=27017:db=logagg_check
+'''
+import os
+import sys
+import time
+import random
+
+import ujson as json
+from basescript import BaseScript
+from deeputil import AttrDict
+from pymongo import MongoClient
+
+from logagg_master.service import Master, MasterService
+from logagg_master.storage import SqliteDatabase, MONGODB, SQLITE
+from logagg_master.heartbeat import HeartbeatWriter
+from logagg_master.registry import ComponentRegistry
+from logagg_master.membership import MasterMembership
+
+from suite import summarize, BenchMaster
+
+# Periodic work of the masters checked, none of it happens during a check
+CHECK_INTERVAL = 24 * 60 * 60 # seconds
+
+class StorageBenchmark(BaseScript):
+    DESC = 'register_component and registry scan latency per storage'
+
+    def _mongodb(self):
+        if self.args.mongodb:
+            details = dict(d.split('=') for d in self.args.mongodb.split(':'))
+            client = MongoClient(details['host'], int(details['port']))
+            client.drop_database(details['db'])
+            return 'mongodb', client[details['db']]
+
+        try:
+            import mongomock
+        except ImportError:
+            sys.exit('mongomock is needed without --mongodb, pip install mongomock or pass --mongodb')
+
+        return 'mongomock', mongomock.MongoClient()['logagg_bench']
+
+
+    def _sqlite(self):
+        path = self.args.sqlite_path
+        for suffix in ('', '-wal', '-shm'):
+            if os.path.exists(path + suffix): os.remove(path + suffix)
+
+        return 'sqlite', SqliteDatabase(path)
+
+
+    def _collections(self, db):
+        # The master's own indexes
+        master = Master.__new__(Master)
+        master.db_client = db
+        master._init_collections()
+        return master.cluster_collection, master.component_collection
+
+
+    def _measure(self, name, db):
+        a = self.args
+        clusters, components = self._collections(db)
+        cluster_names = ['cluster-{}'.format(i) for i in range(a.clusters)]
+        for cluster_name in cluster_names:
+            clusters.insert_one({'cluster_name': cluster_name,
+                                'cluster_passwd': 'bench',
+                                'nsqd_tcp_address': 'localhost:4150',
+                                'logs_topic': 'logs_topic',
+                                'heartbeat_topic': 'heartbeat_topic'})
+
+        writer = HeartbeatWriter(components, self.log, batch_size=1)
+        latencies = list()
+        start = time.time()
+        for i in range(a.components):
+            cluster_name = cluster_names[i % a.clusters]
+            t = time.time()
+            clusters.find_one({'cluster_name': cluster_name})
+            writer.add({'cluster_name': cluster_name,
+                        'namespace': 'collector',
+                        'host': 'host-{}'.format(i),
+                        'port': '1088',
+                        'last_seen': time.time()})
+            latencies.append(time.time() - t)
+        register_component = summarize(latencies, time.time() - start)
+
+        latencies = list()
+        start = time.time()
+        for i in range(a.reads):
+            t = time.time()
+            list(components.find({'cluster_name': random.choice(cluster_names)}, {'_id': 0}))
+            latencies.append(time.time() - t)
+        registry_scan = summarize(latencies, time.time() - start)
+
+        self.log.info('storage_benchmark', storage=name,
+                    register_component_p50_ms=register_component['p50_ms'],
+                    registry_scan_p50_ms=registry_scan['p50_ms'])
+
+        return {'register_component': register_component, 'registry_scan': registry_scan}
+
+
+    def run(self):
+        results = dict()
+        for storage in (self._mongodb, self._sqlite):
+            name, db = storage()
+            results[name] = self._measure(name, db)
+
+        report = {'started_at': time.time(),
+                    'params': {k: v for k, v in vars(self.args).items() if isinstance(v, (str, int, float, type(None)))},
+                    'results': results}
+
+        output = self.args.output or time.strftime('storage-%Y%m%d-%H%M%S.json')
+        with open(output, 'w') as f:
+            f.write(json.dumps(report, indent=4))
+        self.log.info('benchmark_results_saved', output=output)
+
+
+    def _check_master(self, storage):
+        '''
+        A master of its own on storage, owning every cluster, whose
+        periodic work is spaced out so only the check drives it
+        '''
+        a = self.args
+        mongodb = AttrDict(user='', passwd='', host='', port='', name='logagg_check')
+        mongodb_url = None
+        if a.mongodb:
+            details = dict(d.split('=') for d in a.mongodb.split(':'))
+            mongodb.name = details.get('db', mongodb.name)
+            mongodb_url = 'mongodb://{}:{}'.format(details['host'], details['port'])
+
+        if storage == SQLITE: self._sqlite()
+        return BenchMaster('localhost', 1088, mongodb, AttrDict(key='key', secret='secret'), self.log,
+                            mongodb_url=mongodb_url,
+                            storage=storage,
+                            sqlite_path=a.sqlite_path,
+                            sharded=True,
+                            component_flush_interval=CHECK_INTERVAL,
+                            nsq_poll_interval=CHECK_INTERVAL,
+                            nsq_api_health_check_interval=CHECK_INTERVAL)
+
+
+    def _master_queries(self, master):
+        '''
+        Runs the master's own queries through the API and the parts of
+        the master that make them, returning what they read back
+        '''
+        result = dict()
+        service = MasterService(master, self.log)
+        key, secret = master.auth.key, master.auth.secret
+
+        # A single nsq_api, as nsqs are given a $sample of them. The
+        # nsqds are unreachable, their loads are set further down.
+        for i in range(2): service.register_nsq_api(key, secret, 'api', '1077')
+        for i in (1, 2, 2, 3): service.add_nsq('nsqd{}:4150'.format(i), 'localhost:{}'.format(i), key, secret)
+        result['nsq_apis'] = sorted(n['nsq_api_address'] for n in master.nsq_collection.find())
+
+        created = [service.create_cluster('c1', shards=2), service.create_cluster('c1'), service.create_cluster('c2')]
+        result['created'] = sorted(c.get('cluster_name') or c['details'] for c in created)
+        passwd = created[0]['cluster_passwd']
+        result['passwd_changed'] = (service.change_cluster_passwd('c1', 'wrong', 'new')['success'],
+                                    service.change_cluster_passwd('c1', passwd, 'new')['cluster_info'])
+        result['cluster'] = master.clusters.get('c1', fresh=True), master.clusters.get('nope', fresh=True)
+
+        master.nsq_load.poll()
+        result['num_clusters'] = sorted(master.nsq_load.num_clusters.items())
+
+        # c2 moves to nsqd2 and back, every nsqd has c1 backed up
+        nsqs = {n['nsqd_tcp_address']: n for n in master.nsq_collection.find()}
+        master.migrator.migrate('c2', nsqs['nsqd2:4150'])
+        cluster = master.migrator.migrate('c2', nsqs['nsqd3:4150'])
+        result['migrated'] = (sorted(d['nsqd_tcp_address'] for d in cluster['draining']), cluster['version'])
+
+        load = {'reachable': True, 'polled_at': time.time(), 'topics': {'c1_logs': {'depth': 10 ** 9}}}
+        with master.nsq_load.lock: master.nsq_load.loads = {address: load for address in nsqs}
+        master.depth_monitor.check()
+        result['backpressure'] = sorted((c, s['state']) for c, s in master.depth_monitor.states.items())
+        master.migrator.check_drained()
+        cluster = master.cluster_collection.find_one({'cluster_name': 'c2'})
+        result['drained'] = (cluster['draining'], cluster['version'])
+
+        # The master flushes in a batch, another process writes one at a time and a third one reaps
+        for host in ('h1', 'h2'):
+            master.components.update({'cluster_name': 'c1', 'namespace': 'collector', 'host': host, 'port': 1088})
+        master.components.flush()
+        writer = HeartbeatWriter(master.component_collection, self.log, batch_size=1)
+        writer.add({'cluster_name': 'c2', 'namespace': 'forwarder', 'host': 'h3', 'port': 1088, 'last_seen': time.time()})
+        writer.add({'cluster_name': 'c1', 'namespace': 'collector', 'host': 'h1', 'port': 1088, 'last_seen': 0})
+        reaper = ComponentRegistry(master.component_collection, master.component_archive_collection, writer, self.log,
+                                flush_interval=CHECK_INTERVAL)
+        reaper.reap()
+        master.components.refresh()
+        result['archived'] = sorted((c['cluster_name'], c['namespace'], c['host'])
+                                    for c in master.component_archive_collection.find({}, {'_id': 0, 'archived_at': 0}))
+        result['refreshed'] = sorted((c['cluster_name'], c['namespace'], c['host'])
+                                    for cluster_name in ('c1', 'c2') for c in master.components.find(cluster_name))
+
+        # Another master whose lease has run out
+        joined_at = master.master_collection.find_one({'_id': master.membership.id})['joined_at']
+        other = MasterMembership(master.master_collection, 'other', 1088, self.log, lease_ttl=-MasterMembership.LEASE_TTL)
+        master.membership.renew()
+        result['masters'] = (sorted(master.membership.masters), sorted(other.masters),
+                            master.master_collection.find_one({'_id': master.membership.id})['joined_at'] == joined_at)
+
+        return result
+
+
+    def check(self):
+        name = 'mongodb' if self.args.mongodb else 'mongomock'
+        expected = self._master_queries(self._check_master(SQLITE))
+        got = self._master_queries(self._check_master(MONGODB))
+
+        differ = sorted(k for k in expected if got.get(k) != expected[k])
+        for k in differ:
+            self.log.error('storages_differ', query=k, sqlite=expected[k], **{name: got.get(k)})
+
+        self.log.info('storage_check_done', storage=name, num_checked=len(expected), num_differ=len(differ))
+        if differ: sys.exit(1)
+
+
+    def _define_storage_args(self, parser):
+        parser.add_argument('--mongodb', '-d', default=None,
+                help='Real mongodb to use, its db is dropped first, format: <host=localhost:port=27017:db=name>, default: mongomock')
+        parser.add_argument('--sqlite-path', default='logagg-bench.db',
+                help='Database file for sqlite, removed first, default: %(default)s')
+
+
+    def define_subcommands(self, subcommands):
+        super(StorageBenchmark, self).define_subcommands(subcommands)
+
+        check_cmd = subcommands.add_parser('check',
+                help="Check that sqlite answers the master's queries like mongodb")
+        check_cmd.set_defaults(func=self.check)
+        self._define_storage_args(check_cmd)
+
+
+    def define_args(self, parser):
+        parser.add_argument('--output', '-o', default=None,
+                help='File to save the results to, default: storage-<time>.json')
+        self._define_storage_args(parser)
+        parser.add_argument('--clusters', type=int, default=20,
+                help='Number of clusters the components are spread over, default: %(default)s')
+        parser.add_argument('--components', '-c', type=int, default=5000,
+                help='Number of components registered, default: %(default)s')
+        parser.add_argument('--reads', '-r', type=int, default=500,
+                help='Number of registry scans, reads of every component of a cluster, default: %(default)s')
+
+
+def main():
+    StorageBenchmark().start()
+
+if __name__ == '__main__':
+    main()
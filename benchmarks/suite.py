@@ -0,0 +1,419 @@
+'''
+End to end benchmarks of logagg-master. The master's tornado app runs
+in this process against local stand-ins: an in-process mongodb
+(mongomock, or a real one with --mongodb) or a sqlite database
+(--storage sqlite), a fake nsq_api streaming
+synthetic logs and heartbeats at the given rates and fake collectors.
+Every scenario is driven over HTTP from a separate IOLoop and the
+throughput and latency percentiles of all of them are saved as JSON,
+so runs can be compared.
+
+Scenarios: heartbeat ingestion, register_component, get_components,
+collector_add_file, collector_remove_file, batch_collector_add_file and
+tail_logs.
+
+Sample run:
+python benchmarks/suite.py run --output before.json
+python benchmarks/suite.py run --tails 50 --log-rate 20000 --output after.json
+python benchmarks/suite.py run --storage sqlite --output sqlite.json
+'''
+import os
+import re
+import sys
+import time
+import asyncio
+import platform
+import threading
+
+import ujson as json
+from basescript import BaseScript
+from deeputil import AttrDict
+import tornado.web
+import tornado.ioloop
+from tornado import gen
+from tornado.httpclient import AsyncHTTPClient, HTTPRequest
+from pymongo import MongoClient
+
+from logagg_master.service import Master
+from logagg_master.master_command import make_app
+from logagg_master.metrics import MongoCommandMetrics
+from logagg_master.tail import FlushPolicy
+from logagg_master.storage import STORAGES, MONGODB, SQLITE
+
+from tail_latency import percentile
+
+CLUSTER_NAME = 'bench'
+KEY, SECRET = 'bench', 'bench'
+TICK = 0.01 # seconds between writes of the fake nsq_api
+
+def summarize(latencies, seconds):
+    '''
+    >>> s = summarize([0.001, 0.002, 0.003], 2)
+    >>> s['count'], s['per_second'], s['p50_ms']
+    (3, 1.5, 2.0)
+    '''
+    latencies = [l * 1000 for l in latencies] or [0]
+    return {'count': len(latencies),
+            'seconds': seconds,
+            'per_second': len(latencies) / seconds if seconds else 0,
+            'p50_ms': percentile(latencies, 50),
+            'p90_ms': percentile(latencies, 90),
+            'p99_ms': percentile(latencies, 99),
+            'max_ms': max(latencies)}
+
+
+class FakeNsqApi(tornado.web.RequestHandler):
+    '''
+    nsq_api's /tail, streaming log lines or heartbeats of the benchmark
+    cluster at a steady rate. Every line carries when it was sent.
+    '''
+
+    def initialize(self, log_rate, heartbeat_rate, components):
+        self.log_rate = log_rate
+        self.heartbeat_rate = heartbeat_rate
+        self.components = components
+        self.closed = False
+
+
+    def on_connection_close(self):
+        self.closed = True
+
+
+    def _log_line(self, n, now):
+        return json.dumps({'level': 'info', 'host': 'host-{}'.format(n % 100), 'event': 'request_served',
+                            'data': {'n': n, 'status': 200}, 'sent_at': now})
+
+
+    def _heartbeat(self, n, now):
+        return json.dumps({'cluster_name': CLUSTER_NAME, 'namespace': 'collector',
+                            'host': 'hb-host-{}'.format(n % self.components), 'port': '1088',
+                            'timestamp': now})
+
+
+    async def get(self):
+        if 'heartbeat' in self.get_query_argument('topic'):
+            rate, line = self.heartbeat_rate, self._heartbeat
+        else:
+            rate, line = self.log_rate, self._log_line
+
+        started = time.time()
+        sent = 0
+        while not self.closed:
+            now = time.time()
+            due = int((now - started) * rate) - sent
+            if due:
+                self.write('\n'.join(line(sent + i, now) for i in range(due)) + '\n')
+                sent += due
+            try:
+                await self.flush()
+            except Exception:
+                return
+            await gen.sleep(TICK)
+
+
+class HealthHandler(tornado.web.RequestHandler):
+    def get(self):
+        self.write('ok')
+
+
+class FakeCollector(tornado.web.RequestHandler):
+    '''
+    A collector's file and control endpoints, answering like kwikapi does
+    '''
+
+    def get(self, method):
+        self.write(json.dumps({'success': True, 'result': [{'fpath': '/var/log/bench.log'}]}))
+
+
+class BenchMaster(Master):
+    '''
+    The master, on mongomock unless a real mongodb or sqlite is given
+    '''
+
+    def __init__(self, *args, mongodb_url=None, **kwargs):
+        self.mongodb_url = mongodb_url
+        super().__init__(*args, **kwargs)
+
+
+    def _ensure_db_connection(self):
+        if self.storage == SQLITE:
+            return super()._ensure_db_connection()
+
+        if self.mongodb_url:
+            client = MongoClient(self.mongodb_url, event_listeners=[MongoCommandMetrics(self.metrics)])
+            client.drop_database(self.mongodb.name)
+            return client[self.mongodb.name]
+
+        try:
+            import mongomock
+        except ImportError:
+            sys.exit('mongomock is needed for the in-process mongodb, pip install mongomock or pass --mongodb')
+
+        return mongomock.MongoClient()[self.mongodb.name]
+
+
+class BenchmarkSuite(BaseScript):
+    DESC = 'End to end benchmarks of logagg-master against local stand-ins'
+
+    def _start_loop(self, name, setup):
+        '''
+        Run setup on a new IOLoop in a thread of its own and keep that loop running
+        '''
+        ready = threading.Event()
+        result = dict()
+
+        def run():
+            asyncio.set_event_loop(asyncio.new_event_loop())
+            result['value'] = setup()
+            ready.set()
+            tornado.ioloop.IOLoop.current().start()
+
+        threading.Thread(target=run, name=name, daemon=True).start()
+        ready.wait()
+        return result['value']
+
+
+    def _start_standins(self):
+        a = self.args
+        nsq_api = tornado.web.Application([
+            (r'^/tail', FakeNsqApi, dict(log_rate=a.log_rate,
+                                        heartbeat_rate=a.heartbeat_rate,
+                                        components=a.components)),
+            (r'^/', HealthHandler),
+            ])
+        nsq_api.listen(a.base_port + 1)
+
+        collector = tornado.web.Application([(r'^/collector/v1/(\w+)', FakeCollector)])
+        for i in range(a.collectors):
+            collector.listen(a.base_port + 100 + i)
+
+
+    def _start_master(self):
+        a = self.args
+        mongodb = AttrDict(user='', passwd='', host='', port='', name='logagg_bench')
+        mongodb_url = None
+        if a.mongodb:
+            details = dict(d.split('=') for d in a.mongodb.split(':'))
+            mongodb.name = details.get('db', mongodb.name)
+            mongodb_url = 'mongodb://{}:{}'.format(details['host'], details['port'])
+
+        if a.storage == SQLITE:
+            for suffix in ('', '-wal', '-shm'):
+                if os.path.exists(a.sqlite_path + suffix): os.remove(a.sqlite_path + suffix)
+
+        master = BenchMaster('localhost', a.base_port, mongodb, AttrDict(key=KEY, secret=SECRET), self.log,
+                            mongodb_url=mongodb_url,
+                            storage=a.storage,
+                            sqlite_path=a.sqlite_path,
+                            nsq_poll_interval=3600)
+        make_app(master, self.log, FlushPolicy()).listen(a.base_port)
+        return master
+
+
+    def _url(self, method, **params):
+        query = '&'.join('{}={}'.format(k, v) for k, v in params.items())
+        return 'http://localhost:{}/logagg/v1/{}?{}'.format(self.args.base_port, method, query)
+
+
+    async def _call(self, method, **params):
+        response = await self.http.fetch(self._url(method, **params))
+        result = json.loads(response.body.decode('utf-8'))['result']
+        if isinstance(result, dict) and result.get('success') is False:
+            raise Exception('{} failed: {}'.format(method, result))
+        return result
+
+
+    async def _setup(self):
+        a = self.args
+        await self._call('register_nsq_api', key=KEY, secret=SECRET, host='localhost', port=a.base_port + 1)
+        await self._call('add_nsq', key=KEY, secret=SECRET,
+                        nsqd_tcp_address='"bench:4150"', nsqd_http_address='"localhost:{}"'.format(a.base_port + 2))
+        cluster = await self._call('create_cluster', cluster_name=CLUSTER_NAME)
+        self.cluster_passwd = cluster['cluster_passwd']
+
+        for i in range(a.collectors):
+            await self._call('register_component', namespace='collector', cluster_name=CLUSTER_NAME,
+                            cluster_passwd=self.cluster_passwd, host='localhost', port=a.base_port + 100 + i)
+
+
+    async def _load(self, urls):
+        '''
+        Request every url, concurrency at a time, timing each request
+        '''
+        urls = iter(urls)
+        latencies = list()
+
+        async def worker():
+            for url in urls:
+                start = time.time()
+                response = await self.http.fetch(url, raise_error=False)
+                latencies.append(time.time() - start)
+                if response.code != 200: self.log.warn('benchmark_request_failed', url=url, code=response.code)
+
+        start = time.time()
+        await gen.multi([worker() for _ in range(self.args.concurrency)])
+        return summarize(latencies, time.time() - start)
+
+
+    async def _scrape_heartbeats(self):
+        response = await self.http.fetch(self._url('metrics'))
+        match = re.search(r'^logagg_master_heartbeats_total\{cluster="bench"\} (\S+)$',
+                            response.body.decode('utf-8'), re.MULTILINE)
+        return float(match.group(1)) if match else 0
+
+
+    async def _heartbeat_ingestion(self):
+        before = await self._scrape_heartbeats()
+        start = time.time()
+        await gen.sleep(self.args.duration)
+        ingested = await self._scrape_heartbeats() - before
+        seconds = time.time() - start
+
+        # How long after being sent the latest heartbeat of every component got into the registry
+        result = await self._call('get_components', cluster_name=CLUSTER_NAME,
+                                cluster_passwd=self.cluster_passwd, state='alive')
+        latencies = [c['last_seen'] - c['timestamp'] for c in result['components_info'] if 'timestamp' in c]
+
+        return dict(summarize(latencies, seconds),
+                    sent_per_second=self.args.heartbeat_rate,
+                    ingested=ingested,
+                    per_second=ingested / seconds)
+
+
+    async def _tail_logs(self):
+        a = self.args
+        latencies = list()
+        received = [0]
+
+        def reader():
+            partial = [b'']
+
+            def on_chunk(chunk):
+                now = time.time()
+                lines = (partial[0] + chunk).split(b'\n')
+                partial[0] = lines.pop()
+
+                for line in lines:
+                    if not line: continue
+                    raw = json.loads(line).get('result')
+                    if not raw: continue
+                    received[0] += 1
+                    # Only a sample of lines, parsing them all would slow the clients down
+                    if received[0] % 100 == 0:
+                        latencies.append(now - json.loads(raw)['sent_at'])
+
+            return on_chunk
+
+        client = AsyncHTTPClient(force_instance=True, max_clients=a.tails)
+        url = self._url('tail_logs', cluster_name=CLUSTER_NAME, cluster_passwd=self.cluster_passwd)
+        for _ in range(a.tails):
+            # Left to time out once measured, closing them early only adds noise to the logs
+            client.fetch(HTTPRequest(url, streaming_callback=reader(), request_timeout=a.warmup + a.duration + 1),
+                        raise_error=False)
+
+        await gen.sleep(a.warmup)
+        received[0] = 0
+        del latencies[:]
+        start = time.time()
+        await gen.sleep(a.duration)
+        seconds = time.time() - start
+        lines = received[0]
+
+        return dict(summarize(latencies, seconds),
+                    tails=a.tails,
+                    sent_per_second=a.log_rate,
+                    lines=lines,
+                    per_second=lines / seconds,
+                    per_tail_per_second=lines / seconds / a.tails)
+
+
+    async def _run_scenarios(self):
+        a = self.args
+        self.http = AsyncHTTPClient(force_instance=True, max_clients=a.concurrency)
+        await self._setup()
+        await gen.sleep(a.warmup)
+
+        auth = dict(cluster_name=CLUSTER_NAME, cluster_passwd=self.cluster_passwd)
+        def collector(i):
+            return dict(auth, collector_host='localhost', collector_port=a.base_port + 100 + i % a.collectors)
+
+        results = dict()
+        results['heartbeat_ingestion'] = await self._heartbeat_ingestion()
+        results['register_component'] = await self._load(
+            self._url('register_component', namespace='collector', host='bench-{}'.format(i), port=1088, **auth)
+            for i in range(a.requests))
+        results['get_components'] = await self._load(
+            self._url('get_components', **auth) for i in range(a.requests))
+        results['collector_add_file'] = await self._load(
+            self._url('collector_add_file', fpath='"/var/log/bench.log"', formatter='"bench"', **collector(i))
+            for i in range(a.requests))
+        results['collector_remove_file'] = await self._load(
+            self._url('collector_remove_file', fpath='"/var/log/bench.log"', **collector(i))
+            for i in range(a.requests))
+        results['batch_collector_add_file'] = dict(await self._load(
+            self._url('batch_collector_add_file', fpath='"/var/log/bench.log"', formatter='"bench"',
+                    host_pattern='"localhost"', **auth)
+            for i in range(max(1, a.requests // a.collectors))), collectors=a.collectors)
+        results['tail_logs'] = await self._tail_logs()
+
+        return results
+
+
+    def run(self):
+        started_at = time.time()
+        self._start_loop('standins', self._start_standins)
+        self._start_loop('master', self._start_master)
+
+        results = tornado.ioloop.IOLoop.current().run_sync(self._run_scenarios)
+        for scenario, result in results.items():
+            self.log.info('benchmark_result', scenario=scenario, **result)
+
+        params = {k: v for k, v in vars(self.args).items() if isinstance(v, (str, int, float, type(None)))}
+        report = {'started_at': started_at,
+                    'python': platform.python_version(),
+                    'platform': platform.platform(),
+                    'params': params,
+                    'results': results}
+
+        output = self.args.output or time.strftime('benchmark-%Y%m%d-%H%M%S.json')
+        with open(output, 'w') as f:
+            f.write(json.dumps(report, indent=4))
+        self.log.info('benchmark_results_saved', output=output)
+
+
+    def define_args(self, parser):
+        parser.add_argument('--output', '-o', default=None,
+                help='File to save the results to, default: benchmark-<time>.json')
+        parser.add_argument('--mongodb', '-d', default=None,
+                help='Real mongodb to use, its db is dropped first, format: <host=localhost:port=27017:db=name>, default: mongomock')
+        parser.add_argument('--storage', choices=STORAGES, default=MONGODB,
+                help='Storage of the master, default: %(default)s')
+        parser.add_argument('--sqlite-path', default='logagg-bench.db',
+                help='Database file of --storage sqlite, removed first, default: %(default)s')
+        parser.add_argument('--base-port', type=int, default=18088,
+                help='Port of the master, the stand-ins listen on the ports after it, default: %(default)s')
+        parser.add_argument('--collectors', '-c', type=int, default=20,
+                help='Number of fake collectors, default: %(default)s')
+        parser.add_argument('--components', type=int, default=1000,
+                help='Number of distinct components sending heartbeats, default: %(default)s')
+        parser.add_argument('--heartbeat-rate', type=float, default=2000,
+                help='Heartbeats per second sent by the fake nsq_api, default: %(default)s')
+        parser.add_argument('--log-rate', type=float, default=5000,
+                help='Log lines per second sent by the fake nsq_api, default: %(default)s')
+        parser.add_argument('--tails', '-t', type=int, default=10,
+                help='Number of tail_logs streams to hold open, default: %(default)s')
+        parser.add_argument('--requests', '-r', type=int, default=1000,
+                help='Requests per API scenario, default: %(default)s')
+        parser.add_argument('--concurrency', type=int, default=10,
+                help='Requests in flight at once, default: %(default)s')
+        parser.add_argument('--duration', type=float, default=10,
+                help='Seconds heartbeat ingestion and tail_logs are measured for, default: %(default)s')
+        parser.add_argument('--warmup', '-w', type=float, default=2,
+                help='Seconds to wait before measuring, default: %(default)s')
+
+
+def main():
+    BenchmarkSuite().start()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,104 @@
+'''
+Measures how long ordinary API calls take on a running logagg-master
+while many `tail_logs` streams are held open against it.
+
+Sample run:
+python benchmarks/tail_latency.py run --master localhost:1088 --cluster-name logagg --cluster-passwd xxxx --tails 50
+'''
+import time
+
+from basescript import BaseScript
+import tornado.ioloop
+from tornado import gen
+from tornado.httpclient import AsyncHTTPClient, HTTPRequest
+
+TAIL_LOGS_URL = 'http://{master}/logagg/v1/tail_logs?cluster_name={cluster_name}&cluster_passwd={cluster_passwd}'
+PING_URL = 'http://{master}/logagg/v1/ping?key=xyz&secret=xxxx'
+
+def percentile(values, p):
+    '''
+    >>> percentile([1, 2, 3], 50)
+    2
+    >>> percentile([1, 2, 3, 4], 99)
+    4
+    '''
+    values = sorted(values)
+    index = int(round(p / 100.0 * (len(values) - 1)))
+    return values[index]
+
+
+class TailLatencyBenchmark(BaseScript):
+    DESC = 'p99 latency of logagg-master API calls with tails open'
+
+    def __init__(self):
+        super().__init__()
+        self.tail_bytes = 0
+
+
+    def _on_tail_chunk(self, chunk):
+        self.tail_bytes += len(chunk)
+
+
+    def _open_tails(self):
+        url = TAIL_LOGS_URL.format(master=self.args.master,
+                                    cluster_name=self.args.cluster_name,
+                                    cluster_passwd=self.args.cluster_passwd)
+        client = AsyncHTTPClient(force_instance=True, max_clients=self.args.tails)
+
+        for _ in range(self.args.tails):
+            request = HTTPRequest(url,
+                                streaming_callback=self._on_tail_chunk,
+                                request_timeout=3600)
+            client.fetch(request, raise_error=False)
+
+
+    async def _measure(self):
+        self._open_tails()
+        # Give every tail time to reach nsq_api before measuring
+        await gen.sleep(self.args.warmup)
+
+        client = AsyncHTTPClient(force_instance=True)
+        url = PING_URL.format(master=self.args.master)
+        latencies = list()
+
+        for _ in range(self.args.requests):
+            start = time.time()
+            await client.fetch(url)
+            latencies.append((time.time() - start) * 1000)
+
+        return latencies
+
+
+    def run(self):
+        latencies = tornado.ioloop.IOLoop.current().run_sync(self._measure)
+
+        self.log.info('tail_latency_benchmark',
+                    tails=self.args.tails,
+                    requests=len(latencies),
+                    tail_bytes=self.tail_bytes,
+                    p50_ms=percentile(latencies, 50),
+                    p90_ms=percentile(latencies, 90),
+                    p99_ms=percentile(latencies, 99),
+                    max_ms=max(latencies))
+
+
+    def define_args(self, parser):
+        parser.add_argument('--master', '-m', default='localhost:1088',
+                help='Address of the running logagg-master, default: %(default)s')
+        parser.add_argument('--cluster-name', '-n', required=True,
+                help='Cluster to tail')
+        parser.add_argument('--cluster-passwd', '-p', required=True,
+                help='Password of the cluster to tail')
+        parser.add_argument('--tails', '-t', type=int, default=50,
+                help='Number of tail_logs streams to hold open, default: %(default)s')
+        parser.add_argument('--requests', '-r', type=int, default=1000,
+                help='Number of ping calls to time, default: %(default)s')
+        parser.add_argument('--warmup', '-w', type=float, default=2,
+                help='Seconds to wait after opening the tails, default: %(default)s')
+
+
+def main():
+    TailLatencyBenchmark().start()
+
+if __name__ == '__main__':
+    main()
@@ -1,5 +1,6 @@
 import sys
 from os.path import expanduser
+from urllib.parse import urlencode
 
 import ujson as json
 from tabulate import tabulate
@@ -9,6 +10,8 @@ from logagg_utils import ensure_dir
 from deeputil import AttrDict
 from structlog.dev import ConsoleRenderer
 
+from .outbound import OutboundClient
+
 def prGreen(txt): print("\033[92m {}\033[00m" .format(txt))
 def prRed(err): print("\033[91m {}\033[00m" .format(err))
 
@@ -20,16 +23,23 @@ class LogaggCli():
     MASTER_PING_URL = 'http://{host}:{port}/logagg/v1/ping?key={key}&secret={secret}'
     MASTER_ADD_NSQ_URL = 'http://{host}:{port}/logagg/v1/add_nsq?nsqd_tcp_address={nsqd_tcp_address}&nsqd_http_address={nsqd_http_address}&key={key}&secret={secret}'
     MASTER_GET_NSQ_URL = 'http://{host}:{port}/logagg/v1/get_nsq?key={key}&secret={secret}'
-    CREATE_CLUSTER_URL = 'http://{host}:{port}/logagg/v1/create_cluster?cluster_name={cluster_name}'
+    CREATE_CLUSTER_URL = 'http://{host}:{port}/logagg/v1/create_cluster?cluster_name={cluster_name}&shards={shards}'
     GET_CLUSTER_URL = 'http://{host}:{port}/logagg/v1/get_clusters'
     GET_CLUSTER_INFO_URL = 'http://{host}:{port}/logagg/v1/get_cluster_info?cluster_name={cluster_name}&cluster_passwd={cluster_passwd}'
+    MIGRATE_CLUSTER_URL = 'http://{host}:{port}/logagg/v1/migrate_cluster?cluster_name={cluster_name}&nsqd_tcp_address={nsqd_tcp_address}&key={key}&secret={secret}'
     CHANGE_CLUSTER_PASSWD_URL = 'http://{host}:{port}/logagg/v1/change_cluster_passwd?cluster_name={cluster_name}&old_passwd={old_passwd}&new_passwd={new_passwd}'
     GET_COMPONENT_URL = 'http://{host}:{port}/logagg/v1/get_components?cluster_name={cluster_name}&cluster_passwd={cluster_passwd}'
+    COMPONENTS_PAGE_SIZE = 500
     TAIL_LOGS_URL = 'http://{host}:{port}/logagg/v1/tail_logs?cluster_name={cluster_name}&cluster_passwd={cluster_passwd}'
     COLLECTOR_ADD_FILE_URL = 'http://{host}:{port}/logagg/v1/collector_add_file?cluster_name={cluster_name}&cluster_passwd={cluster_passwd}&collector_host={collector_host}&collector_port={collector_port}&fpath="{fpath}"&formatter="{formatter}"'
     COLLECTOR_REMOVE_FILE_URL = 'http://{host}:{port}/logagg/v1/collector_remove_file?cluster_name={cluster_name}&cluster_passwd={cluster_passwd}&collector_host={collector_host}&collector_port={collector_port}&fpath="{fpath}"'
+    BATCH_COLLECTOR_ADD_FILE_URL = 'http://{host}:{port}/logagg/v1/batch_collector_add_file?cluster_name={cluster_name}&cluster_passwd={cluster_passwd}'
+    BATCH_COLLECTOR_REMOVE_FILE_URL = 'http://{host}:{port}/logagg/v1/batch_collector_remove_file?cluster_name={cluster_name}&cluster_passwd={cluster_passwd}'
+
+    MASTER_READ_TIMEOUT = 60 # seconds, the master may itself be waiting on collectors
 
     def __init__(self):
+        self.http = OutboundClient(read_timeout=self.MASTER_READ_TIMEOUT)
         self.data_path = ensure_dir(expanduser('~/.logagg'))
         self.state = DiskDict(self.data_path)
         self._init_state()
@@ -67,7 +77,7 @@ class LogaggCli():
         Request mater urls and return response
         '''
         try:
-            response =  requests.get(url)
+            response =  self.http.get(url)
             response = json.loads(response.content.decode('utf-8'))
             return response
 
@@ -75,6 +85,10 @@ class LogaggCli():
             err_msg = 'Could not reach master, url: {}'.format(url)
             prRed(err_msg)
 
+        except requests.exceptions.Timeout:
+            err_msg = 'Master did not respond in time, url: {}'.format(url)
+            prRed(err_msg)
+
 
     def clear(self):
         '''
@@ -177,7 +191,7 @@ class LogaggCli():
             sys.exit(0)
 
 
-    def create_cluster(self, cluster_name):
+    def create_cluster(self, cluster_name, shards=1):
         '''
         Create a cluster in logagg-master
         '''
@@ -185,7 +199,8 @@ class LogaggCli():
 
         create_cluster_url = self.CREATE_CLUSTER_URL.format(host=master.host,
                                                             port=master.port,
-                                                            cluster_name=cluster_name)
+                                                            cluster_name=cluster_name,
+                                                            shards=shards)
         create_cluster_result = self.request_master_url(create_cluster_url)
 
         if create_cluster_result['result']['success']: 
@@ -229,6 +244,9 @@ class LogaggCli():
         cluster_list = list_cluster_result['result']
 
         for cluster in cluster_list:
+            cluster['backpressure'] = cluster.get('backpressure', {}).get('state')
+            cluster['draining'] = ','.join(d['nsqd_tcp_address'] for d in cluster.get('draining') or [])
+            cluster['shards'] = len(cluster.get('shards') or [cluster])
             if cluster['cluster_name'] in saved_cluster_names: cluster['admin'] = True
             else: cluster['admin'] = False
             if cluster['cluster_name'] == self.state['default_cluster'].get('cluster_name'): cluster['default_cluster'] = True
@@ -236,15 +254,30 @@ class LogaggCli():
 
         headers = ['Cluster-name',
                 'Nsqd TCP address',
-                'NSQd TCP address',
+                'Nsqd HTTP address',
                 'NSQ max depth',
                 'Nsq API address',
                 'Heartbeat topic',
                 'Logs topic',
+                'Shards',
+                'Draining',
+                'Backpressure',
                 'Admin',
                 'Default cluster']
+        keys = ['cluster_name',
+                'nsqd_tcp_address',
+                'nsqd_http_address',
+                'nsq_depth_limit',
+                'nsq_api_address',
+                'heartbeat_topic',
+                'logs_topic',
+                'shards',
+                'draining',
+                'backpressure',
+                'admin',
+                'default_cluster']
         data =  list()
-        for c in cluster_list: data.append(list(c.values()))
+        for c in cluster_list: data.append([c.get(k) for k in keys])
         print(tabulate(data, headers=headers))
 
 
@@ -357,36 +390,74 @@ class LogaggCli():
                                                                 cluster_name=cluster_name,
                                                                 cluster_passwd=cluster_passwd)
 
-            get_components_result = self.request_master_url(get_components_url)
+            headers = ['Namespace',
+                    'Host',
+                    'Port',
+                    'Cluster name',
+                    'files tracked',
+                    'Heartbeat number',
+                    'timestamp',
+                    'State',]
+            fields = ['namespace', 'host', 'port', 'cluster_name',
+                        'files_tracked', 'heartbeat_number', 'timestamp', 'state']
+            params = {'namespace': 'collector',
+                        'fields': ','.join(fields),
+                        'limit': self.COMPONENTS_PAGE_SIZE}
+
+            # Printed a page at a time, as they come
+            first_page = True
+            while True:
+                get_components_result = self.request_master_url(get_components_url + '&' + urlencode(params))
+                if not get_components_result: return
+
+                if not get_components_result['result']['success']:
+                    # Print result
+                    msg = get_components_result['result']['details']
+                    prRed(msg)
+                    return
 
-            if get_components_result['result']['success']: 
                 components_info = get_components_result['result'].get('components_info')
+                data = [[c.get(f) for f in fields] for c in components_info]
+                if first_page: print(tabulate(data, headers=headers))
+                elif data: print(tabulate(data, tablefmt='plain'))
+                first_page = False
 
-                headers = ['Namespace',
-                        'Host',
-                        'Port',
-                        'Cluster name',
-                        'files tracked',
-                        'Heartbeat number',
-                        'timestamp',]
-
-                data =  list()
-                for c in components_info:
-                    if c.get('namespace') == 'collector':
-                        data.append([c.get('namespace'),
-                                     c.get('host'),
-                                     c.get('port'),
-                                     c.get('cluster_name'),
-                                     c.get('files_tracked'),
-                                     c.get('heartbeat_number'),
-                                     c.get('timestamp')]
-                                     )
-                print(tabulate(data, headers=headers))
+                next_cursor = get_components_result['result'].get('next_cursor')
+                if not next_cursor: break
+                params['cursor'] = next_cursor
 
-            else:
-                # Print result
-                msg = get_components_result['result']['details']
-                prRed(msg)
+
+    def migrate_cluster(self, cluster_name, nsqd_tcp_address):
+        '''
+        Move a cluster to another nsqd of master
+        '''
+        master = self.ensure_master()
+
+        if not master.admin:
+            err_msg = 'Requires admin permissions to master'
+            prRed(err_msg)
+            sys.exit(0)
+
+        migrate_cluster_url = self.MIGRATE_CLUSTER_URL.format(host=master.host,
+                                                            port=master.port,
+                                                            cluster_name=cluster_name,
+                                                            nsqd_tcp_address=nsqd_tcp_address,
+                                                            key=master.key,
+                                                            secret=master.secret)
+
+        migrate_cluster_result = self.request_master_url(migrate_cluster_url)
+
+        if migrate_cluster_result['result']['success']:
+            result = migrate_cluster_result['result']
+            msg = 'Migrating cluster-name: {cluster_name} to: {nsqd_tcp_address}, draining: {draining}, collectors told: {told}/{num}'
+            prGreen(msg.format(cluster_name=cluster_name,
+                                nsqd_tcp_address=nsqd_tcp_address,
+                                draining=','.join(result['draining']),
+                                told=result['collectors_told'],
+                                num=result['num_collectors']))
+        else:
+            err_msg = migrate_cluster_result['result']['details']
+            prRed(err_msg)
 
 
     def change_password_cluster(self, cluster_name, new_password, old_password):
@@ -435,9 +506,9 @@ class LogaggCli():
             prRed(msg)
 
 
-    def tail(self, pretty):
+    def tail(self, pretty, level=None, host=None, namespace=None, fields=None, regex=None, drop_policy=None):
         '''
-        Tail the logs of a cluster
+        Tail the logs of a cluster, filters are applied by the master
         '''
         master = self.ensure_master()
 
@@ -453,6 +524,11 @@ class LogaggCli():
                                                         cluster_name=cluster_name,
                                                         cluster_passwd=cluster_passwd)
 
+            params = {'level': level, 'host': host, 'namespace': namespace, 'field': fields, 'regex': regex,
+                      'drop_policy': drop_policy}
+            params = {k: v for k, v in params.items() if v}
+            if params: tail_logs_url += '&' + urlencode(params, doseq=True)
+
             try:
                 session = requests.session()
                 resp = session.get(tail_logs_url, stream=True)
@@ -461,6 +537,11 @@ class LogaggCli():
                     log = dict()
                     try:
                         result = json.loads(line.decode('utf-8'))
+                        if result.get('dropped'):
+                            prRed('{} lines dropped'.format(result['dropped']))
+                        if not result.get('success'):
+                            prRed(result.get('details'))
+                            sys.exit(0)
                         result = result.get('result')
                         if result: log = json.loads(result)
                         else: continue
@@ -556,3 +637,53 @@ class LogaggCli():
                 prRed(msg)
 
 
+    def _batch_collector_request(self, url, params):
+        master = self.ensure_master()
+
+        if not self.state['default_cluster']:
+            err_msg = 'No default cluster'
+            prRed(err_msg)
+            return
+
+        url = url.format(host=master.host,
+                        port=master.port,
+                        cluster_name=self.state['default_cluster']['cluster_name'],
+                        cluster_passwd=self.state['default_cluster']['cluster_passwd'])
+        params = {k: '"{}"'.format(v) for k, v in params.items() if v}
+        batch_result = self.request_master_url(url + '&' + urlencode(params))
+        if not batch_result: return
+
+        if batch_result['result']['success']:
+            headers = ['Host', 'Port', 'Success', 'File paths']
+            data = list()
+            for r in batch_result['result']['results']:
+                if r['success']:
+                    fpaths = ', '.join(f['fpath'] for f in r['fpaths'])
+                else:
+                    fpaths = r['details']
+                data.append([r['host'], r['port'], r['success'], fpaths])
+            print(tabulate(data, headers=headers))
+
+        else:
+            prRed(batch_result['result']['details'])
+
+
+    def batch_collector_add_file(self, fpath, formatter, collectors=None, host_pattern=None):
+        '''
+        Add file to many collectors, all of them if none are picked
+        '''
+        params = {'fpath': fpath,
+                'formatter': formatter,
+                'collectors': ','.join(collectors or []),
+                'host_pattern': host_pattern}
+        self._batch_collector_request(self.BATCH_COLLECTOR_ADD_FILE_URL, params)
+
+
+    def batch_collector_remove_file(self, fpath, collectors=None, host_pattern=None):
+        '''
+        Remove file-path from many collectors, all of them if none are picked
+        '''
+        params = {'fpath': fpath,
+                'collectors': ','.join(collectors or []),
+                'host_pattern': host_pattern}
+        self._batch_collector_request(self.BATCH_COLLECTOR_REMOVE_FILE_URL, params)
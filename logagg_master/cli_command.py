@@ -6,6 +6,8 @@ from .cli import LogaggCli
 
 class LogaggCliCommand(BaseScript):
     DESC = 'Logagg Master service and Command line tool'
+    # TailQueue.POLICIES, spelled out so the CLI does not import the master's tornado tail module
+    TAIL_DROP_POLICIES = ('drop_oldest', 'drop_newest', 'disconnect')
 
     def __init__(self):
         super().__init__()
@@ -44,7 +46,7 @@ class LogaggCliCommand(BaseScript):
         LogaggCli().list_nsq()
 
     def create_cluster(self):
-        LogaggCli().create_cluster(self.args.cluster_name)
+        LogaggCli().create_cluster(self.args.cluster_name, self.args.shards)
 
     def list_cluster(self):
         LogaggCli().list_cluster()
@@ -58,6 +60,9 @@ class LogaggCliCommand(BaseScript):
     def delete_cluster(self):
         LogaggCli().delete_cluster(self.args.cluster_name)
 
+    def migrate_cluster(self):
+        LogaggCli().migrate_cluster(self.args.cluster_name, self.args.nsqd_tcp_address)
+
     def change_password_cluster(self):
         LogaggCli().change_password_cluster(self.args.cluster_name,
                                             self.args.new_password,
@@ -77,8 +82,25 @@ class LogaggCliCommand(BaseScript):
                 self.args.collector_port,
                 self.args.fpath)
 
+    def batch_collector_add_file(self):
+        LogaggCli().batch_collector_add_file(self.args.fpath,
+                self.args.formatter,
+                collectors=self.args.collector,
+                host_pattern=self.args.host_pattern)
+
+    def batch_collector_remove_file(self):
+        LogaggCli().batch_collector_remove_file(self.args.fpath,
+                collectors=self.args.collector,
+                host_pattern=self.args.host_pattern)
+
     def tail(self):
-        LogaggCli().tail(self.args.pretty)
+        LogaggCli().tail(self.args.pretty,
+                level=self.args.level,
+                host=self.args.host,
+                namespace=self.args.namespace,
+                fields=self.args.field,
+                regex=self.args.regex,
+                drop_policy=self.args.drop_policy)
 
     def clear(self):
         LogaggCli().clear()
@@ -143,6 +165,9 @@ class LogaggCliCommand(BaseScript):
         cluster_cmd_create.add_argument(
                 '--cluster-name', '-n', required=True,
                 help='Name of the cluster, must me unique')
+        cluster_cmd_create.add_argument(
+                '--shards', '-s', type=int, default=1,
+                help='Number of nsqds to spread the logs of the cluster over, default: %(default)s')
         # cluster list
         cluster_cmd_list = cluster_cmd_subparser.add_parser('list',
                 help='List all the clusters in master')
@@ -171,6 +196,16 @@ class LogaggCliCommand(BaseScript):
         cluster_cmd_delete.add_argument(
                 '--cluster-name', '-n', required=True,
                 help='Name of the cluster')
+        # cluster migrate
+        cluster_cmd_migrate = cluster_cmd_subparser.add_parser('migrate',
+                help='Move a cluster to another nsqd, needs admin permissions to master')
+        cluster_cmd_migrate.set_defaults(func=self.migrate_cluster)
+        cluster_cmd_migrate.add_argument(
+                '--cluster-name', '-n', required=True,
+                help='Name of the cluster')
+        cluster_cmd_migrate.add_argument(
+                '--nsqd-tcp-address', '-t', required=True,
+                help='TCP address of the nsqd to move to, format: <hostname>:4150')
         # cluster change-password
         cluster_cmd_change_password = cluster_cmd_subparser.add_parser('change-password',
                 help='Change password of an existing cluster')
@@ -192,6 +227,26 @@ class LogaggCliCommand(BaseScript):
                 '--pretty', '-p',
                 action='store_true',
                 help='Print logs in pretty format')
+        cluster_cmd_tail.add_argument(
+                '--level', '-l',
+                help='Only logs of these levels, format: <error,warning>')
+        cluster_cmd_tail.add_argument(
+                '--host', '-i',
+                help='Only logs from these hosts, format: <host1,host2>')
+        cluster_cmd_tail.add_argument(
+                '--namespace', '-n',
+                help='Only logs from these namespaces, format: <ns1,ns2>')
+        cluster_cmd_tail.add_argument(
+                '--field', '-f',
+                action='append',
+                help='Only logs where a field has this exact value, can be repeated, format: <data.status=500>')
+        cluster_cmd_tail.add_argument(
+                '--regex', '-r',
+                help='Only logs whose message matches this regular expression')
+        cluster_cmd_tail.add_argument(
+                '--drop-policy', '-d',
+                choices=self.TAIL_DROP_POLICIES,
+                help='What the master does when logs come in faster than they are read, default: master\'s choice')
         # cluster collector
         cluster_cmd_collector = cluster_cmd_subparser.add_parser('collector',
                 help='Operations on cluster collectors')
@@ -233,6 +288,37 @@ class LogaggCliCommand(BaseScript):
         cluster_cmd_collector_remove_file.add_argument(
                 '--fpath', '-f',
                 help='File path of the log-file on the node where collector is running')
+        # cluster collector batch-add-file
+        cluster_cmd_collector_batch_add_file = cluster_cmd_collector_subparser.add_parser('batch-add-file',
+                help='Add file paths to many collectors at once, all of them unless picked')
+        cluster_cmd_collector_batch_add_file.set_defaults(func=self.batch_collector_add_file)
+        cluster_cmd_collector_batch_add_file.add_argument(
+                '--collector', '-c',
+                action='append',
+                help='Collector to add the file to, can be repeated, format: <host:port>')
+        cluster_cmd_collector_batch_add_file.add_argument(
+                '--host-pattern', '-H',
+                help='Collectors whose host matches this shell style pattern, format: <web-*>')
+        cluster_cmd_collector_batch_add_file.add_argument(
+                '--fpath', '-f', required=True,
+                help='File path of the log-file on the nodes where collectors are running')
+        cluster_cmd_collector_batch_add_file.add_argument(
+                '--formatter', '-b', required=True,
+                help='Formatter to use for the log-file')
+        # cluster collector batch-remove-file
+        cluster_cmd_collector_batch_remove_file = cluster_cmd_collector_subparser.add_parser('batch-remove-file',
+                help='Remove file-path from many collectors at once, all of them unless picked')
+        cluster_cmd_collector_batch_remove_file.set_defaults(func=self.batch_collector_remove_file)
+        cluster_cmd_collector_batch_remove_file.add_argument(
+                '--collector', '-c',
+                action='append',
+                help='Collector to remove the file from, can be repeated, format: <host:port>')
+        cluster_cmd_collector_batch_remove_file.add_argument(
+                '--host-pattern', '-H',
+                help='Collectors whose host matches this shell style pattern, format: <web-*>')
+        cluster_cmd_collector_batch_remove_file.add_argument(
+                '--fpath', '-f', required=True,
+                help='File path of the log-file on the nodes where collectors are running')
 
 
 def main():
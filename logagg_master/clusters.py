@@ -0,0 +1,138 @@
+import time
+import threading
+
+class ClusterCache():
+    '''
+    Cluster details by cluster name, read from mongodb at most once
+    every ttl seconds. Clusters that do not exist are cached too, so
+    create_cluster and change_cluster_passwd must invalidate the name
+    they touch.
+
+    When shared, other processes change clusters without invalidating
+    this cache. Details are then kept at most SHARED_TTL seconds and
+    clusters that do not exist are not cached, so a cluster created
+    elsewhere is found right away.
+    '''
+    TTL = 60 # seconds
+    SHARED_TTL = 5 # seconds
+
+    def __init__(self, collection, log, ttl=TTL, shared=False):
+
+        self.collection = collection
+        self.log = log
+        self.shared = shared
+        self.ttl = min(ttl, self.SHARED_TTL) if shared else ttl
+
+        self.lock = threading.Lock()
+        # {cluster_name: (expires_at, cluster or None)}
+        self.clusters = dict()
+
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+
+    def cached(self, cluster_name):
+        '''
+        (True, details) of a cluster while they are cached, details being
+        None if there is no such cluster, and (False, None) when they need
+        to be read. Never touches mongodb.
+        '''
+        entry = self.clusters.get(cluster_name)
+        if not entry or entry[0] <= time.time(): return False, None
+
+        with self.lock: self.hits += 1
+        return True, dict(entry[1]) if entry[1] else None
+
+
+    def get(self, cluster_name, fresh=False):
+        '''
+        Details of a cluster, None if there is no such cluster, read
+        from mongodb when not cached or when fresh ones are asked for.
+        Callers get their own copy and are free to change it.
+        '''
+        if not fresh:
+            found, cluster = self.cached(cluster_name)
+            if found: return cluster
+
+        now = time.time()
+        invalidations = self.invalidations
+        cluster = self.collection.find_one({'cluster_name': cluster_name})
+        if cluster: del cluster['_id']
+        with self.lock:
+            self.misses += 1
+            # What was read may predate an invalidation that raced it
+            if invalidations == self.invalidations and (cluster or not self.shared):
+                self.clusters[cluster_name] = (now + self.ttl, cluster)
+
+        return dict(cluster) if cluster else None
+
+
+    def invalidate(self, cluster_name):
+        with self.lock:
+            self.clusters.pop(cluster_name, None)
+            self.invalidations += 1
+
+
+    def stats(self):
+        '''
+        >>> c = ClusterCache(None, None)
+        >>> c.stats()
+        {'size': 0, 'hits': 0, 'misses': 0, 'invalidations': 0}
+        '''
+        with self.lock:
+            return {'size': len(self.clusters),
+                    'hits': self.hits,
+                    'misses': self.misses,
+                    'invalidations': self.invalidations}
+
+
+def cluster_version(cluster):
+    '''
+    Every change to a cluster's document bumps its version, so processes
+    holding on to its details can tell they are stale
+
+    >>> cluster_version({'cluster_name': 'logagg', 'version': 3}), cluster_version({'cluster_name': 'logagg'})
+    (3, 0)
+    '''
+    return cluster.get('version', 0)
+
+
+def nsq_shards(cluster):
+    '''
+    Every nsqd the collectors of a cluster write to. A cluster created
+    with a single shard has no "shards" and writes to its own nsqd.
+
+    >>> cluster = {'nsqd_tcp_address': 'a:4150', 'nsqd_http_address': 'a:4151',
+    ...            'nsq_api_address': 'api:1077', 'logs_topic': 'x_logs',
+    ...            'heartbeat_topic': 'x_heartbeat#ephemeral'}
+    >>> [s['nsqd_tcp_address'] for s in nsq_shards(cluster)]
+    ['a:4150']
+    >>> cluster['shards'] = [{'nsqd_tcp_address': 'a:4150', 'nsqd_http_address': 'a:4151', 'nsq_api_address': 'api:1077'},
+    ...                      {'nsqd_tcp_address': 'b:4150', 'nsqd_http_address': 'b:4151', 'nsq_api_address': 'api:1077'}]
+    >>> [(s['nsqd_tcp_address'], s['logs_topic']) for s in nsq_shards(cluster)]
+    [('a:4150', 'x_logs'), ('b:4150', 'x_logs')]
+    '''
+    keys = ('nsqd_tcp_address', 'nsqd_http_address', 'nsq_api_address')
+    shards = cluster.get('shards') or [{k: cluster[k] for k in keys}]
+
+    return [dict(s, logs_topic=cluster['logs_topic'], heartbeat_topic=cluster['heartbeat_topic'])
+            for s in shards]
+
+
+def nsq_sources(cluster):
+    '''
+    Every nsqd the logs and heartbeats of a cluster are read from: its
+    shards, first, then any nsqd it was migrated away from that is still
+    being drained
+
+    >>> cluster = {'nsqd_tcp_address': 'b:4150', 'nsqd_http_address': 'b:4151', 'nsq_api_address': 'api:1077',
+    ...            'logs_topic': 'x_logs', 'heartbeat_topic': 'x_heartbeat#ephemeral',
+    ...            'draining': [{'nsqd_tcp_address': 'a:4150', 'nsq_api_address': 'api:1077',
+    ...                          'logs_topic': 'x_logs', 'heartbeat_topic': 'x_heartbeat#ephemeral'}]}
+    >>> [s['nsqd_tcp_address'] for s in nsq_sources(cluster)]
+    ['b:4150', 'a:4150']
+    '''
+    keys = ('nsqd_tcp_address', 'nsq_api_address', 'logs_topic', 'heartbeat_topic')
+
+    return [{k: s[k] for k in keys} for s in nsq_shards(cluster) + (cluster.get('draining') or [])]
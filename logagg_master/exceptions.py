@@ -8,3 +8,10 @@ class InvalidArgument(BaseException):
     def __str__(self):
         return '"{}"'.format(self.argument)
 
+
+class MongoTimeout(BaseException):
+    def __init__(self, operation):
+        self.operation = operation
+
+    def __str__(self):
+        return 'Mongodb took too long to "{}"'.format(self.operation)
@@ -0,0 +1,264 @@
+import time
+import threading
+
+import ujson as json
+import tornado.ioloop
+from tornado import gen
+from tornado.httpclient import HTTPError
+from tornado.util import TimeoutError
+from pymongo import UpdateOne
+from deeputil import keeprunning
+from logagg_utils import log_exception, start_daemon_thread
+
+from .tail import NsqApiStream
+from .clusters import nsq_sources, cluster_version
+
+class HeartbeatWriter():
+    '''
+    Writes component details to the components collection.
+    Upserts are accumulated and written as one unordered bulk_write once
+    batch_size of them pile up or batch_interval seconds after the first one.
+    A batch_size of 1 writes every heartbeat on its own with update_one.
+    Without autoflush batches are only written when full or flushed, for
+    callers like the ComponentRegistry that flush themselves and must see
+    every write that fails.
+    '''
+    BATCH_SIZE = 1000
+    BATCH_INTERVAL = 1 # seconds
+
+    def __init__(self, collection, log, batch_size=BATCH_SIZE, batch_interval=BATCH_INTERVAL, autoflush=True):
+
+        self.collection = collection
+        self.log = log
+        self.batch_size = batch_size
+        self.batch_interval = batch_interval
+
+        self.lock = threading.Lock()
+        self.pending = list()
+        self.first_pending_at = None
+
+        # Reported with every write
+        self.num_written = 0
+        self.last_report_at = time.time()
+
+        if self.batch_size > 1 and autoflush:
+            self.flush_thread = start_daemon_thread(self._flush_when_due)
+
+
+    @staticmethod
+    def _upsert(component):
+        key = {'cluster_name': component['cluster_name'],
+               'namespace': component['namespace'],
+               'host': component['host'],
+               'port': component['port']}
+        return key, {'$set': component}
+
+
+    def add(self, component):
+        '''
+        Queue the upsert for a component, writing the batch if it is full
+        '''
+        key, update = self._upsert(component)
+
+        if self.batch_size <= 1:
+            start = time.time()
+            self.collection.update_one(key, update, upsert=True)
+            self._report(1, time.time() - start)
+            return
+
+        with self.lock:
+            if not self.pending: self.first_pending_at = time.time()
+            self.pending.append(UpdateOne(key, update, upsert=True))
+            full = len(self.pending) >= self.batch_size
+
+        if full: self.flush()
+
+
+    def flush(self):
+        '''
+        Write all pending upserts in one round trip
+        '''
+        with self.lock:
+            batch, self.pending = self.pending, list()
+            self.first_pending_at = None
+
+        if not batch: return
+
+        start = time.time()
+        self.collection.bulk_write(batch, ordered=False)
+        self._report(len(batch), time.time() - start)
+
+
+    def _report(self, num, latency):
+        with self.lock:
+            self.num_written += num
+            now = time.time()
+            elapsed = now - self.last_report_at
+            if elapsed < self.batch_interval: return
+
+            rate = self.num_written / elapsed
+            self.num_written = 0
+            self.last_report_at = now
+
+        self.log.info('heartbeats_written',
+                    batch_size=num,
+                    batch_latency=latency,
+                    ingest_rate=rate)
+
+
+    @keeprunning(on_error=log_exception)
+    def _flush_when_due(self):
+        first_pending_at = self.first_pending_at
+        if first_pending_at is not None and time.time() - first_pending_at >= self.batch_interval:
+            self.flush()
+
+        time.sleep(min(self.batch_interval, 0.1))
+
+
+class HeartbeatReader():
+    '''
+    Reads the heartbeat topics of all clusters on the IOLoop, one
+    non-blocking nsq_api stream per cluster and nsqd it is read from,
+    and hands every heartbeat to the component registry. Nothing is
+    read until it is started. Given owns, only the clusters it is true
+    for are read.
+    '''
+    SCAN_INTERVAL = 30 # seconds
+    RETRY_INTERVAL = 30 # seconds
+
+    def __init__(self, cluster_collection, registry, log, nsq_apis=None, metrics=None, owns=None):
+
+        self.cluster_collection = cluster_collection
+        self.registry = registry
+        self.log = log
+        self.nsq_apis = nsq_apis
+        self.metrics = metrics
+        self.owns = owns
+        if metrics:
+            metrics.describe('logagg_master_heartbeats_total', 'counter', 'Heartbeats read per cluster')
+            metrics.describe('logagg_master_invalid_heartbeats_total', 'counter', 'Heartbeats that could not be read')
+
+        # {cluster_name: {nsqd_tcp_address: NsqApiStream}}
+        self.streams = dict()
+        # {cluster_name: version of the details the streams were opened for}
+        self.versions = dict()
+        self.last_scan_at = None
+        self.running = False
+
+        self.ioloop = tornado.ioloop.IOLoop.current()
+
+
+    def start(self):
+        '''
+        Start reading the heartbeats of every cluster, safe to call from any thread
+        '''
+        if self.running: return
+        self.running = True
+        self.ioloop.add_callback(self._scan_periodically)
+
+
+    def update(self, cluster):
+        '''
+        Start reading the heartbeats of a new or migrated cluster from
+        wherever it lives now, safe to call from any thread
+        '''
+        if not self.running: return
+        if self.owns and not self.owns(cluster['cluster_name']): return
+        self.ioloop.add_callback(self._update, cluster)
+
+
+    def rescan(self):
+        '''
+        Read the clusters again, after what is owned changed
+        '''
+        if not self.running: return
+        self.ioloop.add_callback(self._scan)
+
+
+    def _update(self, cluster):
+        cluster_name = cluster['cluster_name']
+        # Read before a change that was already applied
+        if cluster_version(cluster) < self.versions.get(cluster_name, 0): return
+        self.versions[cluster_name] = cluster_version(cluster)
+        streams = self.streams.setdefault(cluster_name, dict())
+        sources = nsq_sources(cluster)
+        wanted = set(s['nsqd_tcp_address'] for s in sources)
+
+        for address in list(streams):
+            if address not in wanted: streams.pop(address).close()
+
+        for source in sources:
+            if source['nsqd_tcp_address'] in streams: continue
+            stream = NsqApiStream(source['nsq_api_address'],
+                                source['nsqd_tcp_address'],
+                                source['heartbeat_topic'],
+                                self._on_lines,
+                                self.log,
+                                empty_lines='no',
+                                nsq_apis=self.nsq_apis)
+            streams[source['nsqd_tcp_address']] = stream
+            self.ioloop.spawn_callback(self._read, cluster_name, stream)
+
+
+    def _stop(self, cluster_name):
+        self.log.info('heartbeat_reading_stopped', cluster=cluster_name)
+        self.versions.pop(cluster_name, None)
+        for stream in self.streams.pop(cluster_name).values(): stream.close()
+
+
+    async def _read(self, cluster_name, stream):
+        self.log.info('updating_components', cluster=cluster_name, nsqd_tcp_address=stream.nsqd_tcp_address)
+
+        while not stream.closed:
+            try:
+                await stream.read()
+            except (HTTPError, OSError, TimeoutError):
+                self.log.warn('cannot_request_nsq_api___will_try_again', url=stream.url)
+                await gen.sleep(self.RETRY_INTERVAL)
+
+
+    def _on_lines(self, lines):
+        for line in lines:
+            if not line: continue
+
+            try:
+                heartbeat = json.loads(line.decode('utf-8'))
+                self.registry.update(heartbeat)
+            except (ValueError, KeyError, TypeError):
+                # Raising here would end the stream
+                self.log.warn('invalid_heartbeat', line=line)
+                if self.metrics: self.metrics.inc('logagg_master_invalid_heartbeats_total')
+                continue
+
+            if self.metrics: self.metrics.inc('logagg_master_heartbeats_total', cluster=heartbeat['cluster_name'])
+
+
+    async def _scan(self):
+        # Only streams that were there before the read may be stale
+        known = set(self.streams)
+        clusters = await self.ioloop.run_in_executor(None,
+                        lambda: list(self.cluster_collection.find({}, {'_id': 0})))
+
+        cluster_names = set()
+        for cluster in clusters:
+            if self.owns and not self.owns(cluster['cluster_name']): continue
+            cluster_names.add(cluster['cluster_name'])
+            self._update(cluster)
+
+        for cluster_name in known - cluster_names:
+            if cluster_name in self.streams: self._stop(cluster_name)
+
+        self.last_scan_at = time.time()
+
+
+    async def _scan_periodically(self):
+        '''
+        Picks up clusters created or migrated by other masters and drops removed ones
+        '''
+        while True:
+            try:
+                await self._scan()
+            except Exception:
+                log_exception(self, self._scan)
+
+            await gen.sleep(self.SCAN_INTERVAL)
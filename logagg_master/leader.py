@@ -0,0 +1,36 @@
+import os
+import fcntl
+
+from logagg_utils import log_exception, start_daemon_thread
+
+class LeaderLock():
+    '''
+    Elects one of the worker processes of a master to do the work that
+    must be done once per master, like reading heartbeats, by an
+    exclusive lock on a file every worker waits for. The kernel drops
+    the lock of a process however it dies, so a waiting worker takes
+    over as soon as the leader is gone.
+    '''
+
+    def __init__(self, path, log, on_elected):
+
+        self.path = path
+        self.log = log
+        self.on_elected = on_elected
+        self.is_leader = False
+
+        self.wait_thread = start_daemon_thread(self._wait)
+        self.wait_thread.name = 'leader_election'
+
+
+    def _wait(self):
+        try:
+            # Left open for as long as the process lives, closing it drops the lock
+            self.lock_file = open(self.path, 'a')
+            fcntl.flock(self.lock_file, fcntl.LOCK_EX)
+
+            self.is_leader = True
+            self.log.info('elected_leader', pid=os.getpid(), lock=self.path)
+            self.on_elected()
+        except Exception:
+            log_exception(self, self._wait)
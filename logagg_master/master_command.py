@@ -1,16 +1,53 @@
 import os
 import socket
+import tempfile
 
 from basescript import BaseScript
 from deeputil import AttrDict
 import tornado.ioloop
 import tornado.web
+import tornado.netutil
+import tornado.process
+import tornado.httpserver
 from kwikapi.tornado import RequestHandler
 from kwikapi import API
 
 from .service import MasterService, Master
+from .tail import TailLogsHandler, FlushPolicy, TailQueue
+from .heartbeat import HeartbeatWriter
+from .registry import ComponentRegistry
+from .clusters import ClusterCache
+from .outbound import OutboundClient
+from .nsq import NsqLoad, NsqApiPool, DepthMonitor
+from .metrics import MetricsHandler, request_logger
+from .mongo import MongoExecutor
+from .storage import STORAGES, MONGODB
 from .exceptions import InvalidArgument
 
+def make_app(master, log, flush_policy, max_queue=TailQueue.MAX_SIZE, drop_policy=TailQueue.DROP_OLDEST,
+            api_workers=API.THREADPOOL_SIZE):
+    '''
+    The tornado application serving the master's API, API calls run on
+    a pool of api_workers threads and never on the IOLoop
+    '''
+    master_api = MasterService(master, log)
+    api = API(threadpool_size=api_workers)
+    api.register(master_api, 'v1')
+
+    methods = set(m for m in dir(MasterService) if not m.startswith('_'))
+    methods.update(('tail_logs', 'metrics'))
+
+    return tornado.web.Application([
+        (r'^/logagg/v1/metrics', MetricsHandler, dict(master=master)),
+        (r'^/logagg/v1/tail_logs', TailLogsHandler, dict(master=master,
+                                                        log=log,
+                                                        flush_policy=flush_policy,
+                                                        max_queue=max_queue,
+                                                        drop_policy=drop_policy)),
+        (r'^/logagg/.*', RequestHandler, dict(api=api)),
+            ], log_function=request_logger(master.metrics, methods))
+
+
 class LogaggMasterCommand(BaseScript):
     DESC = 'Logagg Master service and Command line tool'
 
@@ -33,8 +70,11 @@ class LogaggMasterCommand(BaseScript):
             raise InvalidArgument(self.args.auth)
 
         mongodb = AttrDict()
+        if self.args.storage == MONGODB and not self.args.mongodb:
+            raise InvalidArgument('--mongodb is needed with --storage {}'.format(MONGODB))
+
         try:
-            m = self.args.mongodb.split(':')
+            m = self.args.mongodb.split(':') if self.args.mongodb else []
             for a in m:
                 a = a.split('=')
                 if a[0] == 'host': mongodb.host = a[-1]
@@ -47,22 +87,53 @@ class LogaggMasterCommand(BaseScript):
         except ValueError:
             raise InvalidArgument(self.args.mongodb)
 
+        workers = self.args.workers
+        leader_lock = None
+        if workers > 1:
+            # Before anything starts a thread or connects to mongodb, each worker makes its own.
+            # The parent stays behind to restart workers that die.
+            tornado.process.fork_processes(workers)
+            leader_lock = self.args.leader_lock or os.path.join(tempfile.gettempdir(),
+                                                    'logagg-master-{}.lock'.format(port))
+
         # Create LogaggService object
         ls = Master(host,
                 port,
                 mongodb,
                 auth,
-                self.log)
+                self.log,
+                heartbeat_batch_size=self.args.heartbeat_batch_size,
+                heartbeat_batch_interval=self.args.heartbeat_batch_interval,
+                component_flush_interval=self.args.component_flush_interval,
+                cluster_cache_ttl=self.args.cluster_cache_ttl,
+                component_suspect_after=self.args.component_suspect_after,
+                component_dead_after=self.args.component_dead_after,
+                outbound_connect_timeout=self.args.outbound_connect_timeout,
+                outbound_read_timeout=self.args.outbound_read_timeout,
+                collector_workers=self.args.collector_workers,
+                nsq_poll_interval=self.args.nsq_poll_interval,
+                nsq_api_health_check_interval=self.args.nsq_api_health_check_interval,
+                depth_throttle_at=self.args.depth_throttle_at,
+                depth_resume_at=self.args.depth_resume_at,
+                leader_lock=leader_lock,
+                sharded=self.args.sharded,
+                mongo_workers=self.args.mongo_workers,
+                mongo_timeout=self.args.mongo_timeout,
+                storage=self.args.storage,
+                sqlite_path=self.args.sqlite_path)
 
-        master_api = MasterService(ls, self.log)
-        api = API()
-        api.register(master_api, 'v1')
+        flush_policy = FlushPolicy(max_lines=self.args.tail_max_lines,
+                                    max_bytes=self.args.tail_max_bytes,
+                                    max_delay=self.args.tail_max_delay)
 
-        app = tornado.web.Application([
-            (r'^/logagg/.*', RequestHandler, dict(api=api)),
-                ])
+        app = make_app(ls, self.log, flush_policy,
+                        max_queue=self.args.tail_max_queue,
+                        drop_policy=self.args.tail_drop_policy,
+                        api_workers=self.args.api_workers)
 
-        app.listen(self.args.port)
+        # A socket of its own per worker, the kernel spreads connections between them
+        server = tornado.httpserver.HTTPServer(app)
+        server.add_sockets(tornado.netutil.bind_sockets(port, reuse_port=workers > 1))
         tornado.ioloop.IOLoop.current().start()
 
     def define_subcommands(self, subcommands):
@@ -86,8 +157,112 @@ class LogaggMasterCommand(BaseScript):
                 help= 'Service auth details to grant access to components, format: <key=xyz:secret=xxxx>')
 
         master_cmd.add_argument(
-                '--mongodb', '-d', required=True,
-                help= 'Database details, format: <host=localhost:port=27017:user=xyz:passwd=xxxx:db=name>')
+                '--storage', choices=STORAGES, default=MONGODB,
+                help='Where nsqs, clusters and components are kept, default: %(default)s')
+
+        master_cmd.add_argument(
+                '--mongodb', '-d',
+                help= 'Database details, needed with --storage mongodb, format: <host=localhost:port=27017:user=xyz:passwd=xxxx:db=name>')
+
+        master_cmd.add_argument(
+                '--sqlite-path', default=Master.SQLITE_PATH,
+                help='Database file of --storage sqlite, default: %(default)s')
+
+        master_cmd.add_argument(
+                '--workers', '-w', type=int, default=1,
+                help='Worker processes serving the port, one of them reads heartbeats, default: %(default)s')
+
+        master_cmd.add_argument(
+                '--leader-lock',
+                help='File the workers lock to choose the one reading heartbeats, default: logagg-master-<port>.lock in the temp directory')
+
+        master_cmd.add_argument(
+                '--sharded', action='store_true',
+                help='Split clusters with the other sharded masters using the same mongodb, default: %(default)s')
+
+        master_cmd.add_argument(
+                '--api-workers', type=int, default=API.THREADPOOL_SIZE,
+                help='Most API calls handled at once, each on a thread of its own, default: %(default)s')
+
+        master_cmd.add_argument(
+                '--mongo-workers', type=int, default=MongoExecutor.WORKERS,
+                help='Most mongodb operations of API calls and tails run at once, default: %(default)s')
+
+        master_cmd.add_argument(
+                '--mongo-timeout', type=float, default=MongoExecutor.TIMEOUT,
+                help='Seconds an API call or tail waits for a mongodb operation before failing, default: %(default)s')
+
+        master_cmd.add_argument(
+                '--tail-max-lines', type=int, default=FlushPolicy.MAX_LINES,
+                help='Most log lines sent to a tail client in one chunk, default: %(default)s')
+
+        master_cmd.add_argument(
+                '--tail-max-bytes', type=int, default=FlushPolicy.MAX_BYTES,
+                help='Most bytes sent to a tail client in one chunk, default: %(default)s')
+
+        master_cmd.add_argument(
+                '--tail-max-delay', type=float, default=FlushPolicy.MAX_DELAY,
+                help='Most seconds a log line waits before being sent to a tail client, default: %(default)s')
+
+        master_cmd.add_argument(
+                '--tail-max-queue', type=int, default=TailQueue.MAX_SIZE,
+                help='Most log lines queued for a slow tail client, default: %(default)s')
+
+        master_cmd.add_argument(
+                '--tail-drop-policy', choices=TailQueue.POLICIES, default=TailQueue.DROP_OLDEST,
+                help='What to do once a tail client\'s queue is full, default: %(default)s')
+
+        master_cmd.add_argument(
+                '--heartbeat-batch-size', type=int, default=HeartbeatWriter.BATCH_SIZE,
+                help='Most component updates written to mongodb in one bulk write, 1 writes each on its own, default: %(default)s')
+
+        master_cmd.add_argument(
+                '--heartbeat-batch-interval', type=float, default=HeartbeatWriter.BATCH_INTERVAL,
+                help='Seconds between logs of the component write rate, updates are written by every component flush, default: %(default)s')
+
+        master_cmd.add_argument(
+                '--component-flush-interval', type=float, default=ComponentRegistry.FLUSH_INTERVAL,
+                help='Seconds between writes of changed components to mongodb, default: %(default)s')
+
+        master_cmd.add_argument(
+                '--cluster-cache-ttl', type=float, default=ClusterCache.TTL,
+                help='Seconds cluster details are cached before being read from mongodb again, default: %(default)s')
+
+        master_cmd.add_argument(
+                '--component-suspect-after', type=float, default=ComponentRegistry.SUSPECT_AFTER,
+                help='Seconds without a heartbeat before a component is suspect, default: %(default)s')
+
+        master_cmd.add_argument(
+                '--component-dead-after', type=float, default=ComponentRegistry.DEAD_AFTER,
+                help='Seconds without a heartbeat before a component is dead and archived, default: %(default)s')
+
+        master_cmd.add_argument(
+                '--outbound-connect-timeout', type=float, default=OutboundClient.CONNECT_TIMEOUT,
+                help='Seconds to wait for a connection to a collector, default: %(default)s')
+
+        master_cmd.add_argument(
+                '--outbound-read-timeout', type=float, default=OutboundClient.READ_TIMEOUT,
+                help='Seconds to wait for a collector to respond, default: %(default)s')
+
+        master_cmd.add_argument(
+                '--collector-workers', type=int, default=Master.COLLECTOR_WORKERS,
+                help='Most collectors called at once by batch file operations, default: %(default)s')
+
+        master_cmd.add_argument(
+                '--nsq-poll-interval', type=float, default=NsqLoad.POLL_INTERVAL,
+                help='Seconds between polls of nsqd stats used to place clusters, default: %(default)s')
+
+        master_cmd.add_argument(
+                '--nsq-api-health-check-interval', type=float, default=NsqApiPool.HEALTH_CHECK_INTERVAL,
+                help='Seconds between health checks of nsq_apis, default: %(default)s')
+
+        master_cmd.add_argument(
+                '--depth-throttle-at', type=float, default=DepthMonitor.THROTTLE_AT,
+                help='Fraction of nsq_depth_limit at which collectors of a cluster are throttled, default: %(default)s')
+
+        master_cmd.add_argument(
+                '--depth-resume-at', type=float, default=DepthMonitor.RESUME_AT,
+                help='Fraction of nsq_depth_limit under which throttled collectors go back to normal, default: %(default)s')
 
 def main():
     LogaggMasterCommand().start()
@@ -0,0 +1,128 @@
+import time
+import bisect
+import hashlib
+import datetime
+import threading
+
+from deeputil import keeprunning
+from logagg_utils import log_exception, start_daemon_thread
+
+class ClusterRing():
+    '''
+    Consistent hash ring of masters, a cluster belongs to the first
+    master found going clockwise from its name. Every master is put on
+    the ring many times over so clusters spread evenly, and a master
+    joining or leaving only moves the clusters next to it.
+
+    >>> ring = ClusterRing(['a:1088', 'b:1088', 'c:1088'])
+    >>> owners = [ring.owner('cluster{}'.format(i)) for i in range(3000)]
+    >>> sorted(set(owners))
+    ['a:1088', 'b:1088', 'c:1088']
+    >>> min(owners.count(m) for m in ring.members) > 800
+    True
+    >>> smaller = ClusterRing(['a:1088', 'b:1088'])
+    >>> moved = [o for i, o in enumerate(owners) if smaller.owner('cluster{}'.format(i)) != o]
+    >>> set(moved)
+    {'c:1088'}
+    >>> ClusterRing([]).owner('logagg') is None
+    True
+    '''
+    REPLICAS = 100
+
+    def __init__(self, members, replicas=REPLICAS):
+
+        self.members = sorted(set(members))
+        points = sorted((self._hash('{}#{}'.format(m, i)), m)
+                        for m in self.members for i in range(replicas))
+        self.hashes = [h for h, _ in points]
+        self.owners = [m for _, m in points]
+
+
+    @staticmethod
+    def _hash(key):
+        return int(hashlib.md5(key.encode('utf-8')).hexdigest()[:16], 16)
+
+
+    def owner(self, cluster_name):
+        if not self.owners: return None
+        i = bisect.bisect(self.hashes, self._hash(cluster_name)) % len(self.hashes)
+        return self.owners[i]
+
+
+class MasterMembership():
+    '''
+    Masters sharing one mongodb split the clusters between them. Each
+    master holds a lease in the masters collection that it renews every
+    renew_interval seconds, masters whose lease ran out for lease_ttl
+    seconds are gone. Clusters are owned by masters through a ClusterRing
+    of the masters holding a lease, on_change is called whenever it
+    changes.
+    '''
+    LEASE_TTL = 30 # seconds
+    RENEW_INTERVAL = 10 # seconds
+
+    def __init__(self, collection, host, port, log, on_change=None,
+                lease_ttl=LEASE_TTL,
+                renew_interval=RENEW_INTERVAL):
+
+        self.collection = collection
+        self.host = host
+        self.port = port
+        self.log = log
+        self.lease_ttl = lease_ttl
+        self.renew_interval = renew_interval
+
+        self.id = '{}:{}'.format(host, port)
+        self.lock = threading.Lock()
+        # {id: {'host', 'port'}} of the masters holding a lease
+        self.masters = dict()
+        self.ring = ClusterRing([self.id])
+
+        # Join right away, so clusters are not all claimed as ours until then
+        self.on_change = None
+        self.renew()
+        self.on_change = on_change
+        self.renew_thread = start_daemon_thread(self._renew_periodically)
+
+
+    def renew(self):
+        now = datetime.datetime.utcnow()
+        self.collection.update_one({'_id': self.id},
+            {'$set': {'host': self.host,
+                      'port': self.port,
+                      'expires_at': now + datetime.timedelta(seconds=self.lease_ttl)},
+             '$setOnInsert': {'joined_at': now}},
+            upsert=True)
+
+        masters = {m['_id']: {'host': m['host'], 'port': m['port']}
+                    for m in self.collection.find({'expires_at': {'$gt': now}})}
+
+        with self.lock:
+            if set(masters) == set(self.masters): return
+            joined = sorted(set(masters) - set(self.masters))
+            left = sorted(set(self.masters) - set(masters))
+            self.masters = masters
+            self.ring = ClusterRing(masters)
+
+        self.log.info('masters_changed', joined=joined, left=left, num_masters=len(masters))
+        if self.on_change: self.on_change()
+
+
+    @keeprunning(on_error=log_exception)
+    def _renew_periodically(self):
+        time.sleep(self.renew_interval)
+        self.renew()
+
+
+    def owner(self, cluster_name):
+        '''
+        Details of the master that owns a cluster, None if it is this one
+        '''
+        with self.lock:
+            owner = self.ring.owner(cluster_name)
+            if owner == self.id: return None
+            return dict(self.masters[owner])
+
+
+    def owns(self, cluster_name):
+        return self.owner(cluster_name) is None
@@ -0,0 +1,220 @@
+import bisect
+import threading
+from collections import defaultdict, OrderedDict
+
+import tornado.web
+import tornado.ioloop
+from tornado import gen
+from tornado.log import access_log
+from pymongo import monitoring
+
+class Metrics():
+    '''
+    Counters, gauges and histograms of the master kept in memory and
+    rendered in the Prometheus text exposition format. Recording costs
+    a dict update under one lock, so it is left on all the time.
+    Values only known at scrape time come from collectors, callables
+    returning (name, labels, value) tuples of gauges.
+
+    >>> m = Metrics()
+    >>> m.describe('requests_total', 'counter', 'Requests')
+    >>> m.inc('requests_total', method='ping')
+    >>> m.describe('latency_seconds', 'histogram', 'Latency', buckets=(0.1, 1))
+    >>> m.observe('latency_seconds', 0.5)
+    >>> print(m.render())
+    # HELP requests_total Requests
+    # TYPE requests_total counter
+    requests_total{method="ping"} 1
+    # HELP latency_seconds Latency
+    # TYPE latency_seconds histogram
+    latency_seconds_bucket{le="0.1"} 0
+    latency_seconds_bucket{le="1"} 1
+    latency_seconds_bucket{le="+Inf"} 1
+    latency_seconds_sum 0.5
+    latency_seconds_count 1
+    <BLANKLINE>
+    '''
+    LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10) # seconds
+
+    def __init__(self):
+
+        self.lock = threading.Lock()
+        # {name: (type, help, buckets)}, in the order they are rendered
+        self.descriptions = OrderedDict()
+        # {name: {labels: value}}, labels being a tuple of (key, value)
+        self.values = defaultdict(dict)
+        self.collectors = list()
+
+
+    def describe(self, name, type, help, buckets=LATENCY_BUCKETS):
+        self.descriptions[name] = (type, help, buckets)
+
+
+    @staticmethod
+    def _labels(labels):
+        return tuple(sorted(labels.items()))
+
+
+    def inc(self, name, value=1, **labels):
+        labels = self._labels(labels)
+        with self.lock:
+            values = self.values[name]
+            values[labels] = values.get(labels, 0) + value
+
+
+    def set(self, name, value, **labels):
+        labels = self._labels(labels)
+        with self.lock: self.values[name][labels] = value
+
+
+    def observe(self, name, value, **labels):
+        '''
+        Count value in the buckets of the histogram name
+        '''
+        buckets = self.descriptions[name][2]
+        labels = self._labels(labels)
+        with self.lock:
+            values = self.values[name]
+            h = values.get(labels)
+            # [count per bucket, then +Inf], sum, count
+            if h is None: h = values[labels] = [[0] * (len(buckets) + 1), 0.0, 0]
+            h[0][bisect.bisect_left(buckets, value)] += 1
+            h[1] += value
+            h[2] += 1
+
+
+    def add_collector(self, collector):
+        self.collectors.append(collector)
+
+
+    @staticmethod
+    def _format_labels(labels):
+        if not labels: return ''
+
+        def escape(v):
+            return str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+        return '{' + ','.join('{}="{}"'.format(k, escape(v)) for k, v in labels) + '}'
+
+
+    @staticmethod
+    def _format_value(value):
+        if isinstance(value, float) and value.is_integer(): return str(int(value))
+        return repr(value) if isinstance(value, float) else str(value)
+
+
+    def render(self):
+        with self.lock:
+            # Histograms are copied too, they keep changing while being rendered
+            values = {name: {l: [list(v[0]), v[1], v[2]] if isinstance(v, list) else v for l, v in vs.items()}
+                        for name, vs in self.values.items()}
+
+        for collector in self.collectors:
+            for name, labels, value in collector():
+                values.setdefault(name, dict())[self._labels(labels)] = value
+
+        lines = list()
+        for name, (type, help, buckets) in self.descriptions.items():
+            lines.append('# HELP {} {}'.format(name, help))
+            lines.append('# TYPE {} {}'.format(name, type))
+
+            for labels, value in sorted(values.get(name, {}).items()):
+                if type != 'histogram':
+                    lines.append('{}{} {}'.format(name, self._format_labels(labels), self._format_value(value)))
+                    continue
+
+                counts, total, count = value
+                cumulative = 0
+                for le, n in zip(list(buckets) + ['+Inf'], counts):
+                    cumulative += n
+                    lines.append('{}_bucket{} {}'.format(name,
+                                self._format_labels(labels + (('le', self._format_value(le)),)), cumulative))
+                lines.append('{}_sum{} {}'.format(name, self._format_labels(labels), self._format_value(total)))
+                lines.append('{}_count{} {}'.format(name, self._format_labels(labels), count))
+
+        return '\n'.join(lines) + '\n'
+
+
+class MongoCommandMetrics(monitoring.CommandListener):
+    '''
+    Latency of every command the master sends to mongodb
+    '''
+
+    def __init__(self, metrics):
+        self.metrics = metrics
+        metrics.describe('logagg_master_mongodb_command_duration_seconds', 'histogram',
+                        'Latency of mongodb commands')
+        metrics.describe('logagg_master_mongodb_command_failures_total', 'counter',
+                        'Failed mongodb commands')
+
+
+    def started(self, event):
+        pass
+
+
+    def succeeded(self, event):
+        self.metrics.observe('logagg_master_mongodb_command_duration_seconds',
+                            event.duration_micros / 1e6, command=event.command_name)
+
+
+    def failed(self, event):
+        self.metrics.observe('logagg_master_mongodb_command_duration_seconds',
+                            event.duration_micros / 1e6, command=event.command_name)
+        self.metrics.inc('logagg_master_mongodb_command_failures_total', command=event.command_name)
+
+
+def request_logger(metrics, methods):
+    '''
+    A tornado log_function counting requests and their latency per API
+    method, any other path is counted as "other". Requests are still
+    written to the access log like tornado does by default.
+    '''
+    metrics.describe('logagg_master_requests_total', 'counter', 'Requests per API method and status')
+    metrics.describe('logagg_master_request_duration_seconds', 'histogram',
+                    'Latency of requests per API method, tail_logs lasting as long as the tail')
+
+    def log_request(handler):
+        status = handler.get_status()
+        request_time = handler.request.request_time()
+        method = handler.request.path.rstrip('/').rsplit('/', 1)[-1]
+        if method not in methods: method = 'other'
+
+        metrics.inc('logagg_master_requests_total', method=method, code=status)
+        metrics.observe('logagg_master_request_duration_seconds', request_time, method=method)
+
+        if status < 400: log = access_log.info
+        elif status < 500: log = access_log.warning
+        else: log = access_log.error
+        log('%d %s %.2fms', status, handler._request_summary(), 1000.0 * request_time)
+
+    return log_request
+
+
+async def watch_ioloop(metrics, interval=1):
+    '''
+    How late the IOLoop runs callbacks, anything above a few
+    milliseconds means something is blocking it
+    '''
+    metrics.describe('logagg_master_ioloop_lag_seconds', 'gauge', 'How late the IOLoop ran the last timer')
+    ioloop = tornado.ioloop.IOLoop.current()
+
+    while True:
+        start = ioloop.time()
+        await gen.sleep(interval)
+        metrics.set('logagg_master_ioloop_lag_seconds', max(0, ioloop.time() - start - interval))
+
+
+class MetricsHandler(tornado.web.RequestHandler):
+    '''
+    Metrics of the master for Prometheus to scrape
+    Sample url:
+    'http://localhost:1088/logagg/v1/metrics'
+    '''
+
+    def initialize(self, master):
+        self.master = master
+
+
+    def get(self):
+        self.set_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.write(self.master.metrics.render())
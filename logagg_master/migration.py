@@ -0,0 +1,115 @@
+import time
+
+import tornado.ioloop
+from deeputil import keeprunning
+from logagg_utils import log_exception, start_daemon_thread
+
+from .clusters import cluster_version
+
+class ClusterMigrator():
+    '''
+    Moves clusters between nsqds while they are in use. The cluster is
+    pointed at the new nsqd and its collectors are told to switch, while
+    the old nsqd stays in the cluster's "draining" list and keeps being
+    read by tails and the heartbeat reader until its logs topic is empty.
+    '''
+    COLLECTOR_SWITCH_NSQ_URL = 'http://{collector_address}/collector/v1/switch_nsq?nsqd_http_address="{nsqd_http_address}"&logs_topic="{logs_topic}"&heartbeat_topic="{heartbeat_topic}"'
+    DRAIN_CHECK_INTERVAL = 10 # seconds
+
+    def __init__(self, master, log, drain_check_interval=DRAIN_CHECK_INTERVAL):
+
+        self.master = master
+        self.log = log
+        # migrate runs on API requests, which only reach mongodb through the master's MongoExecutor
+        self.cluster_collection = master.mongo.wrap(master.cluster_collection)
+        self.drain_check_interval = drain_check_interval
+        self.ioloop = tornado.ioloop.IOLoop.current()
+        # Only one worker process of a master checks
+        self.leader = True
+
+        self.drain_check_thread = start_daemon_thread(self._check_drained_periodically)
+
+
+    def _cluster_changed(self, cluster):
+        self.master.clusters.invalidate(cluster['cluster_name'])
+        self.ioloop.add_callback(self.master.tail_multiplexer.update, cluster)
+        self.master.heartbeat_reader.update(cluster)
+
+
+    def migrate(self, cluster_name, nsq):
+        '''
+        Move a cluster to nsq, returns the moved cluster with how many of
+        its collectors were told, or None if the cluster was not found,
+        is already on nsq or was moved by someone else meanwhile
+        '''
+        cluster = self.cluster_collection.find_one({'cluster_name': cluster_name}, {'_id': 0})
+        if not cluster or cluster['nsqd_tcp_address'] == nsq['nsqd_tcp_address']: return None
+
+        old = {k: cluster[k] for k in ('nsqd_tcp_address', 'nsqd_http_address', 'nsq_api_address',
+                                        'logs_topic', 'heartbeat_topic')}
+        old['since'] = time.time()
+        # Moving back to an nsqd that is still draining makes it current again
+        draining = [d for d in cluster.get('draining') or []
+                        if d['nsqd_tcp_address'] != nsq['nsqd_tcp_address']] + [old]
+
+        changes = {'nsqd_tcp_address': nsq['nsqd_tcp_address'],
+                    'nsqd_http_address': nsq['nsqd_http_address'],
+                    'nsq_api_address': nsq['nsq_api_address'],
+                    'draining': draining}
+        result = self.cluster_collection.update_one({'cluster_name': cluster_name,
+                                                     'nsqd_tcp_address': cluster['nsqd_tcp_address']},
+                                                     {'$set': changes, '$inc': {'version': 1}})
+        if not result.modified_count: return None
+
+        cluster.update(changes, version=cluster_version(cluster) + 1)
+        self.master.nsq_load.assigned(nsq['nsqd_tcp_address'])
+        self._cluster_changed(cluster)
+
+        url_for = lambda collector_address: self.COLLECTOR_SWITCH_NSQ_URL.format(collector_address=collector_address,
+                                                                                nsqd_http_address=cluster['nsqd_http_address'],
+                                                                                logs_topic=cluster['logs_topic'],
+                                                                                heartbeat_topic=cluster['heartbeat_topic'])
+        told, num_collectors = self.master.tell_collectors(cluster_name, url_for)
+        self.log.info('cluster_migrated',
+                    cluster=cluster_name,
+                    from_nsqd=old['nsqd_tcp_address'],
+                    to_nsqd=nsq['nsqd_tcp_address'],
+                    collectors_told=told,
+                    num_collectors=num_collectors)
+
+        return dict(cluster, collectors_told=told, num_collectors=num_collectors)
+
+
+    def _is_drained(self, draining):
+        load = self.master.nsq_load.get(draining['nsqd_tcp_address'])
+        # Only trust stats taken after the collectors were told to switch
+        if not load['reachable'] or load['polled_at'] <= draining['since']: return False
+
+        topic = load['topics'].get(draining['logs_topic'])
+        return not topic or topic['depth'] == 0
+
+
+    def check_drained(self):
+        if not self.leader: return
+
+        for cluster in self.cluster_collection.find({'draining.0': {'$exists': True}}, {'_id': 0}):
+            if not self.master.owns(cluster['cluster_name']): continue
+            for draining in cluster['draining']:
+                if not self._is_drained(draining): continue
+
+                self.cluster_collection.update_one({'cluster_name': cluster['cluster_name']},
+                    {'$pull': {'draining': {'nsqd_tcp_address': draining['nsqd_tcp_address']}},
+                     '$inc': {'version': 1}})
+                self.log.info('cluster_drained',
+                            cluster=cluster['cluster_name'],
+                            nsqd_tcp_address=draining['nsqd_tcp_address'],
+                            seconds=time.time() - draining['since'])
+
+                self._cluster_changed(self.cluster_collection.find_one(
+                    {'cluster_name': cluster['cluster_name']}, {'_id': 0}))
+
+
+    @keeprunning(on_error=log_exception)
+    def _check_drained_periodically(self):
+        time.sleep(self.drain_check_interval)
+        self.check_drained()
@@ -0,0 +1,109 @@
+import time
+import datetime
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
+
+from tornado import gen
+from pymongo.cursor import Cursor
+from pymongo.command_cursor import CommandCursor
+
+from .exceptions import MongoTimeout
+
+class MongoExecutor():
+    '''
+    Runs mongodb operations on a bounded pool of threads and waits at
+    most timeout seconds for each. A slow or failing over mongodb then
+    fails requests quickly instead of holding on to every API thread,
+    and the IOLoop awaits operations instead of waiting on them.
+    Operations are timed separately for how long they waited for a
+    thread and how long they ran, a long wait means the pool is too
+    small or mongodb too slow for the load.
+    '''
+    WORKERS = 16
+    TIMEOUT = 5 # seconds
+
+    def __init__(self, metrics, workers=WORKERS, timeout=TIMEOUT):
+
+        self.metrics = metrics
+        self.timeout = timeout
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+
+        metrics.describe('logagg_master_mongodb_queue_wait_seconds', 'histogram',
+                        'Time mongodb operations waited for a thread')
+        metrics.describe('logagg_master_mongodb_operation_duration_seconds', 'histogram',
+                        'Time mongodb operations ran, cursors read to the end')
+        metrics.describe('logagg_master_mongodb_operation_timeouts_total', 'counter',
+                        'Mongodb operations given up on, still queued or already running')
+
+
+    def submit(self, op, fn, *args, **kwargs):
+        queued_at = time.time()
+
+        def run():
+            started_at = time.time()
+            self.metrics.observe('logagg_master_mongodb_queue_wait_seconds', started_at - queued_at, op=op)
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                self.metrics.observe('logagg_master_mongodb_operation_duration_seconds',
+                                    time.time() - started_at, op=op)
+
+        return self.executor.submit(run)
+
+
+    def _timed_out(self, op, future):
+        # One still queued never runs, one running is left to finish
+        stage = 'queued' if future.cancel() else 'running'
+        self.metrics.inc('logagg_master_mongodb_operation_timeouts_total', op=op, stage=stage)
+        return MongoTimeout(op)
+
+
+    def call(self, op, fn, *args, **kwargs):
+        '''
+        Run fn on the pool and wait for it, for threads other than the IOLoop's
+        '''
+        future = self.submit(op, fn, *args, **kwargs)
+        try:
+            return future.result(self.timeout)
+        except TimeoutError:
+            raise self._timed_out(op, future)
+
+
+    async def run(self, op, fn, *args, **kwargs):
+        '''
+        Run fn on the pool, for coroutines on the IOLoop
+        '''
+        future = self.submit(op, fn, *args, **kwargs)
+        try:
+            return await gen.with_timeout(datetime.timedelta(seconds=self.timeout), future)
+        except gen.TimeoutError:
+            raise self._timed_out(op, future)
+
+
+    def wrap(self, collection):
+        return TimedCollection(collection, self)
+
+
+class TimedCollection():
+    '''
+    A collection whose operations run on a MongoExecutor, named
+    <collection>.<method> in its metrics. Cursors are read to the end
+    on the pool and come back as lists.
+    '''
+
+    def __init__(self, collection, executor):
+        self.collection = collection
+        self.executor = executor
+
+
+    def __getattr__(self, name):
+        fn = getattr(self.collection, name)
+        op = '{}.{}'.format(self.collection.name, name)
+
+        def run(*args, **kwargs):
+            result = fn(*args, **kwargs)
+            return list(result) if isinstance(result, (Cursor, CommandCursor)) else result
+
+        def call(*args, **kwargs):
+            return self.executor.call(op, run, *args, **kwargs)
+
+        return call
@@ -0,0 +1,364 @@
+import time
+import threading
+from collections import Counter
+
+import ujson as json
+import requests
+from deeputil import keeprunning
+from logagg_utils import log_exception, start_daemon_thread
+
+from .clusters import nsq_shards
+
+def parse_nsqd_stats(stats):
+    '''
+    Depth and message count of every topic in the response of nsqd's
+    /stats?format=json, older nsqds wrap it in "data"
+
+    >>> stats = {'topics': [{'topic_name': 'a_logs', 'depth': 5, 'message_count': 100,
+    ...                      'channels': [{'depth': 10}, {'depth': 1}]}]}
+    >>> parse_nsqd_stats(stats)
+    {'a_logs': {'depth': 16, 'message_count': 100}}
+    >>> parse_nsqd_stats({'status_code': 200, 'data': stats}) == parse_nsqd_stats(stats)
+    True
+    '''
+    if 'data' in stats: stats = stats['data']
+
+    topics = dict()
+    for t in stats.get('topics') or []:
+        depth = t.get('depth', 0) + sum(c.get('depth', 0) for c in t.get('channels') or [])
+        topics[t['topic_name']] = {'depth': depth, 'message_count': t.get('message_count', 0)}
+
+    return topics
+
+
+class NsqLoad():
+    '''
+    Load of every nsqd, polled from its /stats in the background so that
+    placing a cluster never waits on an nsqd
+    '''
+    STATS_URL = 'http://{nsqd_http_address}/stats?format=json'
+    POLL_INTERVAL = 10 # seconds
+
+    def __init__(self, nsq_collection, cluster_collection, outbound, log, poll_interval=POLL_INTERVAL):
+
+        self.nsq_collection = nsq_collection
+        self.cluster_collection = cluster_collection
+        self.outbound = outbound
+        self.log = log
+        self.poll_interval = poll_interval
+
+        self.lock = threading.Lock()
+        # {nsqd_tcp_address: {'reachable', 'depth', 'message_rate', 'topics', ...}}
+        self.loads = dict()
+        # {nsqd_tcp_address: number of clusters on it}
+        self.num_clusters = Counter()
+
+        self.poll_thread = start_daemon_thread(self._poll_periodically)
+
+
+    def _poll_nsqd(self, nsq, now):
+        address = nsq['nsqd_tcp_address']
+        previous = self.loads.get(address, {})
+
+        try:
+            stats = self.outbound.get(self.STATS_URL.format(nsqd_http_address=nsq['nsqd_http_address']))
+            topics = parse_nsqd_stats(json.loads(stats.content.decode('utf-8')))
+        except (requests.exceptions.RequestException, ValueError, KeyError):
+            self.log.warn('cannot_poll_nsqd_stats', nsqd_http_address=nsq['nsqd_http_address'])
+            return dict(previous, reachable=False)
+
+        message_count = sum(t['message_count'] for t in topics.values())
+        message_rate = 0.0
+        if previous.get('polled_at'):
+            # nsqd restarts reset message_count
+            message_rate = max(0, message_count - previous['message_count']) / (now - previous['polled_at'])
+
+        return {'reachable': True,
+                'polled_at': now,
+                'depth': sum(t['depth'] for t in topics.values()),
+                'message_count': message_count,
+                'message_rate': message_rate,
+                'topics': topics}
+
+
+    def poll(self):
+        now = time.time()
+        loads = {n['nsqd_tcp_address']: self._poll_nsqd(n, now) for n in self.nsq_collection.find()}
+
+        num_clusters = Counter()
+        # Every shard of a cluster counts against its nsqd
+        for c in self.cluster_collection.find({}, {'_id': 0, 'nsqd_tcp_address': 1, 'shards.nsqd_tcp_address': 1}):
+            for shard in c.get('shards') or [c]:
+                num_clusters[shard['nsqd_tcp_address']] += 1
+
+        with self.lock:
+            self.loads = loads
+            self.num_clusters = num_clusters
+
+
+    @keeprunning(on_error=log_exception)
+    def _poll_periodically(self):
+        self.poll()
+        time.sleep(self.poll_interval)
+
+
+    def get(self, nsqd_tcp_address):
+        '''
+        Load of an nsqd with the number of clusters on it
+        '''
+        with self.lock:
+            load = self.loads.get(nsqd_tcp_address, {'reachable': None})
+            return dict(load, num_clusters=self.num_clusters[nsqd_tcp_address])
+
+
+    def rank(self, nsqs):
+        '''
+        nsqs from the least to the most loaded, scoring message rate, depth
+        and number of clusters each relative to the busiest nsqd.
+        Unreachable nsqds come last.
+        '''
+        loads = [self.get(n['nsqd_tcp_address']) for n in nsqs]
+        reachable = [l for l in loads if l['reachable'] is not False] or loads
+
+        peak = dict()
+        for metric in ('message_rate', 'depth', 'num_clusters'):
+            peak[metric] = max([l.get(metric, 0) for l in reachable] or [0]) or 1
+
+        def score(candidate):
+            _, load = candidate
+            return (load['reachable'] is False, sum(load.get(m, 0) / float(peak[m]) for m in peak))
+
+        return [n for n, _ in sorted(zip(nsqs, loads), key=score)]
+
+
+    def pick(self, nsqs):
+        '''
+        The least loaded of nsqs, unreachable nsqds are only picked if no
+        other is left
+        '''
+        ranked = self.rank(nsqs)
+        return ranked[0] if ranked else None
+
+
+    def assigned(self, nsqd_tcp_address):
+        '''
+        Count a cluster just placed on an nsqd until the next poll sees it
+        '''
+        with self.lock:
+            self.num_clusters[nsqd_tcp_address] += 1
+
+
+class NsqApiPool():
+    '''
+    Health of every registered nsq_api and the number of streams the
+    master has open through each, so every stream can be opened through
+    the least loaded healthy one
+    '''
+    HEALTH_CHECK_URL = 'http://{nsq_api_address}/'
+    HEALTH_CHECK_INTERVAL = 5 # seconds
+    HEALTH_CHECK_TIMEOUT = 2 # seconds
+
+    def __init__(self, nsq_api_collection, outbound, log, health_check_interval=HEALTH_CHECK_INTERVAL):
+
+        self.nsq_api_collection = nsq_api_collection
+        self.outbound = outbound
+        self.log = log
+        self.health_check_interval = health_check_interval
+
+        self.lock = threading.Lock()
+        # {nsq_api_address: True, False or None when not checked yet}
+        self.healthy = dict()
+        # {nsq_api_address: number of open streams}
+        self.streams = Counter()
+
+        self.health_check_thread = start_daemon_thread(self._check_periodically)
+
+
+    def _is_healthy(self, address):
+        try:
+            # Any response at all means nsq_api is up
+            self.outbound.get(self.HEALTH_CHECK_URL.format(nsq_api_address=address),
+                            timeout=self.HEALTH_CHECK_TIMEOUT)
+            return True
+        except requests.exceptions.RequestException:
+            return False
+
+
+    def check(self):
+        addresses = [n['host'] + ':' + str(n['port']) for n in self.nsq_api_collection.find()]
+        healthy = {a: self._is_healthy(a) for a in addresses}
+
+        with self.lock:
+            for address, is_healthy in healthy.items():
+                if self.healthy.get(address) is not False and not is_healthy:
+                    self.log.warn('nsq_api_unhealthy', nsq_api_address=address)
+                elif self.healthy.get(address) is False and is_healthy:
+                    self.log.info('nsq_api_healthy_again', nsq_api_address=address)
+            self.healthy = healthy
+
+
+    @keeprunning(on_error=log_exception)
+    def _check_periodically(self):
+        self.check()
+        time.sleep(self.health_check_interval)
+
+
+    def add(self, address):
+        '''
+        Put a newly registered nsq_api in rotation before its first health check
+        '''
+        with self.lock: self.healthy.setdefault(address, None)
+
+
+    def pick(self, default=None):
+        '''
+        The healthy nsq_api with the fewest open streams, default if none is healthy
+        '''
+        with self.lock:
+            candidates = [a for a, h in self.healthy.items() if h is not False]
+            if not candidates: return default
+            return min(candidates, key=lambda a: self.streams[a])
+
+
+    def acquire(self, default):
+        '''
+        Pick an nsq_api for a new stream and count the stream against it
+        '''
+        address = self.pick(default)
+        with self.lock: self.streams[address] += 1
+        return address
+
+
+    def release(self, address):
+        with self.lock:
+            self.streams[address] -= 1
+            if self.streams[address] <= 0: del self.streams[address]
+
+
+    def failed(self, address):
+        '''
+        Take an nsq_api out of rotation until its next good health check.
+        Returns whether another healthy nsq_api is left to fail over to.
+        '''
+        with self.lock:
+            if self.healthy.get(address) is not False:
+                self.log.warn('nsq_api_failed', nsq_api_address=address)
+            self.healthy[address] = False
+            return any(h is not False for h in self.healthy.values())
+
+
+    def stats(self):
+        with self.lock:
+            return [{'nsq_api_address': a, 'healthy': h, 'streams': self.streams[a]}
+                    for a, h in self.healthy.items()]
+
+
+class DepthMonitor():
+    '''
+    Compares the depth of every cluster's logs topic with its
+    nsq_depth_limit and tells the cluster's collectors to slow down:
+    throttle from throttle_at of the limit, pause at the limit and back
+    to normal once the depth falls under resume_at of the limit.
+    Collectors are told through tell_collectors, see Master.tell_collectors,
+    when the state of their cluster changes. Until it changes again, those
+    that joined since or did not answer are told on the following checks.
+    '''
+    COLLECTOR_THROTTLE_URL = 'http://{collector_address}/collector/v1/throttle?state="{state}"'
+    INTERVAL = 10 # seconds
+    THROTTLE_AT = 0.8
+    RESUME_AT = 0.5
+
+    NORMAL = 'normal'
+    THROTTLE = 'throttle'
+    PAUSE = 'pause'
+
+    def __init__(self, cluster_collection, nsq_load, tell_collectors, log,
+                interval=INTERVAL, throttle_at=THROTTLE_AT, resume_at=RESUME_AT, owns=None):
+
+        self.cluster_collection = cluster_collection
+        self.nsq_load = nsq_load
+        self.tell_collectors = tell_collectors
+        self.log = log
+        self.interval = interval
+        self.throttle_at = throttle_at
+        self.resume_at = resume_at
+
+        # {cluster_name: {'state', 'depth', 'nsq_depth_limit', 'changed_at'}}
+        self.states = dict()
+        # {cluster_name: <host>:<port> of the collectors told its current state}
+        self.told = dict()
+        # Only one worker process of a master tells collectors
+        self.leader = True
+        self.owns = owns
+
+        self.monitor_thread = start_daemon_thread(self._monitor_periodically)
+
+
+    def next_state(self, state, depth, limit):
+        '''
+        >>> m = DepthMonitor.__new__(DepthMonitor)
+        >>> m.throttle_at, m.resume_at = 0.8, 0.5
+        >>> [m.next_state('normal', d, 100) for d in (10, 80, 100)]
+        ['normal', 'throttle', 'pause']
+        >>> [m.next_state('pause', d, 100) for d in (99, 60, 40)]
+        ['throttle', 'throttle', 'normal']
+        '''
+        if depth >= limit: return self.PAUSE
+        if depth >= self.throttle_at * limit: return self.THROTTLE
+        if state != self.NORMAL and depth >= self.resume_at * limit: return self.THROTTLE
+        return self.NORMAL
+
+
+    def check(self):
+        for cluster in self.cluster_collection.find({}, {'_id': 0, 'cluster_passwd': 0}):
+            cluster_name = cluster['cluster_name']
+            topics = [self.nsq_load.get(s['nsqd_tcp_address']).get('topics', {}).get(s['logs_topic'])
+                        for s in nsq_shards(cluster)]
+            # nsqd not polled yet or topic not created yet
+            topics = [t for t in topics if t]
+            if not topics: continue
+            # The collectors of a cluster are slowed down together, by its deepest shard
+            topic = max(topics, key=lambda t: t['depth'])
+
+            previous = self.states.get(cluster_name, {'state': self.NORMAL})
+            limit = cluster['nsq_depth_limit']
+            state = self.next_state(previous['state'], topic['depth'], limit)
+
+            self.states[cluster_name] = {'state': state,
+                                        'depth': topic['depth'],
+                                        'nsq_depth_limit': limit,
+                                        'changed_at': previous.get('changed_at') if state == previous['state'] else time.time()}
+
+            changed = state != previous['state']
+            if not changed and state == self.NORMAL: continue
+            # Other worker processes and masters keep track of the state, only the owner's leader tells collectors
+            if not self.leader or (self.owns and not self.owns(cluster_name)): continue
+
+            # Slowed down clusters are checked again every time, for collectors that joined since
+            if changed: self.told[cluster_name] = set()
+            url_for = lambda collector_address: self.COLLECTOR_THROTTLE_URL.format(collector_address=collector_address,
+                                                                                state=state)
+            told, num_collectors = self.tell_collectors(cluster_name, url_for, self.told.setdefault(cluster_name, set()))
+            if state == self.NORMAL: self.told.pop(cluster_name, None)
+            if changed:
+                self.log.warn('cluster_backpressure_changed',
+                            cluster=cluster_name,
+                            state=state,
+                            previous_state=previous['state'],
+                            depth=topic['depth'],
+                            nsq_depth_limit=limit,
+                            collectors_told=told,
+                            num_collectors=num_collectors)
+
+
+    @keeprunning(on_error=log_exception)
+    def _monitor_periodically(self):
+        time.sleep(self.interval)
+        self.check()
+
+
+    def get(self, cluster_name):
+        '''
+        Backpressure state of a cluster
+        '''
+        return self.states.get(cluster_name, {'state': self.NORMAL})
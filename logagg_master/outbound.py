@@ -0,0 +1,159 @@
+import time
+import threading
+from collections import defaultdict
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import MaxRetryError, NewConnectionError
+
+class OutboundClient():
+    '''
+    Shared HTTP client for calls the master makes to other components.
+    Connections are kept alive in a pool per host and every request has
+    a connect and a read timeout. Requests that failed to connect are
+    retried while the retry budget allows: at most retry_ratio of the
+    requests in the last BUDGET_WINDOW seconds, plus MIN_RETRIES. Ones
+    that may have reached the target are not, calls to collectors are
+    not idempotent.
+    '''
+    POOL_CONNECTIONS = 100 # hosts with a pool of their own
+    POOL_MAXSIZE = 10 # connections kept alive per host
+    CONNECT_TIMEOUT = 3 # seconds
+    READ_TIMEOUT = 10 # seconds
+    RETRIES = 2
+    RETRY_RATIO = 0.1
+    MIN_RETRIES = 10
+    BUDGET_WINDOW = 60 # seconds
+
+    def __init__(self,
+                pool_connections=POOL_CONNECTIONS,
+                pool_maxsize=POOL_MAXSIZE,
+                connect_timeout=CONNECT_TIMEOUT,
+                read_timeout=READ_TIMEOUT,
+                retries=RETRIES,
+                retry_ratio=RETRY_RATIO,
+                metrics=None):
+
+        self.timeout = (connect_timeout, read_timeout)
+        self.retries = retries
+        self.retry_ratio = retry_ratio
+        self.metrics = metrics
+        if metrics:
+            metrics.describe('logagg_master_outbound_request_duration_seconds', 'histogram',
+                            'Latency of calls the master makes to collectors and nsqds')
+            metrics.describe('logagg_master_outbound_errors_total', 'counter',
+                            'Calls to collectors and nsqds that failed')
+
+        self.adapter = HTTPAdapter(pool_connections=pool_connections,
+                                    pool_maxsize=pool_maxsize,
+                                    pool_block=False)
+        self.session = requests.Session()
+        self.session.mount('http://', self.adapter)
+        self.session.mount('https://', self.adapter)
+
+        self.lock = threading.Lock()
+        self.num_requests = 0
+        self.num_retries = 0
+        self.num_budget_exhausted = 0
+        self.budget_started_at = time.time()
+        self.budget_requests = 0
+        self.budget_retries = 0
+        # {host:port: [requests, errors, total latency, max latency]}
+        self.targets = defaultdict(lambda: [0, 0, 0.0, 0.0])
+
+
+    def _take_retry(self):
+        with self.lock:
+            now = time.time()
+            if now - self.budget_started_at > self.BUDGET_WINDOW:
+                self.budget_started_at = now
+                self.budget_requests = self.budget_retries = 0
+
+            if self.budget_retries >= self.MIN_RETRIES + self.retry_ratio * self.budget_requests:
+                self.num_budget_exhausted += 1
+                return False
+
+            self.budget_retries += 1
+            self.num_retries += 1
+            return True
+
+
+    @staticmethod
+    def _not_sent(e):
+        '''
+        Whether a request failed before any of it was sent
+        '''
+        if isinstance(e, requests.exceptions.ConnectTimeout): return True
+
+        reason = e.args[0] if e.args else None
+        if isinstance(reason, MaxRetryError): reason = reason.reason
+        return isinstance(reason, NewConnectionError)
+
+
+    def _record(self, target, latency, failed):
+        with self.lock:
+            self.num_requests += 1
+            self.budget_requests += 1
+            t = self.targets[target]
+            t[0] += 1
+            if failed: t[1] += 1
+            t[2] += latency
+            t[3] = max(t[3], latency)
+
+        if self.metrics:
+            self.metrics.observe('logagg_master_outbound_request_duration_seconds', latency)
+            if failed: self.metrics.inc('logagg_master_outbound_errors_total')
+
+
+    def get(self, url, **kwargs):
+        '''
+        GET a url, raising requests exceptions like requests.get does
+        '''
+        kwargs.setdefault('timeout', self.timeout)
+        target = urlsplit(url).netloc
+        attempt = 0
+
+        while True:
+            start = time.time()
+            try:
+                response = self.session.get(url, **kwargs)
+            except requests.exceptions.ConnectionError as e:
+                self._record(target, time.time() - start, True)
+                # A connection lost after the request went out may have been acted on already
+                if not self._not_sent(e) or attempt >= self.retries or not self._take_retry(): raise
+                attempt += 1
+                continue
+            # Read timeouts are not retried, the target is there but slow
+            except requests.exceptions.RequestException:
+                self._record(target, time.time() - start, True)
+                raise
+
+            self._record(target, time.time() - start, False)
+            return response
+
+
+    def stats(self):
+        '''
+        Request counts, connection reuse and latency per target
+        '''
+        new_connections = 0
+        pools = self.adapter.poolmanager.pools
+        for key in pools.keys():
+            pool = pools.get(key)
+            if pool: new_connections += pool.num_connections
+
+        with self.lock:
+            num_requests = self.num_requests
+            targets = {target: {'requests': t[0],
+                                'errors': t[1],
+                                'mean_latency': t[2] / t[0],
+                                'max_latency': t[3]}
+                        for target, t in self.targets.items()}
+
+            return {'requests': num_requests,
+                    'new_connections': new_connections,
+                    'reuse_rate': 1 - float(new_connections) / num_requests if num_requests else 0.0,
+                    'retries': self.num_retries,
+                    'retry_budget_exhausted': self.num_budget_exhausted,
+                    'targets': targets}
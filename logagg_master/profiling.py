@@ -0,0 +1,146 @@
+import sys
+import time
+import asyncio
+import threading
+import traceback
+import tracemalloc
+from collections import Counter
+from concurrent.futures import Future, TimeoutError
+
+SAMPLE_INTERVAL = 0.01 # seconds
+MAX_STACK_DEPTH = 50
+COROUTINES_TIMEOUT = 5 # seconds
+
+def _location(frame):
+    code = frame.f_code
+    return '{}:{}:{}'.format(code.co_filename, code.co_firstlineno, code.co_name)
+
+
+def _stack(frame):
+    '''
+    Locations of a frame and its callers, outermost first
+    '''
+    stack = list()
+    while frame is not None and len(stack) < MAX_STACK_DEPTH:
+        stack.append(_location(frame))
+        frame = frame.f_back
+    stack.reverse()
+    return stack
+
+
+def _top(counter, num_samples, limit, key):
+    num_samples = num_samples or 1
+    return [{key: k, 'samples': n, 'percent': 100.0 * n / num_samples}
+            for k, n in counter.most_common(limit)]
+
+
+def sample(seconds, limit=30, interval=SAMPLE_INTERVAL):
+    '''
+    Profile every thread of the process, the IOLoop's included, by
+    sampling their stacks for seconds. Unlike cProfile, which only sees
+    the thread that enabled it, this catches the background threads and
+    costs the process nothing between samples. Returns the functions
+    seen running most (self) and on the stack most (total) with the most
+    frequent stacks, collapsed to "outer;...;inner" like flame graphs take.
+    '''
+    me = threading.get_ident()
+    names = {t.ident: t.name for t in threading.enumerate()}
+
+    own = Counter()
+    total = Counter()
+    stacks = Counter()
+    threads = Counter()
+    num_samples = 0
+
+    deadline = time.time() + seconds
+    while time.time() < deadline:
+        for ident, frame in sys._current_frames().items():
+            if ident == me: continue
+
+            stack = _stack(frame)
+            num_samples += 1
+            own[stack[-1]] += 1
+            total.update(set(stack))
+            stacks[';'.join(stack)] += 1
+            threads[names.get(ident, str(ident))] += 1
+
+        time.sleep(interval)
+
+    return {'seconds': seconds,
+            'interval': interval,
+            'samples': num_samples,
+            'threads': dict(threads),
+            'top_self': _top(own, num_samples, limit, 'function'),
+            'top_total': _top(total, num_samples, limit, 'function'),
+            'top_stacks': _top(stacks, num_samples, limit, 'stack')}
+
+
+def _coroutine_stacks(loop):
+    # asyncio.Task.all_tasks is gone from python 3.9, asyncio.all_tasks is new in 3.7
+    all_tasks = getattr(asyncio, 'all_tasks', None) or asyncio.Task.all_tasks
+
+    return [{'task': repr(task),
+            'stack': [''.join(traceback.format_stack(f, limit=1)) for f in task.get_stack()]}
+            for task in list(all_tasks(loop))]
+
+
+def thread_stacks(ioloop=None, timeout=COROUTINES_TIMEOUT):
+    '''
+    Current stack of every thread and, given the master's IOLoop, of every
+    coroutine waiting on it (tail and heartbeat streams among them).
+    Coroutines are listed on the IOLoop, their set changes under any
+    other thread, so they are None if it is stuck for timeout seconds.
+    '''
+    threads = {t.ident: t for t in threading.enumerate()}
+
+    stacks = list()
+    for ident, frame in sys._current_frames().items():
+        thread = threads.get(ident)
+        stacks.append({'name': thread.name if thread else str(ident),
+                        'ident': ident,
+                        'daemon': thread.daemon if thread else None,
+                        'stack': traceback.format_stack(frame)})
+
+    coroutines = list()
+    loop = getattr(ioloop, 'asyncio_loop', None)
+    if loop:
+        future = Future()
+
+        def collect():
+            try:
+                future.set_result(_coroutine_stacks(loop))
+            except Exception as e:
+                future.set_exception(e)
+
+        ioloop.add_callback(collect)
+        try:
+            coroutines = future.result(timeout)
+        except TimeoutError:
+            coroutines = None
+
+    return {'threads': stacks, 'coroutines': coroutines}
+
+
+def memory_top(limit=25, frames=1):
+    '''
+    Where the most memory allocated since tracing started still lives,
+    tracing is started by the first call and until then nothing is
+    returned. Tracing slows allocations down, stop it when done.
+    '''
+    if not tracemalloc.is_tracing():
+        tracemalloc.start(frames)
+        return None
+
+    snapshot = tracemalloc.take_snapshot()
+    snapshot = snapshot.filter_traces((tracemalloc.Filter(False, tracemalloc.__file__),))
+    current, peak = tracemalloc.get_traced_memory()
+
+    return {'traced_memory': current,
+            'traced_memory_peak': peak,
+            'top_allocators': [{'location': str(s.traceback),
+                                'size': s.size,
+                                'count': s.count} for s in snapshot.statistics('lineno')[:limit]]}
+
+
+def stop_memory_tracing():
+    tracemalloc.stop()
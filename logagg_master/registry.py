@@ -0,0 +1,312 @@
+import time
+import bisect
+import datetime
+import threading
+from collections import defaultdict
+
+from pymongo import DeleteOne
+from deeputil import keeprunning
+from logagg_utils import log_exception, start_daemon_thread
+
+class ComponentRegistry():
+    '''
+    In-memory view of every component, kept current by heartbeats and
+    registrations. Reads never touch mongodb. Changed components are
+    written behind every flush_interval seconds, so any number of
+    heartbeats from one component in that time cost a single write.
+
+    A component is alive until it has not been seen for suspect_after
+    seconds, suspect until dead_after seconds and dead after that. Dead
+    components are dropped from memory and moved from the components
+    collection to the archive collection in batches after every flush.
+
+    When other processes update the same components, a shared registry
+    also reads back whatever they wrote after every flush. Only one of
+    them should reap, the others set reap_dead to False. Given owns,
+    only the components of clusters it is true for are reaped. Heartbeats
+    read by another process get here up to two flushes late, one to be
+    written and one to be read back, so components whose heartbeats are
+    read elsewhere are given that much longer before they are suspect
+    or dead.
+    '''
+    FLUSH_INTERVAL = 30 # seconds
+    SUSPECT_AFTER = 60 # seconds
+    DEAD_AFTER = 300 # seconds
+    REAP_BATCH_SIZE = 1000
+
+    ALIVE = 'alive'
+    SUSPECT = 'suspect'
+    DEAD = 'dead'
+    LIVE = (ALIVE, SUSPECT)
+
+    def __init__(self, collection, archive_collection, writer, log,
+                flush_interval=FLUSH_INTERVAL,
+                suspect_after=SUSPECT_AFTER,
+                dead_after=DEAD_AFTER,
+                reap_batch_size=REAP_BATCH_SIZE,
+                shared=False,
+                owns=None):
+
+        self.collection = collection
+        self.archive_collection = archive_collection
+        self.writer = writer
+        self.log = log
+        self.flush_interval = flush_interval
+        self.suspect_after = suspect_after
+        self.dead_after = dead_after
+        self.reap_batch_size = reap_batch_size
+        self.shared = shared
+        self.owns = owns
+        self.reap_dead = True
+
+        self.lock = threading.Lock()
+        # {cluster_name: {(namespace, host, port): component}}
+        self.clusters = defaultdict(dict)
+        # {cluster_name: sorted keys}, built when first paged through and
+        # dropped whenever a component of the cluster comes or goes
+        self.sorted_keys = dict()
+        self.dirty = set()
+
+        # Updates received since the last flush
+        self.num_updates = 0
+
+        self._load()
+        self.flush_thread = start_daemon_thread(self._flush_periodically)
+
+
+    @staticmethod
+    def _key(component):
+        return component['namespace'], component['host'], str(component['port'])
+
+
+    def _load(self):
+        num = 0
+        now = time.time()
+        for c in self.collection.find():
+            del c['_id']
+            # Written before liveness was tracked, give them a chance to heartbeat
+            c.setdefault('last_seen', now)
+            self.clusters[c['cluster_name']][self._key(c)] = c
+            num += 1
+
+        self.log.info('component_registry_loaded', num_components=num)
+
+
+    def update(self, component):
+        '''
+        Merge the details of a component into the registry
+        '''
+        cluster_name = component['cluster_name']
+        key = self._key(component)
+
+        with self.lock:
+            components = self.clusters[cluster_name]
+            if key not in components: self.sorted_keys.pop(cluster_name, None)
+            # A fresh dict every time, so readers can hold on to what they got
+            components[key] = dict(components.get(key, {}), **component)
+            components[key]['last_seen'] = time.time()
+            self.dirty.add((cluster_name, key))
+            self.num_updates += 1
+
+
+    def get(self, cluster_name, namespace, host, port):
+        '''
+        Details of one component, None if it is not known
+        '''
+        with self.lock:
+            components = self.clusters.get(cluster_name, {})
+            return components.get((namespace, host, str(port)))
+
+
+    def _reads_heartbeats(self, cluster_name):
+        return self.reap_dead and (not self.owns or self.owns(cluster_name))
+
+
+    def state(self, component, now=None):
+        '''
+        >>> r = ComponentRegistry.__new__(ComponentRegistry)
+        >>> r.suspect_after, r.dead_after, r.flush_interval = 60, 300, 30
+        >>> r.shared, r.reap_dead, r.owns = False, True, None
+        >>> [r.state({'cluster_name': 'c', 'last_seen': t}, now=1000) for t in (990, 900, 600)]
+        ['alive', 'suspect', 'dead']
+        >>> r.shared, r.reap_dead = True, False
+        >>> [r.state({'cluster_name': 'c', 'last_seen': t}, now=1000) for t in (900, 850, 650, 600)]
+        ['alive', 'suspect', 'suspect', 'dead']
+        '''
+        age = (now or time.time()) - component['last_seen']
+        if self.shared and not self._reads_heartbeats(component['cluster_name']):
+            age -= 2 * self.flush_interval
+        if age < self.suspect_after: return self.ALIVE
+        if age < self.dead_after: return self.SUSPECT
+        return self.DEAD
+
+
+    def find(self, cluster_name, states=LIVE):
+        '''
+        Details of the components in a cluster that are in one of states,
+        each with its current state
+        '''
+        now = time.time()
+        with self.lock:
+            components = list(self.clusters.get(cluster_name, {}).values())
+
+        found = list()
+        for c in components:
+            state = self.state(c, now)
+            if state in states: found.append(dict(c, state=state))
+
+        return found
+
+
+    def page(self, cluster_name, states=LIVE, namespace=None, host_prefix='', after=None, limit=0):
+        '''
+        Like find, but in (namespace, host, port) order, only the ones
+        in namespace whose host starts with host_prefix, after the key
+        after and at most limit of them. Returns them with the key to
+        pass as after for the next page, None when no more components
+        match.
+
+        >>> r = ComponentRegistry.__new__(ComponentRegistry)
+        >>> r.suspect_after, r.dead_after, r.shared = 60, 300, False
+        >>> r.lock, r.clusters, r.sorted_keys = threading.Lock(), {}, {}
+        >>> r.clusters['c'] = {('collector', h, '1'): {'host': h, 'last_seen': time.time()}
+        ...                     for h in ('web1', 'web2', 'web3', 'db1')}
+        >>> found, after = r.page('c', namespace='collector', host_prefix='web', limit=2)
+        >>> [c['host'] for c in found], after
+        (['web1', 'web2'], ('collector', 'web2', '1'))
+        >>> found, after = r.page('c', namespace='collector', host_prefix='web', after=after, limit=2)
+        >>> [c['host'] for c in found], after
+        (['web3'], None)
+        >>> found, after = r.page('c', namespace='collector', host_prefix='db', limit=1)
+        >>> [c['host'] for c in found], after
+        (['db1'], None)
+        '''
+        now = time.time()
+        found = list()
+        last = None
+
+        # Sorted keys are replaced and never changed, components are fresh dicts
+        # every time, so the scan can go without holding up heartbeats and flushes
+        with self.lock:
+            components = self.clusters.get(cluster_name, {})
+            keys = self.sorted_keys.get(cluster_name)
+            if keys is None: keys = self.sorted_keys[cluster_name] = sorted(components)
+
+        # Keys sort by namespace then host, so the filters select a range of them
+        start = bisect.bisect_left(keys, (namespace, host_prefix)) if namespace else 0
+        if after: start = max(start, bisect.bisect_right(keys, tuple(after)))
+
+        for i in range(start, len(keys)):
+            key = keys[i]
+            if namespace and (key[0] != namespace or not key[1].startswith(host_prefix)): break
+            if not key[1].startswith(host_prefix): continue
+
+            # Reaped or archived since the keys were sorted
+            c = components.get(key)
+            if c is None: continue
+            state = self.state(c, now)
+            if state not in states: continue
+
+            # Only a further match makes a next page
+            if limit and len(found) == limit: return found, last
+
+            found.append(dict(c, state=state))
+            last = key
+
+        return found, None
+
+
+    def flush(self):
+        '''
+        Write every component changed since the last flush
+        '''
+        with self.lock:
+            dirty, self.dirty = self.dirty, set()
+            num_updates, self.num_updates = self.num_updates, 0
+            changed = [self.clusters[cluster_name][key] for cluster_name, key in dirty]
+
+        if not changed: return
+
+        try:
+            for component in changed:
+                self.writer.add(component)
+            self.writer.flush()
+        except Exception:
+            # Try these again on the next flush
+            with self.lock: self.dirty.update(dirty)
+            raise
+
+        self.log.info('component_registry_flushed',
+                    num_updates=num_updates,
+                    num_written=len(changed))
+
+
+    def refresh(self):
+        '''
+        Catch up with components written by other processes, dropping
+        the ones they archived
+        '''
+        stored = dict()
+        for c in self.collection.find({}, {'_id': 0}):
+            stored[(c['cluster_name'], self._key(c))] = c
+
+        with self.lock:
+            self.sorted_keys.clear()
+            for (cluster_name, key), c in stored.items():
+                known = self.clusters[cluster_name].get(key)
+                if known and known['last_seen'] >= c.get('last_seen', 0): continue
+                c.setdefault('last_seen', time.time())
+                self.clusters[cluster_name][key] = c
+
+            for cluster_name, components in list(self.clusters.items()):
+                for key in list(components):
+                    # Not written yet is not archived
+                    if (cluster_name, key) in stored or (cluster_name, key) in self.dirty: continue
+                    del components[key]
+                if not components: del self.clusters[cluster_name]
+
+
+    def _archive(self, components):
+        archived_at = datetime.datetime.utcnow()
+        self.archive_collection.insert_many([dict(c, archived_at=archived_at) for c in components],
+                                            ordered=False)
+        self.collection.bulk_write([DeleteOne({'cluster_name': c['cluster_name'],
+                                               'namespace': c['namespace'],
+                                               'host': c['host'],
+                                               'port': c['port']}) for c in components],
+                                    ordered=False)
+
+
+    def reap(self):
+        '''
+        Drop dead components and archive them in mongodb
+        '''
+        now = time.time()
+        dead = list()
+
+        with self.lock:
+            for cluster_name, components in list(self.clusters.items()):
+                # Heartbeats of the cluster are read by another master
+                if self.owns and not self.owns(cluster_name): continue
+                for key, c in list(components.items()):
+                    if self.state(c, now) != self.DEAD: continue
+                    dead.append(components.pop(key))
+                    self.dirty.discard((cluster_name, key))
+                    self.sorted_keys.pop(cluster_name, None)
+                if not components: del self.clusters[cluster_name]
+
+        if not dead: return
+
+        for i in range(0, len(dead), self.reap_batch_size):
+            self._archive(dead[i:i + self.reap_batch_size])
+
+        self.log.info('dead_components_archived', num_archived=len(dead))
+
+
+    @keeprunning(on_error=log_exception)
+    def _flush_periodically(self):
+        time.sleep(self.flush_interval)
+        self.flush()
+        if self.shared: self.refresh()
+        # After the flush, so no pending write brings an archived component back
+        if self.reap_dead: self.reap()
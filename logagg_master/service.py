@@ -1,31 +1,63 @@
 import uuid
-from typing import Generator
-import time
+import base64
+import fnmatch
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
 import ujson as json
-from kwikapi import Request, BaseProtocol
+from kwikapi import BaseProtocol
 import tornado
+import tornado.ioloop
+from tornado import gen
 import pymongo
 from pymongo import MongoClient
-from deeputil import generate_random_string, keeprunning, AttrDict
+from deeputil import generate_random_string
+from logagg_utils import log_exception
 import requests
-from logagg_utils import log_exception, start_daemon_thread
+
+from .tail import TailMultiplexer
+from .heartbeat import HeartbeatWriter, HeartbeatReader
+from .registry import ComponentRegistry
+from .clusters import ClusterCache, nsq_shards
+from .outbound import OutboundClient
+from .nsq import NsqLoad, NsqApiPool, DepthMonitor
+from .migration import ClusterMigrator
+from .leader import LeaderLock
+from .mongo import MongoExecutor
+from .storage import SqliteDatabase, MONGODB, SQLITE
+from .membership import MasterMembership
+from .metrics import Metrics, MongoCommandMetrics, watch_ioloop
+from . import profiling
 
 class MasterService():
     '''
     Logagg master API
     '''
-    NSQ_API_URL = 'http://{nsq_api_address}/tail?nsqd_tcp_address={nsqd_tcp_address}&topic={topic}&empty_lines={empty_lines}'
     COLLECTOR_ADD_FILE_URL = 'http://{collector_address}/collector/v1/add_file?fpath={fpath}&formatter={formatter}'
     COLLECTOR_REMOVE_FILE_URL = 'http://{collector_address}/collector/v1/remove_file?fpath="{fpath}"'
     COLLECTOR_STOP_URL = 'http://{collector_address}/collector/v1/stop'
     NSQ_DEPTH_LIMIT = 1000000
+    MAX_PROFILE_SECONDS = 300
+    MAX_COMPONENTS_PAGE = 5000
 
     def __init__(self, master, log):
 
         self.master = master
         self.log = log
 
+        # Requests only reach mongodb through the master's MongoExecutor
+        self.nsq_collection = master.mongo.wrap(master.nsq_collection)
+        self.nsq_api_collection = master.mongo.wrap(master.nsq_api_collection)
+        self.cluster_collection = master.mongo.wrap(master.cluster_collection)
+
+
+    def _get_cluster(self, cluster_name):
+        # Only misses wait for the MongoExecutor, cached clusters are served while mongodb is down too
+        found, cluster = self.master.clusters.cached(cluster_name)
+        if found: return cluster
+
+        return self.master.mongo.call('clusters.get', self.master.clusters.get, cluster_name)
+
 
     def ping(self, key:str, secret:str) -> dict:
         '''
@@ -47,22 +79,23 @@ class MasterService():
         'http://localhost:1088/logagg/v1/add_nsq?nsqd_tcp_address="<hostname>:4150"&nsqd_http_address="<hostname>:4151"&key=xyz&secret=xxxx'
         '''
         if key == self.master.auth.key and secret == self.master.auth.secret:
-            nsq_api = dict()
-            random_nsq_api = self.master.nsq_api_collection.aggregate([{'$sample': {'size': 1}}])
-
-            for n in random_nsq_api:
-                nsq_api = n
-
-            if not nsq_api:
+            # Only a default, streams pick the least loaded healthy nsq_api when they open
+            nsq_api_address = self.master.nsq_apis.pick()
+            if not nsq_api_address:
+                # None health checked yet
+                for n in self.nsq_api_collection.aggregate([{'$sample': {'size': 1}}]):
+                    nsq_api_address = n['host'] + ':' + str(n['port'])
+
+            if not nsq_api_address:
                 return {'success': False, 'details': 'No nsq_api in master to assign to NSQ'}
 
             details = {'nsqd_tcp_address': nsqd_tcp_address,
                         'nsqd_http_address': nsqd_http_address,
                         'nsq_depth_limit': self.NSQ_DEPTH_LIMIT,
-                        'nsq_api_address': nsq_api['host']+':'+str(nsq_api['port'])}
+                        'nsq_api_address': nsq_api_address}
 
             try:
-                object_id = self.master.nsq_collection.insert_one(details).inserted_id
+                object_id = self.nsq_collection.insert_one(details).inserted_id
 
             except pymongo.errors.DuplicateKeyError as dke:
                 return {'details': 'Duplicate nsq details', 'success': False}
@@ -81,16 +114,117 @@ class MasterService():
         'http://localhost:1088/logagg/v1/get_nsq?key=xyz&secret=xxxx'
         '''
         if key == self.master.auth.key and secret == self.master.auth.secret:
-            nsq = self.master.nsq_collection.find()
+            nsq = self.nsq_collection.find()
             nsq_list = list()
             for n in nsq:
                 n.pop('_id')
+                n['load'] = self.master.nsq_load.get(n['nsqd_tcp_address'])
+                n['load'].pop('topics', None)
                 nsq_list.append(n)
             return {'success': True, 'nsq_list':nsq_list}
         else:
             return {'success': False, 'details': 'Authentication failed'}
 
 
+    def get_nsq_api(self, key:str, secret:str) -> dict:
+        '''
+        Health and open streams of every nsq_api
+        Sample url:
+        'http://localhost:1088/logagg/v1/get_nsq_api?key=xyz&secret=xxxx'
+        '''
+        if key == self.master.auth.key and secret == self.master.auth.secret:
+            return {'success': True, 'nsq_api_list': self.master.nsq_apis.stats()}
+        else:
+            return {'success': False, 'details': 'Authentication failed'}
+
+
+    def get_cluster_cache_stats(self, key:str, secret:str) -> dict:
+        '''
+        Hits and misses of the cluster details cache
+        Sample url:
+        'http://localhost:1088/logagg/v1/get_cluster_cache_stats?key=xyz&secret=xxxx'
+        '''
+        if key == self.master.auth.key and secret == self.master.auth.secret:
+            return {'success': True, 'stats': self.master.clusters.stats()}
+        else:
+            return {'success': False, 'details': 'Authentication failed'}
+
+
+    def get_outbound_stats(self, key:str, secret:str) -> dict:
+        '''
+        Connection reuse and per-target latency of calls made by the master
+        Sample url:
+        'http://localhost:1088/logagg/v1/get_outbound_stats?key=xyz&secret=xxxx'
+        '''
+        if key == self.master.auth.key and secret == self.master.auth.secret:
+            return {'success': True, 'stats': self.master.outbound.stats()}
+        else:
+            return {'success': False, 'details': 'Authentication failed'}
+
+
+    def get_profile(self, key:str, secret:str, seconds:int=10, limit:int=30) -> dict:
+        '''
+        Sample the stacks of every thread for seconds and return the
+        busiest functions and stacks
+        Sample url:
+        'http://localhost:1088/logagg/v1/get_profile?key=xyz&secret=xxxx&seconds=10'
+        '''
+        if key == self.master.auth.key and secret == self.master.auth.secret:
+            if not 0 < seconds <= self.MAX_PROFILE_SECONDS:
+                return {'success': False,
+                        'details': 'seconds must be between 1 and {}'.format(self.MAX_PROFILE_SECONDS)}
+            # Only one at a time, they would show up in each other's samples
+            if not self.master.profile_lock.acquire(blocking=False):
+                return {'success': False, 'details': 'Already profiling'}
+            try:
+                return {'success': True, 'profile': profiling.sample(seconds, limit=limit)}
+            finally:
+                self.master.profile_lock.release()
+        else:
+            return {'success': False, 'details': 'Authentication failed'}
+
+
+    def get_thread_stacks(self, key:str, secret:str) -> dict:
+        '''
+        Current stack of every thread and of every coroutine on the IOLoop
+        Sample url:
+        'http://localhost:1088/logagg/v1/get_thread_stacks?key=xyz&secret=xxxx'
+        '''
+        if key == self.master.auth.key and secret == self.master.auth.secret:
+            return dict(profiling.thread_stacks(self.master.ioloop), success=True)
+        else:
+            return {'success': False, 'details': 'Authentication failed'}
+
+
+    def get_memory_top(self, key:str, secret:str, limit:int=25) -> dict:
+        '''
+        Top allocators of memory still in use, the first call starts
+        tracing allocations
+        Sample url:
+        'http://localhost:1088/logagg/v1/get_memory_top?key=xyz&secret=xxxx&limit=25'
+        '''
+        if key == self.master.auth.key and secret == self.master.auth.secret:
+            top = profiling.memory_top(limit)
+            if top is None:
+                return {'success': True, 'details': 'Started tracing memory allocations, call again to see top allocators'}
+            return dict(top, success=True)
+        else:
+            return {'success': False, 'details': 'Authentication failed'}
+
+
+    def stop_memory_tracing(self, key:str, secret:str) -> dict:
+        '''
+        Stop tracing memory allocations started by get_memory_top
+        Sample url:
+        'http://localhost:1088/logagg/v1/stop_memory_tracing?key=xyz&secret=xxxx'
+        '''
+        if key == self.master.auth.key and secret == self.master.auth.secret:
+            profiling.stop_memory_tracing()
+            return {'success': True, 'details': 'Stopped tracing memory allocations'}
+        else:
+            return {'success': False, 'details': 'Authentication failed'}
+
+
     def register_nsq_api(self, key:str, secret:str, host:str, port:str) -> dict:
         '''
         Validate auth details and store details of component in master
@@ -103,8 +237,9 @@ class MasterService():
             details = {'host': host,
                 'port': port}
 
+            self.master.nsq_apis.add(host + ':' + str(port))
             try:
-                object_id = self.master.nsq_api_collection.insert_one(details).inserted_id
+                object_id = self.nsq_api_collection.insert_one(details).inserted_id
 
             except pymongo.errors.DuplicateKeyError as dke:
                 return {'details': 'Duplicate nsq_api details', 'success': True}
@@ -116,22 +251,26 @@ class MasterService():
             return {'success': False, 'details': 'Authentication failed'}
 
    
-    def create_cluster(self, cluster_name:str) -> dict:
+    def create_cluster(self, cluster_name:str, shards:int=1) -> dict:
         '''
-        Create cluster in master
+        Create cluster in master, spread over shards nsqds
         Sample url:
-        'http://localhost:1088/logagg/v1/create_cluster?cluster_name=logagg'
+        'http://localhost:1088/logagg/v1/create_cluster?cluster_name=logagg&shards=1'
         '''
-        passwd = generate_random_string(8).decode('utf-8') 
-        random_nsq = self.master.nsq_collection.aggregate([{'$sample': {'size': 1}}])
-        nsq = dict()
+        if shards < 1:
+            return {'success': False, 'details': 'Cluster needs at least one shard'}
 
-        for n in random_nsq:
-            nsq = n
+        passwd = generate_random_string(8)
+        # Older deeputils return bytes
+        if isinstance(passwd, bytes): passwd = passwd.decode('utf-8')
+        nsqs = self.master.nsq_load.rank(list(self.nsq_collection.find()))
 
-        if not nsq:
+        if not nsqs:
             return {'success': False, 'details': 'No NSQ in master to assign to cluster'}
+        if len(nsqs) < shards:
+            return {'success': False, 'details': 'Only {} NSQ in master to spread {} shards over'.format(len(nsqs), shards)}
 
+        nsq = nsqs[0]
         cluster_info = {'cluster_name': cluster_name,
                 'cluster_passwd': passwd,
                 'nsqd_tcp_address': nsq['nsqd_tcp_address'],
@@ -139,14 +278,53 @@ class MasterService():
                 'nsq_depth_limit': nsq['nsq_depth_limit'],
                 'nsq_api_address': nsq['nsq_api_address'],
                 'heartbeat_topic': cluster_name+'_heartbeat#ephemeral',
-                'logs_topic': cluster_name+'_logs'}
+                'logs_topic': cluster_name+'_logs',
+                'version': 1}
+        if shards > 1:
+            cluster_info['shards'] = [{'nsqd_tcp_address': n['nsqd_tcp_address'],
+                                        'nsqd_http_address': n['nsqd_http_address'],
+                                        'nsq_api_address': n['nsq_api_address']} for n in nsqs[:shards]]
         try:
-            object_id = self.master.cluster_collection.insert_one(cluster_info).inserted_id
+            object_id = self.cluster_collection.insert_one(cluster_info).inserted_id
+            self.master.clusters.invalidate(cluster_name)
+            for shard in nsq_shards(cluster_info):
+                self.master.nsq_load.assigned(shard['nsqd_tcp_address'])
+            self.master.heartbeat_reader.update(cluster_info)
             return {'success': True, 'cluster_name': cluster_name, 'cluster_passwd': passwd}
 
         except pymongo.errors.DuplicateKeyError as dke:
             return {'success': False, 'details': 'Cluster name already existing'}
 
+
+    def migrate_cluster(self, cluster_name:str, nsqd_tcp_address:str, key:str, secret:str) -> dict:
+        '''
+        Move a cluster to another nsqd while it is in use, the old nsqd
+        keeps being read until it is drained
+        Sample url:
+        'http://localhost:1088/logagg/v1/migrate_cluster?cluster_name=logagg&nsqd_tcp_address="<hostname>:4150"&key=xyz&secret=xxxx'
+        '''
+        if key == self.master.auth.key and secret == self.master.auth.secret:
+            nsq = self.nsq_collection.find_one({'nsqd_tcp_address': nsqd_tcp_address})
+            if not nsq:
+                return {'success': False, 'details': 'NSQ not found'}
+
+            cluster = self._get_cluster(cluster_name)
+            if cluster and cluster.get('shards'):
+                return {'success': False, 'details': 'Sharded clusters cannot be migrated'}
+
+            cluster = self.master.migrator.migrate(cluster_name, nsq)
+            if not cluster:
+                return {'success': False, 'details': 'Cluster not found, already on this NSQ or being migrated'}
+
+            return {'success': True,
+                    'details': 'Cluster migrating',
+                    'draining': [d['nsqd_tcp_address'] for d in cluster['draining']],
+                    'collectors_told': cluster['collectors_told'],
+                    'num_collectors': cluster['num_collectors']}
+        else:
+            return {'success': False, 'details': 'Authentication failed'}
+
+
     def get_clusters(self) -> list:
         '''
         Get cluster information
@@ -154,12 +332,13 @@ class MasterService():
         'http://localhost:1088/logagg/v1/get_clusters'
         '''
 
-        clusters = self.master.cluster_collection.find()
+        clusters = self.cluster_collection.find()
 
         cluster_list = list()
         for c in clusters:
             del c['_id']
             del c['cluster_passwd']
+            c['backpressure'] = self.master.depth_monitor.get(c['cluster_name'])
             cluster_list.append(c)
 
         return cluster_list
@@ -172,12 +351,11 @@ class MasterService():
         'http://localhost:1088/logagg/v1/get_cluster_info?cluster_name=logagg&cluster_passwd=xxxx'
         '''
 
-        cluster = self.master.cluster_collection.find_one({'cluster_name': cluster_name})
+        cluster = self._get_cluster(cluster_name)
         if not cluster:
             return {'success': False, 'details': 'Cluster name not found'}
         else:
             if cluster['cluster_passwd'] == cluster_passwd:
-                del cluster['_id']
                 return {'success': True, 'cluster_info': cluster}
             else:
                 return {'success': False, 'details': 'Authentication failed'}
@@ -188,7 +366,7 @@ class MasterService():
         Sample url:
         'http://localhost:1088/logagg/v1/change_cluster_passwd?cluster_name=logagg&old_passwd=5cc299d1&new_passwd=qwerty'
         '''
-        c = self.master.cluster_collection.find_one({'$and':[{'cluster_name': cluster_name},
+        c = self.cluster_collection.find_one({'$and':[{'cluster_name': cluster_name},
                                                                 {'cluster_passwd': old_passwd}
                                                                 ]
                                                         })
@@ -198,10 +376,11 @@ class MasterService():
         
         else:
             query = {'$and':[{'cluster_name': cluster_name}, {'cluster_passwd': old_passwd}]}
-            newvalues = { '$set': { 'cluster_passwd': new_passwd } }
-            c = self.master.cluster_collection.update_one(query, newvalues)
-            
-            new_cluster_info = self.master.cluster_collection.find_one({'cluster_name': cluster_name})
+            newvalues = { '$set': { 'cluster_passwd': new_passwd }, '$inc': {'version': 1} }
+            c = self.cluster_collection.update_one(query, newvalues)
+            self.master.clusters.invalidate(cluster_name)
+
+            new_cluster_info = self.cluster_collection.find_one({'cluster_name': cluster_name})
             return{'success': True,
                     'cluster_info': {'cluster_name': new_cluster_info['cluster_name'],
                                      'cluster_passwd': new_cluster_info['cluster_passwd']
@@ -209,13 +388,34 @@ class MasterService():
                 }
 
 
+    def _assign_shard(self, cluster, component):
+        '''
+        Shard a collector writes to: the one it already has, else the one
+        with the fewest live collectors
+        '''
+        shards = nsq_shards(cluster)
+        known = self.master.components.get(cluster['cluster_name'], component['namespace'],
+                                            component['host'], component['port'])
+        if known and known.get('shard', len(shards)) < len(shards): return known['shard']
+
+        num_collectors = [0] * len(shards)
+        for c in self.master.components.find(cluster['cluster_name']):
+            if c['namespace'] == 'collector' and c.get('shard', len(shards)) < len(shards):
+                num_collectors[c['shard']] += 1
+
+        return num_collectors.index(min(num_collectors))
+
+
     def register_component(self, namespace:str, cluster_name:str, cluster_passwd:str, host:str, port:str) -> dict:
         '''
-        Validate auth details and store details of component in database
+        Validate auth details and store details of component in database.
+        Collectors are told which shard of the cluster to write to.
         Sample url:
         'http://localhost:1088/logagg/v1/register_component?namespace=master&cluster_name=logagg&cluster_passwd=xxxx&host=78.47.113.210&port=1088'
         '''
-        c = self.master.cluster_collection.find_one({'cluster_name': cluster_name})
+        c = self._get_cluster(cluster_name)
+        if not c:
+            return {'success': False, 'details': 'Cluster not found'}
 
         if cluster_passwd == c['cluster_passwd']:
             component = {'namespace':namespace,
@@ -223,40 +423,114 @@ class MasterService():
                     'port':str(port),
                     'cluster_name':cluster_name}
 
-            component_info = AttrDict(component)
-            try:
-                cluster_name= component_info.cluster_name
-                namespace = component_info.namespace
-                host = component_info.host
-                port = component_info.port
-                self.master.component_collection.update_one({'cluster_name': cluster_name, 'namespace': namespace, 'host': host, 'port': port},
-                                                     {'$set': component},
-                                                     upsert=True)
+            if namespace != 'collector':
+                self.master.components.update(component)
                 return {'success': True}
 
-            except pymongo.errors.DuplicateKeyError as dke:
-                return {'success': True, 'details': 'Duplicate component details'}
+            component['shard'] = self._assign_shard(c, component)
+            self.master.components.update(component)
+            return {'success': True, 'shard': nsq_shards(c)[component['shard']]}
         else:
             return {'success': False, 'details': 'Authentication failed'}
 
 
-    def get_components(self, cluster_name:str, cluster_passwd:str) -> dict:
+    @staticmethod
+    def _text(value):
+        '''
+        A query argument as text. kwikapi reads arguments that look like
+        numbers as numbers, so a host_prefix of 10 comes in as the int 10.
+        Their formatting is lost, 10.10 comes back as '10.1', clients keep
+        it by quoting them: host_prefix="10.10"
+
+        >>> MasterService._text(10), MasterService._text(10.5), MasterService._text('web')
+        ('10', '10.5', 'web')
+        '''
+        return value if isinstance(value, str) else str(value)
+
+
+    @staticmethod
+    def _encode_cursor(key):
+        return base64.urlsafe_b64encode(json.dumps(key).encode('utf-8')).decode('ascii')
+
+
+    @staticmethod
+    def _decode_cursor(cursor):
+        '''
+        >>> MasterService._decode_cursor(MasterService._encode_cursor(('collector', 'web1', '1088')))
+        ['collector', 'web1', '1088']
         '''
-        Get all components in a cluster
+        key = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')).decode('utf-8'))
+        if not (isinstance(key, list) and len(key) == 3 and all(isinstance(k, str) for k in key)):
+            raise ValueError(cursor)
+        return key
+
+
+    def get_components(self, cluster_name:str, cluster_passwd:str, state:str='live',
+                        namespace:str='', host_prefix:str='', fields:str='', limit:int=0, cursor:str='') -> dict:
+        '''
+        Get components in a cluster, by default the live (alive or suspect) ones.
+        Optionally only those of a namespace whose host starts with host_prefix,
+        with only the comma separated fields asked for. Given a limit, components
+        come in pages ordered by namespace, host and port, pass next_cursor as
+        cursor to get the next page, it is None after the last one.
         Sample url:
-        'http://localhost:1088/logagg/v1/get_components?cluster_name=logagg&cluster_passwd=xxxx'
+        'http://localhost:1088/logagg/v1/get_components?cluster_name=logagg&cluster_passwd=xxxx&state="alive,suspect"'
+        'http://localhost:1088/logagg/v1/get_components?cluster_name=logagg&cluster_passwd=xxxx&namespace=collector&host_prefix=web&fields=host,port,state&limit=500'
         '''
-        components_info = list()
-        cluster =  self.master.cluster_collection.find_one({'cluster_name': cluster_name})
+        cluster = self._get_cluster(cluster_name)
         if not cluster:
             return {'success': False, 'details': 'Cluster not found'}
         if cluster['cluster_passwd'] != cluster_passwd:
             return {'success': False, 'details': 'Authentication failed'}
 
-        for c in self.master.component_collection.find({'cluster_name': cluster_name}):
-            del c['_id']
-            components_info.append(c)
-        return {'success': True, 'components_info': components_info}
+        if state == 'live':
+            states = ComponentRegistry.LIVE
+        else:
+            states = self._text(state).split(',')
+            for st in states:
+                if st not in (ComponentRegistry.ALIVE, ComponentRegistry.SUSPECT, ComponentRegistry.DEAD):
+                    return {'success': False, 'details': 'Invalid state "{}"'.format(st)}
+
+        try:
+            after = self._decode_cursor(cursor) if cursor else None
+        except ValueError:
+            return {'success': False, 'details': 'Invalid cursor'}
+
+        limit = min(max(limit, 0), self.MAX_COMPONENTS_PAGE)
+        components_info, last = self.master.components.page(cluster_name, states,
+                                                            namespace=self._text(namespace) or None,
+                                                            host_prefix=self._text(host_prefix),
+                                                            after=after,
+                                                            limit=limit)
+        if fields:
+            fields = self._text(fields).split(',')
+            components_info = [{f: c[f] for f in fields if f in c} for c in components_info]
+
+        return {'success': True,
+                'components_info': components_info,
+                'next_cursor': self._encode_cursor(last) if last else None}
+
+
+    def _request_collector(self, url):
+        '''
+        Call a collector, whatever goes wrong comes back as a failed result
+        so one collector never fails a batch
+        '''
+        try:
+            response = self.master.outbound.get(url)
+        except requests.exceptions.ConnectionError:
+            return {'success': False, 'details': 'Could not reach collector'}
+        except requests.exceptions.Timeout:
+            return {'success': False, 'details': 'Collector did not respond in time'}
+        except requests.exceptions.RequestException as e:
+            return {'success': False, 'details': 'Request to collector failed: {}'.format(e)}
+
+        try:
+            result = json.loads(response.content.decode('utf-8'))
+            return {'success': True, 'fpaths': result['result']}
+        except (ValueError, KeyError, TypeError):
+            # kwikapi errors have no result
+            return {'success': False, 'details': 'Collector responded with an error: {}'.format(response.text[:200])}
 
 
     def collector_add_file(self, cluster_name:str,
@@ -271,17 +545,14 @@ class MasterService():
                      cluster_name=logagg&cluster_passwd=xxxx&collector_host=localhost&collector_port=1088&
                      fpath="/var/log/serverstats.log"&formatter="logagg_collector.formatters.docker_file_log_driver"'
         '''
-        cluster =  self.master.cluster_collection.find_one({'cluster_name': cluster_name})
+        cluster = self._get_cluster(cluster_name)
         if not cluster:
             return {'success': False, 'details': 'Cluster not found'}
         if cluster['cluster_passwd'] != cluster_passwd:
             return {'success': False, 'details': 'Authentication failed'}
 
         collector_port = str(collector_port)
-        collector = self.master.component_collection.find_one({'cluster_name': cluster_name,
-                                                                'host': collector_host,
-                                                                'port': collector_port,
-                                                                'namespace': 'collector'})
+        collector = self.master.components.get(cluster_name, 'collector', collector_host, collector_port)
         if not collector:
             return {'success': False, 'details': 'Collector not found'}
         else:
@@ -289,12 +560,7 @@ class MasterService():
             add_file_url = self.COLLECTOR_ADD_FILE_URL.format(collector_address=collector_address,
                                                                 fpath=fpath,
                                                                 formatter=formatter)
-            try:
-                add_file_result = requests.get(add_file_url).content
-                add_file_result = json.loads(add_file_result.decode('utf-8'))
-            except requests.exceptions.ConnectionError:
-                return {'success': False, 'details': 'Could not reach collector'}
-            return {'success': True, 'fpaths': add_file_result['result']}
+            return self._request_collector(add_file_url)
 
 
     def collector_remove_file(self, cluster_name:str,
@@ -308,82 +574,149 @@ class MasterService():
                      cluster_name=logagg&cluster_passwd=xxxx&collector_host=localhost&collector_port=1088&
                      fpath="/var/log/serverstats.log"'
         '''
-        cluster =  self.master.cluster_collection.find_one({'cluster_name': cluster_name})
+        cluster = self._get_cluster(cluster_name)
         if not cluster:
             return {'success': False, 'details': 'Cluster not found'}
         if cluster['cluster_passwd'] != cluster_passwd:
             return {'success': False, 'details': 'Authentication failed'}
 
         collector_port = str(collector_port)
-        collector = self.master.component_collection.find_one({'cluster_name': cluster_name,
-                                                                'host': collector_host,
-                                                                'port': collector_port,
-                                                                'namespace': 'collector'})
+        collector = self.master.components.get(cluster_name, 'collector', collector_host, collector_port)
         if not collector:
             return {'success': False, 'details': 'Collector not found'}
         else:
             collector_address = collector_host + ':' + collector_port
             remove_file_url = self.COLLECTOR_REMOVE_FILE_URL.format(collector_address=collector_address,
                                                                 fpath=fpath)
-            try:
-                remove_file_result = requests.get(remove_file_url).content
-                remove_file_result = json.loads(remove_file_result.decode('utf-8'))
-            except requests.exceptions.ConnectionError:
-                return {'success': False, 'details': 'Could not reach collector'}
-            return {'success': True, 'fpaths': remove_file_result['result']}
+            return self._request_collector(remove_file_url)
 
 
-    def tail_logs(self, req:Request, cluster_name:str, cluster_passwd:str) -> Generator:
+    def _select_collectors(self, cluster_name, collectors, host_pattern):
         '''
-        Sample url:
-        'http://localhost:1088/logagg/v1/tail_logs?cluster_name=logagg&cluster_passwd=xxxx'
+        Collectors picked by a list of <host>:<port>, a host pattern or all
+        live collectors of the cluster. Listed collectors that are not known
+        come back as (host, port, None).
         '''
-        cluster =  self.master.cluster_collection.find_one({'cluster_name': cluster_name})
+        if collectors:
+            selected = list()
+            for c in self._text(collectors).split(','):
+                host, _, port = c.strip().rpartition(':')
+                selected.append((host, port, self.master.components.get(cluster_name, 'collector', host, port)))
+            return selected
+
+        host_pattern = self._text(host_pattern or '*')
+        return [(c['host'], str(c['port']), c) for c in self.master.components.find(cluster_name)
+                    if c['namespace'] == 'collector' and fnmatch.fnmatchcase(c['host'], host_pattern)]
+
+
+    def _batch_request_collectors(self, cluster_name, cluster_passwd, collectors, host_pattern, url_for):
+        cluster = self._get_cluster(cluster_name)
         if not cluster:
             return {'success': False, 'details': 'Cluster not found'}
         if cluster['cluster_passwd'] != cluster_passwd:
             return {'success': False, 'details': 'Authentication failed'}
+        if collectors and host_pattern:
+            return {'success': False, 'details': 'Give either collectors or host_pattern'}
 
-        nsq_api_address = cluster['nsq_api_address']
-        topic = cluster['logs_topic']
-        nsqd_tcp_address = cluster['nsqd_tcp_address']
-        url = self.NSQ_API_URL.format(nsq_api_address=nsq_api_address,
-                                        nsqd_tcp_address=nsqd_tcp_address,
-                                        topic=topic,
-                                        empty_lines='yes')
-        s = requests.session()
-        try:
-            resp = s.get(url, stream=True)
-        except requests.exceptions.ConnectionError:
-            self.log.error('cannot_request_nsq_api', url=url)
-            return  {'success': False, 'details': 'Cannot request nsq api'}
-        start = time.time()
-        log_list = list()
-
-        for log in resp.iter_lines():
-            if req._request.connection.stream.closed():
-                self.log.debug('stream_closed')
-                resp.close()
-                break
-            if log:
-                log_list.append(log.decode('utf-8') + '\n')
+        selected = self._select_collectors(cluster_name, collectors, host_pattern)
+
+        def request(collector):
+            host, port, component = collector
+            if not component:
+                result = {'success': False, 'details': 'Collector not found'}
             else:
-                 yield ''
-            if time.time() - start >= 1:
-                for l in log_list: yield l
-                log_list = []
-                start = time.time()
+                result = self._request_collector(url_for(host + ':' + port))
+            return dict(result, host=host, port=port)
+
+        results = list(self.master.collector_executor.map(request, selected))
+        self.log.info('batch_collector_request',
+                    cluster=cluster_name,
+                    num_collectors=len(results),
+                    num_failed=sum(1 for r in results if not r['success']))
+
+        return {'success': True, 'results': results}
+
+
+    def batch_collector_add_file(self, cluster_name:str,
+                                cluster_passwd:str,
+                                fpath:str,
+                                formatter:str,
+                                collectors:str='',
+                                host_pattern:str='') -> dict:
+        '''
+        Add files to many collectors at once, picked by a comma separated
+        list of <host>:<port>, by a shell style host pattern or, when neither
+        is given, all live collectors of the cluster
+        Sample url: 'http://localhost:1088/logagg/v1/batch_collector_add_file?
+                     cluster_name=logagg&cluster_passwd=xxxx&host_pattern="web-*"&
+                     fpath="/var/log/serverstats.log"&formatter="logagg_collector.formatters.docker_file_log_driver"'
+        '''
+        url_for = lambda collector_address: self.COLLECTOR_ADD_FILE_URL.format(collector_address=collector_address,
+                                                                            fpath=fpath,
+                                                                            formatter=formatter)
+        return self._batch_request_collectors(cluster_name, cluster_passwd, collectors, host_pattern, url_for)
+
+
+    def batch_collector_remove_file(self, cluster_name:str,
+                                    cluster_passwd:str,
+                                    fpath:str,
+                                    collectors:str='',
+                                    host_pattern:str='') -> dict:
+        '''
+        Remove file-path from many collectors at once, picked like in batch_collector_add_file
+        Sample url: 'http://localhost:1088/logagg/v1/batch_collector_remove_file?
+                     cluster_name=logagg&cluster_passwd=xxxx&collectors="web-1:1099,web-2:1099"&
+                     fpath="/var/log/serverstats.log"'
+        '''
+        url_for = lambda collector_address: self.COLLECTOR_REMOVE_FILE_URL.format(collector_address=collector_address,
+                                                                                fpath=fpath)
+        return self._batch_request_collectors(cluster_name, cluster_passwd, collectors, host_pattern, url_for)
+
 
 class Master():
     '''
     Logagg master class
+
+    One of several worker processes serving the same port when given a
+    leader_lock, only the worker holding it reads heartbeats, reaps
+    components and tells collectors what to do. Every worker checks the
+    clusters it tails or reads heartbeats of every CLUSTER_CHECK_INTERVAL
+    seconds and follows the ones other workers changed.
+
+    When sharded, masters sharing the mongodb split the clusters between
+    them (see MasterMembership) and do all of that for their own clusters
+    only. Tails of other clusters are redirected to their owner, any
+    other call is answered by any master. The owner of a cluster another
+    master migrated follows it by the same check as workers do.
     '''
-    NSQ_API_URL = 'http://{nsq_api_address}/tail?nsqd_tcp_address={nsqd_tcp_address}&topic={topic}'
     SERVER_SELECTION_TIMEOUT = 500  # MongoDB server selection timeout
     NAMESPACE = 'master'
-    UPDATE_COMPONENTS_INTERVAL = 30
-
-    def __init__(self, host, port, mongodb, auth, log):
+    COMPONENT_ARCHIVE_TTL = 7 * 24 * 60 * 60 # seconds
+    COLLECTOR_WORKERS = 32 # collectors called at once by batch operations
+    MASTER_LEASE_RETENTION = 24 * 60 * 60 # seconds
+    SQLITE_PATH = 'logagg-master.db'
+    CLUSTER_CHECK_INTERVAL = ClusterCache.SHARED_TTL # seconds
+
+    def __init__(self, host, port, mongodb, auth, log,
+                heartbeat_batch_size=HeartbeatWriter.BATCH_SIZE,
+                heartbeat_batch_interval=HeartbeatWriter.BATCH_INTERVAL,
+                component_flush_interval=ComponentRegistry.FLUSH_INTERVAL,
+                cluster_cache_ttl=ClusterCache.TTL,
+                component_suspect_after=ComponentRegistry.SUSPECT_AFTER,
+                component_dead_after=ComponentRegistry.DEAD_AFTER,
+                outbound_connect_timeout=OutboundClient.CONNECT_TIMEOUT,
+                outbound_read_timeout=OutboundClient.READ_TIMEOUT,
+                collector_workers=COLLECTOR_WORKERS,
+                nsq_poll_interval=NsqLoad.POLL_INTERVAL,
+                nsq_api_health_check_interval=NsqApiPool.HEALTH_CHECK_INTERVAL,
+                depth_throttle_at=DepthMonitor.THROTTLE_AT,
+                depth_resume_at=DepthMonitor.RESUME_AT,
+                leader_lock=None,
+                sharded=False,
+                mongo_workers=MongoExecutor.WORKERS,
+                mongo_timeout=MongoExecutor.TIMEOUT,
+                storage=MONGODB,
+                sqlite_path=SQLITE_PATH):
 
         self.host = host
         self.port = port
@@ -391,13 +724,216 @@ class Master():
 
         self.log = log
         self.mongodb = mongodb
+        self.storage = storage
+        self.sqlite_path = sqlite_path
+        self.metrics = Metrics()
+        self.ioloop = tornado.ioloop.IOLoop.current()
+        self.profile_lock = threading.Lock()
+        self.mongo = MongoExecutor(self.metrics, workers=mongo_workers, timeout=mongo_timeout)
+        # Other worker processes or masters change clusters too
+        self.shared = bool(leader_lock or sharded)
         self.db_client = self._ensure_db_connection()
-        self._init_mongo_collections()
-        self.update_component_thread = start_daemon_thread(self.update_components)
-        self.update_cluster_components_threads = dict()
+        self._init_collections()
+        self.membership = None
+        if sharded:
+            self.membership = MasterMembership(self.master_collection, host, port, self.log,
+                                            on_change=self._rebalance)
+        self.outbound = OutboundClient(connect_timeout=outbound_connect_timeout,
+                                        read_timeout=outbound_read_timeout,
+                                        metrics=self.metrics)
+        self.collector_executor = ThreadPoolExecutor(max_workers=collector_workers)
+        self.nsq_load = NsqLoad(self.nsq_collection,
+                                self.cluster_collection,
+                                self.outbound,
+                                self.log,
+                                poll_interval=nsq_poll_interval)
+        self.nsq_apis = NsqApiPool(self.nsq_api_collection,
+                                    self.outbound,
+                                    self.log,
+                                    health_check_interval=nsq_api_health_check_interval)
+        self.clusters = ClusterCache(self.cluster_collection, self.log, ttl=cluster_cache_ttl, shared=self.shared)
+        self.tail_multiplexer = TailMultiplexer(self.log, self.nsq_apis)
+        # Written by the registry's flushes only, which put back what failed to be written
+        self.heartbeat_writer = HeartbeatWriter(self.component_collection,
+                                                self.log,
+                                                batch_size=heartbeat_batch_size,
+                                                batch_interval=heartbeat_batch_interval,
+                                                autoflush=False)
+        self.components = ComponentRegistry(self.component_collection,
+                                            self.component_archive_collection,
+                                            self.heartbeat_writer,
+                                            self.log,
+                                            flush_interval=component_flush_interval,
+                                            suspect_after=component_suspect_after,
+                                            dead_after=component_dead_after,
+                                            shared=self.shared,
+                                            owns=self.owns)
+        self.depth_monitor = DepthMonitor(self.cluster_collection,
+                                        self.nsq_load,
+                                        self.tell_collectors,
+                                        self.log,
+                                        interval=nsq_poll_interval,
+                                        throttle_at=depth_throttle_at,
+                                        resume_at=depth_resume_at,
+                                        owns=self.owns)
+        self.heartbeat_reader = HeartbeatReader(self.cluster_collection,
+                                                self.components,
+                                                self.log,
+                                                nsq_apis=self.nsq_apis,
+                                                metrics=self.metrics,
+                                                owns=self.owns)
+        self.migrator = ClusterMigrator(self, self.log, drain_check_interval=nsq_poll_interval)
+        self._init_metrics()
+
+        # Named so they can be told apart in thread stacks and profiles
+        for name, thread in self._background_threads().items(): thread.name = name
+
+        if self.shared: self.ioloop.spawn_callback(self._check_clusters_periodically)
+
+        self.leader = None
+        if leader_lock:
+            self._follow()
+            # Last, the leader may be elected right away
+            self.leader = LeaderLock(leader_lock, self.log, self._lead)
+        else:
+            self._lead()
+
+
+    @property
+    def is_leader(self):
+        return self.leader is None or self.leader.is_leader
+
+
+    def owns(self, cluster_name):
+        return self.membership is None or self.membership.owns(cluster_name)
+
+
+    def tell_collectors(self, cluster_name, url_for, told=None):
+        '''
+        GET url_for(<host>:<port>) of every live collector of a cluster,
+        all at once. Returns how many of them answered and how many
+        were asked. Given a set told, collectors whose <host>:<port> is
+        in it are skipped and the ones that answer are added to it.
+        '''
+        address = lambda collector: collector['host'] + ':' + str(collector['port'])
+
+        def tell(collector):
+            try:
+                self.outbound.get(url_for(address(collector)))
+                return True
+            except requests.exceptions.RequestException:
+                return False
+
+        collectors = [c for c in self.components.find(cluster_name)
+                        if c['namespace'] == 'collector' and (told is None or address(c) not in told)]
+        answered = list(self.collector_executor.map(tell, collectors))
+        if told is not None: told.update(address(c) for c, ok in zip(collectors, answered) if ok)
+
+        return sum(answered), len(collectors)
+
+
+    def _rebalance(self):
+        # Streams of clusters that moved away are stopped, of ones that moved here started
+        self.heartbeat_reader.rescan()
+
+
+    async def _check_clusters(self):
+        names = sorted(set(self.tail_multiplexer.cluster_tails) | set(self.heartbeat_reader.streams))
+        if not names: return
+
+        clusters = await self.ioloop.run_in_executor(None,
+                        lambda: list(self.cluster_collection.find({'cluster_name': {'$in': names}}, {'_id': 0})))
+        # Details no newer than the ones followed change nothing
+        for cluster in clusters:
+            self.tail_multiplexer.update(cluster)
+            self.heartbeat_reader.update(cluster)
+
+
+    async def _check_clusters_periodically(self):
+        '''
+        Follows clusters migrated or drained by other processes, which
+        only tell their own tails and heartbeat reader
+        '''
+        while True:
+            await gen.sleep(self.CLUSTER_CHECK_INTERVAL)
+            try:
+                await self._check_clusters()
+            except Exception:
+                log_exception(self, self._check_clusters)
+
+
+    def _follow(self):
+        self.components.reap_dead = False
+        self.depth_monitor.leader = False
+        self.migrator.leader = False
+
+
+    def _lead(self):
+        self.components.reap_dead = True
+        self.depth_monitor.leader = True
+        self.migrator.leader = True
+        self.heartbeat_reader.start()
 
        
-    def _init_mongo_collections(self):
+    def _init_metrics(self):
+        m = self.metrics
+        m.describe('logagg_master_tail_lines_total', 'counter', 'Log lines forwarded to tail clients per cluster')
+        m.describe('logagg_master_tail_bytes_total', 'counter', 'Bytes forwarded to tail clients per cluster')
+        m.describe('logagg_master_tail_streams', 'gauge', 'Clusters being tailed, each read once from nsq_api')
+        m.describe('logagg_master_tail_clients', 'gauge', 'Tail clients per cluster')
+        m.describe('logagg_master_heartbeat_streams', 'gauge', 'Heartbeat streams open and connected to nsq_api')
+        m.describe('logagg_master_heartbeat_last_scan_timestamp_seconds', 'gauge', 'When the heartbeat reader last scanned clusters')
+        m.describe('logagg_master_heartbeats_pending', 'gauge', 'Component updates waiting to be written to mongodb')
+        m.describe('logagg_master_components', 'gauge', 'Components known to the registry')
+        m.describe('logagg_master_thread_alive', 'gauge', 'Whether each background thread is running')
+        m.describe('logagg_master_leader', 'gauge', 'Whether this process reads heartbeats and tells collectors')
+        m.describe('logagg_master_masters', 'gauge', 'Masters splitting the clusters, this one included')
+        m.add_collector(self._gauges)
+
+        self.ioloop.spawn_callback(watch_ioloop, m)
+
+
+    def _gauges(self):
+        gauges = list()
+
+        for cluster_tail in list(self.tail_multiplexer.cluster_tails.values()):
+            gauges.append(('logagg_master_tail_clients', {'cluster': cluster_tail.cluster_name}, len(cluster_tail.clients)))
+        gauges.append(('logagg_master_tail_streams', {}, len(self.tail_multiplexer.cluster_tails)))
+
+        streams = [s for ss in list(self.heartbeat_reader.streams.values()) for s in list(ss.values())]
+        gauges.append(('logagg_master_heartbeat_streams', {'state': 'open'}, len(streams)))
+        gauges.append(('logagg_master_heartbeat_streams', {'state': 'connected'}, sum(s.code == 200 for s in streams)))
+        if self.heartbeat_reader.last_scan_at:
+            gauges.append(('logagg_master_heartbeat_last_scan_timestamp_seconds', {}, self.heartbeat_reader.last_scan_at))
+
+        gauges.append(('logagg_master_heartbeats_pending', {}, len(self.heartbeat_writer.pending)))
+        gauges.append(('logagg_master_components', {},
+                        sum(len(c) for c in list(self.components.clusters.values()))))
+
+        for name, thread in self._background_threads().items():
+            gauges.append(('logagg_master_thread_alive', {'thread': name}, int(thread.is_alive())))
+        gauges.append(('logagg_master_leader', {}, int(self.is_leader)))
+        if self.membership:
+            gauges.append(('logagg_master_masters', {}, len(self.membership.masters)))
+
+        return gauges
+
+
+    def _background_threads(self):
+        threads = {'component_flush': self.components.flush_thread,
+                    'nsq_poll': self.nsq_load.poll_thread,
+                    'nsq_api_health_check': self.nsq_apis.health_check_thread,
+                    'depth_monitor': self.depth_monitor.monitor_thread,
+                    'drain_check': self.migrator.drain_check_thread}
+        if hasattr(self.heartbeat_writer, 'flush_thread'):
+            threads['heartbeat_flush'] = self.heartbeat_writer.flush_thread
+        if self.membership:
+            threads['membership_renew'] = self.membership.renew_thread
+
+        return threads
+
+
+    def _init_collections(self):
         # Collection for nsq details
         self.nsq_collection = self.db_client['nsq']
         self.nsq_collection.create_index([
@@ -420,8 +956,15 @@ class Master():
             ('port', pymongo.ASCENDING),
             ('cluster_name', pymongo.ASCENDING)],
             unique=True)
-        #FIXME: does not serve it's purpose of expiring records
-        #self.component_collection.ensure_index('timestamp', expireAfterSeconds=60)
+
+        # Collection for dead components, kept for a while after they are reaped
+        self.component_archive_collection = self.db_client['components_archive']
+        self.component_archive_collection.create_index('archived_at',
+                                                    expireAfterSeconds=self.COMPONENT_ARCHIVE_TTL)
+
+        # Collection for the leases of masters splitting the clusters, dropped a while after they expire
+        self.master_collection = self.db_client['masters']
+        self.master_collection.create_index('expires_at', expireAfterSeconds=self.MASTER_LEASE_RETENTION)
 
         # Collection for cluster info
         self.cluster_collection = self.db_client['cluster']
@@ -431,66 +974,19 @@ class Master():
 
 
     def _ensure_db_connection(self):
+        if self.storage == SQLITE:
+            db_client = SqliteDatabase(self.sqlite_path)
+            self.log.info('sqlite_storage_opened', path=self.sqlite_path)
+            return db_client
+
         url = 'mongodb://{}:{}@{}:{}'.format(self.mongodb.user,
                 self.mongodb.passwd,
                 self.mongodb.host,
                 self.mongodb.port)
 
-        client = MongoClient(url, serverSelectionTimeoutMS=self.SERVER_SELECTION_TIMEOUT)
+        client = MongoClient(url, serverSelectionTimeoutMS=self.SERVER_SELECTION_TIMEOUT,
+                            event_listeners=[MongoCommandMetrics(self.metrics)])
         self.log.info('mongodb_server_connection_established', db=dict(self.mongodb))
         db_client = client[self.mongodb.name]
 
         return db_client
-
-    @keeprunning(UPDATE_COMPONENTS_INTERVAL, on_error=log_exception)
-    def _update_cluster_components(self, cluster_name):
-        '''
-        Starts a deamon thread for reading from heartbeat topic and updarting info in database
-        '''
-        cluster_info = self.cluster_collection.find_one({'cluster_name': cluster_name})
-        topic = cluster_info['heartbeat_topic']
-        nsqd_tcp_address = cluster_info['nsqd_tcp_address']
-        nsq_api_address = cluster_info['nsq_api_address']
-
-        url = self.NSQ_API_URL.format(nsq_api_address=nsq_api_address,
-                                        nsqd_tcp_address=nsqd_tcp_address,
-                                        topic=topic,
-                                        empty_lines='no')
-        try:
-            self.log.info("updating_components", cluster=cluster_name)
-            resp = requests.get(url, stream=True)
-            start_read_heartbeat = time.time()
-            for heartbeat in resp.iter_lines():
-                heartbeat = AttrDict(json.loads(heartbeat.decode('utf-8')))
-                cluster_name = heartbeat.cluster_name
-                namespace = heartbeat.namespace
-                host = heartbeat.host
-                port = heartbeat.port
-                self.component_collection.update_one({'cluster_name': cluster_name, 'namespace': namespace, 'host': host, 'port': port},
-                                                     {'$set': heartbeat},
-                                                     upsert=True)
-
-        except requests.exceptions.ConnectionError:
-            self.log.warn('cannot_request_nsq_api___will_try_again', url=url)
-
-        except KeyboardInterrupt:
-            if resp: resp.close()
-            sys.exit(0)
-        time.sleep(self.UPDATE_COMPONENTS_INTERVAL)
-
-
-    @keeprunning(UPDATE_COMPONENTS_INTERVAL, on_error=log_exception)
-    def update_components(self):
-        '''
-        Reads heartbeat and updates components
-        '''
-        # List of cluster names
-        cluster_list = list()
-        for c in self.cluster_collection.find(): cluster_list.append(c['cluster_name'])
-
-        for cluster_name in cluster_list:
-            if cluster_name not in self.update_cluster_components_threads:
-                update_cluster_components_thread = start_daemon_thread(self._update_cluster_components, (cluster_name,))
-                self.update_cluster_components_threads[cluster_name] = update_cluster_components_thread
-
-        time.sleep(self.UPDATE_COMPONENTS_INTERVAL)
@@ -0,0 +1,457 @@
+'''
+Where the master keeps nsqs, nsq_apis, clusters and components.
+
+The master only uses a small part of the pymongo collection API, which
+is the storage interface: find, find_one, insert_one, insert_many,
+update_one, delete_one, bulk_write of UpdateOne and DeleteOne, an
+aggregate that is a single $sample, create_index and drop. Filters are
+equality on fields, $and and $exists, $gt, $gte, $lt, $lte, $ne and $in
+on dotted paths. Updates are $set, $setOnInsert, $unset, $inc and $pull.
+Projections include or exclude fields.
+
+MongoDB is the default storage and is used through pymongo as it is.
+SQLite is the embedded one, for small deployments that should not need
+a mongod of their own.
+'''
+import uuid
+import json
+import time
+import sqlite3
+import datetime
+import threading
+
+import pymongo
+from pymongo import UpdateOne, DeleteOne, InsertOne
+from pymongo.errors import DuplicateKeyError
+from pymongo.results import InsertOneResult, InsertManyResult, UpdateResult, DeleteResult, BulkWriteResult
+
+MONGODB = 'mongodb'
+SQLITE = 'sqlite'
+STORAGES = (MONGODB, SQLITE)
+
+_MISSING = object()
+
+def _encode(value):
+    if isinstance(value, datetime.datetime): return {'$date': value.isoformat()}
+    raise TypeError('Cannot store {!r}'.format(value))
+
+
+def _decode(obj):
+    if len(obj) == 1 and '$date' in obj:
+        value = obj['$date']
+        return datetime.datetime.strptime(value, '%Y-%m-%dT%H:%M:%S.%f' if '.' in value else '%Y-%m-%dT%H:%M:%S')
+    return obj
+
+
+def _get(doc, path):
+    '''
+    Value at a dotted path, list elements by index
+
+    >>> _get({'a': [{'b': 1}]}, 'a.0.b')
+    1
+    >>> _get({'a': []}, 'a.0') is _MISSING
+    True
+    '''
+    value = doc
+    for key in path.split('.'):
+        if isinstance(value, dict) and key in value:
+            value = value[key]
+        elif isinstance(value, list) and key.isdigit() and int(key) < len(value):
+            value = value[int(key)]
+        else:
+            return _MISSING
+
+    return value
+
+
+def _compare(value, condition):
+    '''
+    >>> _compare(5, {'$gt': 3, '$lt': 10}), _compare(_MISSING, {'$exists': False}), _compare(1, 2)
+    (True, True, False)
+    '''
+    if not (isinstance(condition, dict) and condition and all(k.startswith('$') for k in condition)):
+        if value is _MISSING: return condition is None
+        return value == condition
+
+    for op, arg in condition.items():
+        if op == '$exists':
+            if (value is not _MISSING) != bool(arg): return False
+        elif op == '$ne':
+            if value is not _MISSING and value == arg: return False
+        elif op == '$in':
+            if value is _MISSING or value not in arg: return False
+        elif op in ('$gt', '$gte', '$lt', '$lte'):
+            if value is _MISSING or value is None: return False
+            try:
+                if op == '$gt' and not value > arg: return False
+                if op == '$gte' and not value >= arg: return False
+                if op == '$lt' and not value < arg: return False
+                if op == '$lte' and not value <= arg: return False
+            except TypeError:
+                return False
+        else:
+            raise NotImplementedError('Query operator {} is not supported by the sqlite storage'.format(op))
+
+    return True
+
+
+def _matches(doc, conditions):
+    return all(_compare(_get(doc, path), condition) for path, condition in conditions)
+
+
+def _split(filter):
+    '''
+    Equality on top level fields, which SQL can use indexes for, and the
+    conditions left to check on the documents read
+
+    >>> eq, rest = _split({'$and': [{'a': 1}, {'b': {'$gt': 2}}], 'c.d': 3})
+    >>> sorted(eq.items()), sorted(rest)
+    ([('a', 1)], [('b', {'$gt': 2}), ('c.d', 3)])
+    '''
+    eq = dict()
+    rest = list()
+    conditions = list((filter or {}).items())
+
+    while conditions:
+        path, condition = conditions.pop()
+        if path == '$and':
+            for f in condition: conditions.extend(f.items())
+        elif path.startswith('$'):
+            raise NotImplementedError('Query operator {} is not supported by the sqlite storage'.format(path))
+        elif '.' not in path and path not in eq and isinstance(condition, (str, int, float)):
+            eq[path] = condition
+        else:
+            rest.append((path, condition))
+
+    return eq, rest
+
+
+def _copy_path(source, target, keys):
+    value = source.get(keys[0], _MISSING)
+    if value is _MISSING: return
+    if len(keys) == 1:
+        target[keys[0]] = value
+    elif isinstance(value, dict):
+        _copy_path(value, target.setdefault(keys[0], dict()), keys[1:])
+    elif isinstance(value, list):
+        items = target.setdefault(keys[0], [dict() for v in value if isinstance(v, dict)])
+        for v, item in zip([v for v in value if isinstance(v, dict)], items):
+            _copy_path(v, item, keys[1:])
+
+
+def _project(doc, projection):
+    '''
+    >>> doc = {'_id': 'x', 'a': 1, 'b': [{'c': 2, 'd': 3}], 'e': 4}
+    >>> sorted(_project(doc, {'_id': 0, 'a': 1, 'b.c': 1}).items())
+    [('a', 1), ('b', [{'c': 2}])]
+    >>> sorted(_project(doc, {'_id': 0, 'e': 0}))
+    ['a', 'b']
+    '''
+    if not projection: return doc
+
+    fields = {k: v for k, v in projection.items() if k != '_id'}
+    if fields and all(fields.values()):
+        projected = dict()
+        for path in fields: _copy_path(doc, projected, path.split('.'))
+        if projection.get('_id', 1) and '_id' in doc: projected['_id'] = doc['_id']
+        return projected
+
+    projected = dict(doc)
+    for path in fields: projected.pop(path, None)
+    if not projection.get('_id', 1): projected.pop('_id', None)
+    return projected
+
+
+def _set(doc, path, value):
+    keys = path.split('.')
+    for key in keys[:-1]: doc = doc.setdefault(key, dict())
+    doc[keys[-1]] = value
+
+
+def _apply(doc, update, inserting=False):
+    '''
+    >>> doc = {'a': 1, 'l': [{'x': 1}, {'x': 2}]}
+    >>> _apply(doc, {'$set': {'b.c': 2}, '$unset': {'a': ''}, '$pull': {'l': {'x': 1}}})
+    >>> doc
+    {'l': [{'x': 2}], 'b': {'c': 2}}
+    >>> _apply(doc, {'$inc': {'b.c': 1, 'n': 1}})
+    >>> doc['b'], doc['n']
+    ({'c': 3}, 1)
+    '''
+    for op, changes in update.items():
+        if op == '$set' or (op == '$setOnInsert' and inserting):
+            for path, value in changes.items(): _set(doc, path, value)
+        elif op == '$setOnInsert':
+            continue
+        elif op == '$unset':
+            for path in changes:
+                keys = path.split('.')
+                parent = _get(doc, '.'.join(keys[:-1])) if len(keys) > 1 else doc
+                if isinstance(parent, dict): parent.pop(keys[-1], None)
+        elif op == '$inc':
+            for path, amount in changes.items():
+                value = _get(doc, path)
+                _set(doc, path, amount if value is _MISSING else value + amount)
+        elif op == '$pull':
+            for path, condition in changes.items():
+                values = _get(doc, path)
+                if not isinstance(values, list): continue
+                if isinstance(condition, dict) and not all(k.startswith('$') for k in condition):
+                    keep = [v for v in values if not (isinstance(v, dict) and _matches(v, condition.items()))]
+                else:
+                    keep = [v for v in values if not _compare(v, condition)]
+                _set(doc, path, keep)
+        else:
+            raise NotImplementedError('Update operator {} is not supported by the sqlite storage'.format(op))
+
+
+class SqliteDatabase():
+    '''
+    Collections kept in a SQLite database in WAL mode, so readers never
+    wait on the writer and worker processes of a master on one host can
+    share it. Every collection is a table of JSON documents, indexes are
+    built on the fields they cover.
+    '''
+    BUSY_TIMEOUT = 30 # seconds
+
+    def __init__(self, path):
+
+        self.path = path
+        self.name = path
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.collections = dict()
+
+        self.connection().execute('PRAGMA journal_mode=WAL')
+
+
+    def connection(self):
+        '''
+        Connection of the calling thread, sqlite connections cannot be shared between threads
+        '''
+        conn = getattr(self.local, 'conn', None)
+        if conn is None:
+            conn = self.local.conn = sqlite3.connect(self.path, timeout=self.BUSY_TIMEOUT, isolation_level=None)
+            conn.execute('PRAGMA synchronous=NORMAL')
+
+        return conn
+
+
+    def __getitem__(self, name):
+        with self.lock:
+            if name not in self.collections:
+                self.collections[name] = SqliteCollection(self, name)
+            return self.collections[name]
+
+
+class SqliteCollection():
+    '''
+    A table of JSON documents answering the calls of the storage interface
+    '''
+    EXPIRE_INTERVAL = 60 # seconds
+
+    def __init__(self, database, name):
+
+        self.database = database
+        self.name = name
+        self.table = '"{}"'.format(name.replace('"', '""'))
+        # {field: seconds} of TTL indexes
+        self.ttls = dict()
+        self.expired_at = 0
+
+        self._create_table()
+
+
+    def _create_table(self):
+        self.database.connection().execute(
+            'CREATE TABLE IF NOT EXISTS {} (id TEXT PRIMARY KEY, doc TEXT NOT NULL)'.format(self.table))
+
+
+    @staticmethod
+    def _field(path, suffix=''):
+        return "json_extract(doc, '$.\"{}\"{}')".format(path.replace("'", "''").replace('"', '\\"'), suffix)
+
+
+    def _write(self, fn):
+        '''
+        Run fn in a transaction that holds the write lock from the start,
+        so what it reads cannot change before it writes
+        '''
+        conn = self.database.connection()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            result = fn(conn)
+            conn.execute('COMMIT')
+        except sqlite3.IntegrityError as e:
+            conn.execute('ROLLBACK')
+            raise DuplicateKeyError(str(e), 11000)
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+
+        self._expire()
+        return result
+
+
+    def _select(self, conn, filter, limit=None):
+        eq, rest = _split(filter)
+        where = list()
+        params = list()
+        for path, value in eq.items():
+            if path == '_id':
+                where.append('id = ?')
+            else:
+                where.append('{} = ?'.format(self._field(path)))
+            params.append(value)
+
+        sql = 'SELECT id, doc FROM {}'.format(self.table)
+        if where: sql += ' WHERE ' + ' AND '.join(where)
+        if limit and not rest: sql += ' LIMIT {:d}'.format(limit)
+
+        found = 0
+        # Read to the end first, callers may write before they are done
+        for _id, doc in conn.execute(sql, params).fetchall():
+            doc = json.loads(doc, object_hook=_decode)
+            doc['_id'] = _id
+            if not _matches(doc, rest): continue
+            yield doc
+            found += 1
+            if limit and found >= limit: return
+
+
+    def _store(self, conn, doc, replace=False):
+        doc = dict(doc)
+        _id = str(doc.pop('_id'))
+        conn.execute('{} INTO {} (id, doc) VALUES (?, ?)'.format('REPLACE' if replace else 'INSERT', self.table),
+                    (_id, json.dumps(doc, default=_encode)))
+
+
+    def find(self, filter=None, projection=None):
+        return [_project(doc, projection) for doc in self._select(self.database.connection(), filter)]
+
+
+    def find_one(self, filter=None, projection=None):
+        for doc in self._select(self.database.connection(), filter, limit=1):
+            return _project(doc, projection)
+        return None
+
+
+    def insert_one(self, document):
+        # Like pymongo, the document gets its _id
+        document.setdefault('_id', uuid.uuid4().hex)
+        self._write(lambda conn: self._store(conn, document))
+        return InsertOneResult(document['_id'], True)
+
+
+    def insert_many(self, documents, ordered=True):
+        for document in documents: document.setdefault('_id', uuid.uuid4().hex)
+
+        def insert(conn):
+            for document in documents: self._store(conn, document)
+
+        self._write(insert)
+        return InsertManyResult([d['_id'] for d in documents], True)
+
+
+    def _update_one(self, conn, filter, update, upsert):
+        for doc in self._select(conn, filter, limit=1):
+            before = json.dumps(doc, default=_encode, sort_keys=True)
+            _apply(doc, update)
+            modified = json.dumps(doc, default=_encode, sort_keys=True) != before
+            if modified: self._store(conn, doc, replace=True)
+            return {'n': 1, 'nModified': int(modified)}
+
+        if not upsert: return {'n': 0, 'nModified': 0}
+
+        eq, rest = _split(filter)
+        doc = dict(eq)
+        for path, condition in rest:
+            if not isinstance(condition, dict): _set(doc, path, condition)
+        _apply(doc, update, inserting=True)
+        doc.setdefault('_id', uuid.uuid4().hex)
+        self._store(conn, doc)
+        return {'n': 1, 'nModified': 0, 'upserted': doc['_id']}
+
+
+    def update_one(self, filter, update, upsert=False):
+        return UpdateResult(self._write(lambda conn: self._update_one(conn, filter, update, upsert)), True)
+
+
+    def _delete_one(self, conn, filter):
+        for doc in self._select(conn, filter, limit=1):
+            conn.execute('DELETE FROM {} WHERE id = ?'.format(self.table), (doc['_id'],))
+            return 1
+        return 0
+
+
+    def delete_one(self, filter):
+        return DeleteResult({'n': self._write(lambda conn: self._delete_one(conn, filter))}, True)
+
+
+    def bulk_write(self, requests, ordered=True):
+        def write(conn):
+            result = {'nInserted': 0, 'nUpserted': 0, 'nMatched': 0, 'nModified': 0, 'nRemoved': 0, 'upserted': []}
+            for i, r in enumerate(requests):
+                if isinstance(r, UpdateOne):
+                    raw = self._update_one(conn, r._filter, r._doc, r._upsert)
+                    if 'upserted' in raw:
+                        result['nUpserted'] += 1
+                        result['upserted'].append({'index': i, '_id': raw['upserted']})
+                    else:
+                        result['nMatched'] += raw['n']
+                        result['nModified'] += raw['nModified']
+                elif isinstance(r, DeleteOne):
+                    result['nRemoved'] += self._delete_one(conn, r._filter)
+                elif isinstance(r, InsertOne):
+                    r._doc.setdefault('_id', uuid.uuid4().hex)
+                    self._store(conn, r._doc)
+                    result['nInserted'] += 1
+                else:
+                    raise NotImplementedError('{} is not supported by the sqlite storage'.format(type(r).__name__))
+            return result
+
+        return BulkWriteResult(self._write(write), True)
+
+
+    def aggregate(self, pipeline):
+        if len(pipeline) != 1 or list(pipeline[0]) != ['$sample']:
+            raise NotImplementedError('Only a single $sample stage is supported by the sqlite storage')
+
+        rows = self.database.connection().execute(
+                    'SELECT id, doc FROM {} ORDER BY RANDOM() LIMIT ?'.format(self.table),
+                    (pipeline[0]['$sample']['size'],))
+        return [dict(json.loads(doc, object_hook=_decode), _id=_id) for _id, doc in rows]
+
+
+    def create_index(self, keys, unique=False, expireAfterSeconds=None, **kwargs):
+        if isinstance(keys, str): keys = [(keys, pymongo.ASCENDING)]
+        fields = [k for k, _ in keys]
+
+        if expireAfterSeconds is not None:
+            # Only dates expire, which are kept as {'$date': isoformat} and sort as text
+            self.ttls[fields[0]] = expireAfterSeconds
+            expressions = [self._field(fields[0], '."$date"')]
+        else:
+            expressions = [self._field(f) for f in fields]
+
+        name = '"{}"'.format('_'.join([self.name] + fields).replace('"', '""'))
+        self.database.connection().execute('CREATE {}INDEX IF NOT EXISTS {} ON {} ({})'.format(
+                    'UNIQUE ' if unique else '', name, self.table, ', '.join(expressions)))
+        return name
+
+
+    def _expire(self):
+        if not self.ttls or time.time() - self.expired_at < self.EXPIRE_INTERVAL: return
+        self.expired_at = time.time()
+
+        now = datetime.datetime.utcnow()
+        conn = self.database.connection()
+        for field, seconds in self.ttls.items():
+            expired_before = (now - datetime.timedelta(seconds=seconds)).isoformat()
+            conn.execute('DELETE FROM {} WHERE {} < ?'.format(self.table, self._field(field, '."$date"')),
+                        (expired_before,))
+
+
+    def drop(self):
+        self.database.connection().execute('DROP TABLE IF EXISTS {}'.format(self.table))
+        self._create_table()
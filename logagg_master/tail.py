@@ -0,0 +1,858 @@
+import ast
+import re
+import sys
+import collections
+from urllib.parse import urlsplit
+
+import ujson as json
+import tornado.web
+import tornado.locks
+import tornado.ioloop
+from tornado import gen
+from tornado.iostream import StreamClosedError
+from tornado.util import TimeoutError
+from tornado.tcpclient import TCPClient
+from tornado.httpclient import HTTPError
+from tornado.httputil import HTTPMessageDelegate, HTTPHeaders, RequestStartLine
+from tornado.http1connection import HTTP1Connection, HTTP1ConnectionParameters
+
+from .exceptions import InvalidArgument, MongoTimeout
+from .clusters import nsq_sources, cluster_version
+
+class NsqApiStream(HTTPMessageDelegate):
+    '''
+    Reads a topic from nsq_api over a non-blocking connection and hands
+    the complete lines of every received chunk to a callback.
+
+    With an NsqApiPool, every (re)open goes through the least loaded
+    healthy nsq_api, nsq_api_address only being used when none is known
+    to be healthy, and an nsq_api that cannot be reached is failed over
+    from right away.
+    '''
+    NSQ_API_URL = 'http://{nsq_api_address}/tail?nsqd_tcp_address={nsqd_tcp_address}&topic={topic}&empty_lines={empty_lines}'
+    CONNECT_TIMEOUT = 5
+    REOPEN_INTERVAL = 1
+    MAX_BODY_SIZE = sys.maxsize # A tail never ends on its own, so do not cap the body size
+
+    def __init__(self, nsq_api_address, nsqd_tcp_address, topic, on_lines, log,
+                empty_lines='yes', nsq_apis=None):
+
+        self.nsq_api_address = nsq_api_address
+        self.nsqd_tcp_address = nsqd_tcp_address
+        self.topic = topic
+        self.empty_lines = empty_lines
+        self.nsq_apis = nsq_apis
+        self.url = self._url(nsq_api_address)
+        self.on_lines = on_lines
+        self.log = log
+        self.closed = False
+        self.code = None
+        self._iostream = None
+        self._partial = b''
+
+
+    def _url(self, nsq_api_address):
+        return self.NSQ_API_URL.format(nsq_api_address=nsq_api_address,
+                                        nsqd_tcp_address=self.nsqd_tcp_address,
+                                        topic=self.topic,
+                                        empty_lines=self.empty_lines)
+
+
+    def close(self):
+        '''
+        Stop reading and drop the upstream connection
+        '''
+        self.closed = True
+        if self._iostream: self._iostream.close()
+
+
+    def headers_received(self, start_line, headers):
+        self.code = start_line.code
+
+
+    def data_received(self, chunk):
+        if self.code != 200: return
+
+        lines = (self._partial + chunk).split(b'\n')
+        self._partial = lines.pop()
+        if lines: self.on_lines(lines)
+
+
+    async def _fetch(self):
+        url = urlsplit(self.url)
+        self._iostream = await TCPClient().connect(url.hostname,
+                                                    url.port or 80,
+                                                    timeout=self.CONNECT_TIMEOUT)
+        if self.closed:
+            self._iostream.close()
+            return
+
+        connection = HTTP1Connection(self._iostream, True,
+                                    HTTP1ConnectionParameters(no_keep_alive=True,
+                                        max_body_size=self.MAX_BODY_SIZE))
+        connection.write_headers(RequestStartLine('GET', url.path + '?' + url.query, 'HTTP/1.1'),
+                                HTTPHeaders({'Host': url.netloc, 'Connection': 'close'}))
+        connection.finish()
+        await connection.read_response(self)
+
+
+    def _failover(self, nsq_api_address):
+        if not self.nsq_apis: return False
+
+        if self.nsq_apis.failed(nsq_api_address):
+            self.log.warn('nsq_api_failing_over', url=self.url)
+            return True
+
+        return False
+
+
+    async def read(self):
+        '''
+        Read the topic until the stream is closed, re-opening it whenever
+        nsq_api ends the response. Raises if no nsq_api can be reached.
+        '''
+        while not self.closed:
+            if self.nsq_apis:
+                nsq_api_address = self.nsq_apis.acquire(self.nsq_api_address)
+            else:
+                nsq_api_address = self.nsq_api_address
+            self.url = self._url(nsq_api_address)
+            self.code = None
+            self._partial = b''
+
+            try:
+                await self._fetch()
+            except (StreamClosedError, TimeoutError):
+                if self.closed: return
+                # Never got a response out of nsq_api
+                if self.code is None:
+                    if self._failover(nsq_api_address): continue
+                    raise
+            finally:
+                if self.nsq_apis: self.nsq_apis.release(nsq_api_address)
+
+            if self.code != 200 and not self.closed:
+                if self._failover(nsq_api_address): continue
+                raise HTTPError(self.code)
+
+            if not self.closed:
+                self.log.warn('nsq_api_stream_ended___reopening', url=self.url)
+                await gen.sleep(self.REOPEN_INTERVAL)
+
+
+class LogLine():
+    '''
+    A raw line from the logs topic, decoded at most once however many
+    clients need to look inside it
+    '''
+    __slots__ = ('raw', '_record')
+
+    def __init__(self, raw):
+        self.raw = raw
+        self._record = None
+
+
+    @property
+    def record(self):
+        if self._record is None:
+            try:
+                self._record = json.loads(self.raw.decode('utf-8'))
+            except ValueError:
+                self._record = {}
+            if not isinstance(self._record, dict): self._record = {}
+
+        return self._record
+
+
+class TailFilter():
+    '''
+    Decides which log records a tail client gets. All filters are parsed and
+    compiled once when the client connects and must all match.
+
+    level, host and namespace take comma separated alternatives, fields are
+    "<key>=<value>" exact matches where key may be a dotted path into the
+    record and regex is searched for in the message (event) of the record.
+
+    >>> f = TailFilter(level='error,warning', fields=['data.status=500'], regex='time(d)? out')
+    >>> f.match({'level': 'ERROR', 'event': 'request timed out', 'data': {'status': 500}})
+    True
+    >>> f.match({'level': 'info', 'event': 'request timed out', 'data': {'status': 500}})
+    False
+    >>> TailFilter().active
+    False
+    '''
+    MESSAGE_KEYS = ('event', 'raw')
+
+    def __init__(self, level=None, host=None, namespace=None, fields=None, regex=None):
+
+        self.levels = self._alternatives(level, lower=True)
+        self.hosts = self._alternatives(host)
+        self.namespaces = self._alternatives(namespace)
+
+        self.fields = list()
+        for field in fields or []:
+            key, sep, value = field.partition('=')
+            if not key or not sep: raise InvalidArgument(field)
+            self.fields.append((key.split('.'), value))
+
+        try:
+            self.regex = re.compile(regex) if regex else None
+        except re.error:
+            raise InvalidArgument(regex)
+
+        self.active = bool(self.levels or self.hosts or self.namespaces or self.fields or self.regex)
+
+
+    @staticmethod
+    def _alternatives(value, lower=False):
+        if not value: return None
+        value = value.lower() if lower else value
+        return set(v.strip() for v in value.split(',') if v.strip())
+
+
+    @staticmethod
+    def _lookup(record, path):
+        for key in path:
+            if not isinstance(record, dict): return None
+            record = record.get(key)
+        return record
+
+
+    def match(self, record):
+        if self.levels and str(record.get('level', '')).lower() not in self.levels:
+            return False
+        if self.hosts and record.get('host') not in self.hosts:
+            return False
+        if self.namespaces and record.get('namespace') not in self.namespaces:
+            return False
+
+        for path, value in self.fields:
+            if str(self._lookup(record, path)) != value: return False
+
+        if self.regex:
+            message = next((record[k] for k in self.MESSAGE_KEYS if k in record), None)
+            if not isinstance(message, str) or not self.regex.search(message):
+                return False
+
+        return True
+
+
+class RingBuffer():
+    '''
+    Fixed size buffer of the most recent lines of a stream. Every line gets
+    a sequence number so readers can keep their own position (cursor) in it.
+
+    >>> r = RingBuffer(3)
+    >>> r.extend([b'a', b'b'])
+    >>> r.read(0)
+    ([b'a', b'b'], 2, 0)
+    >>> r.extend([b'c', b'd', b'e'])
+    >>> r.read(2)
+    ([b'c', b'd', b'e'], 5, 0)
+    >>> r.read(1)
+    ([b'c', b'd', b'e'], 5, 1)
+    '''
+
+    def __init__(self, size):
+        self.size = size
+        self.lines = [None] * size
+        self.head = 0 # Sequence number of the next line to be written
+
+
+    @property
+    def oldest(self):
+        '''
+        Sequence number of the oldest line still in the buffer
+        '''
+        return max(0, self.head - self.size)
+
+
+    def extend(self, lines):
+        for line in lines:
+            self.lines[self.head % self.size] = line
+            self.head += 1
+
+
+    def read(self, cursor, limit=None):
+        '''
+        Lines from cursor onwards, the new cursor and the number of lines
+        that were overwritten before the reader got to them
+        '''
+        oldest = self.oldest
+        dropped = max(0, oldest - cursor)
+        cursor = max(cursor, oldest)
+
+        end = self.head if limit is None else min(self.head, cursor + limit)
+        lines = [self.lines[i % self.size] for i in range(cursor, end)]
+
+        return lines, end, dropped
+
+
+class ClusterTail():
+    '''
+    A single upstream subscription to the logs topic of a cluster whose
+    lines are shared by every tail client attached to it. A cluster being
+    migrated is read from its old nsqd too until that one is drained.
+    '''
+    RING_BUFFER_SIZE = 10000
+
+    def __init__(self, cluster, log, nsq_apis=None):
+
+        self.cluster_name = cluster['cluster_name']
+        self.log = log
+        self.nsq_apis = nsq_apis
+        self.buffer = RingBuffer(self.RING_BUFFER_SIZE)
+        self.clients = set()
+        self.error = None
+        self.sources = nsq_sources(cluster)
+        self.version = cluster_version(cluster)
+        # {nsqd_tcp_address: NsqApiStream}
+        self.streams = dict()
+
+
+    def _on_lines(self, lines):
+        # Empty lines are nsq_api keep-alives, they only wake the clients up
+        self.buffer.extend(LogLine(l) for l in lines if l)
+        self._wake_clients()
+
+
+    def _wake_clients(self):
+        for client in self.clients: client.wake()
+
+
+    async def _read(self, stream):
+        try:
+            await stream.read()
+        except (HTTPError, OSError, TimeoutError):
+            self.log.error('cannot_request_nsq_api', url=stream.url)
+            # Losing an nsqd that is only being drained does not end the tail
+            if stream is self.streams.get(self.sources[0]['nsqd_tcp_address']):
+                self.error = 'Cannot request nsq api'
+                self._wake_clients()
+
+
+    def _set_sources(self, sources):
+        self.sources = sources
+        wanted = set(s['nsqd_tcp_address'] for s in self.sources)
+
+        for address in list(self.streams):
+            if address not in wanted: self.streams.pop(address).close()
+
+        for source in self.sources:
+            if source['nsqd_tcp_address'] in self.streams: continue
+            stream = NsqApiStream(source['nsq_api_address'],
+                                source['nsqd_tcp_address'],
+                                source['logs_topic'],
+                                self._on_lines,
+                                self.log,
+                                nsq_apis=self.nsq_apis)
+            self.streams[source['nsqd_tcp_address']] = stream
+            tornado.ioloop.IOLoop.current().spawn_callback(self._read, stream)
+
+
+    def update(self, cluster):
+        '''
+        Follow the nsqds of a cluster that was migrated, details older
+        than the ones followed already are ignored
+        '''
+        if cluster_version(cluster) < self.version: return
+        self.version = cluster_version(cluster)
+        self._set_sources(nsq_sources(cluster))
+
+
+    def start(self):
+        self.log.info('cluster_tail_started', cluster=self.cluster_name)
+        self._set_sources(self.sources)
+
+
+    def stop(self):
+        self.log.info('cluster_tail_stopped', cluster=self.cluster_name)
+        for stream in self.streams.values(): stream.close()
+
+
+    def attach(self, client):
+        self.clients.add(client)
+
+
+    def detach(self, client):
+        self.clients.discard(client)
+
+
+class TailMultiplexer():
+    '''
+    Keeps one ClusterTail per cluster that is being tailed, opening the
+    upstream stream with the first client and closing it with the last.
+    A client attaching with newer details of the cluster than its tail
+    follows, changed by another process, moves the tail to them.
+    '''
+
+    def __init__(self, log, nsq_apis=None):
+        self.log = log
+        self.nsq_apis = nsq_apis
+        self.cluster_tails = dict()
+
+
+    def attach(self, cluster, client):
+        cluster_name = cluster['cluster_name']
+        cluster_tail = self.cluster_tails.get(cluster_name)
+
+        if not cluster_tail or cluster_tail.error:
+            cluster_tail = ClusterTail(cluster, self.log, self.nsq_apis)
+            self.cluster_tails[cluster_name] = cluster_tail
+            cluster_tail.start()
+        elif cluster_version(cluster) > cluster_tail.version:
+            cluster_tail.update(cluster)
+
+        cluster_tail.attach(client)
+        return cluster_tail
+
+
+    def update(self, cluster):
+        '''
+        Point the tail of a cluster, if there is one, at where it now lives
+        '''
+        cluster_tail = self.cluster_tails.get(cluster['cluster_name'])
+        if cluster_tail: cluster_tail.update(cluster)
+
+
+    def detach(self, cluster_tail, client):
+        cluster_tail.detach(client)
+
+        if not cluster_tail.clients:
+            cluster_tail.stop()
+            if self.cluster_tails.get(cluster_tail.cluster_name) is cluster_tail:
+                del self.cluster_tails[cluster_tail.cluster_name]
+
+
+class TailQueue():
+    '''
+    The bounded queue of lines a tail client has yet to read. Lines stay in
+    the cluster's ring buffer, the queue only tracks which of them are still
+    due to the client and applies the drop policy once more than max_size
+    of them pile up: skip the oldest, skip the newest or give up on the client.
+
+    >>> ring = RingBuffer(10)
+    >>> q = TailQueue(ring, 3, TailQueue.DROP_OLDEST)
+    >>> ring.extend([1, 2, 3, 4, 5]); q.update()
+    >>> q.read(10), q.dropped
+    ([3, 4, 5], 2)
+    >>> q = TailQueue(ring, 3, TailQueue.DROP_NEWEST)
+    >>> ring.extend([6, 7, 8, 9]); q.update()
+    >>> ring.extend([10]); q.update()
+    >>> q.read(10), q.dropped
+    ([6, 7, 8], 2)
+    >>> ring.extend([11]); q.update()
+    >>> q.read(10), q.dropped
+    ([11], 2)
+    '''
+    DROP_OLDEST = 'drop_oldest'
+    DROP_NEWEST = 'drop_newest'
+    DISCONNECT = 'disconnect'
+    POLICIES = (DROP_OLDEST, DROP_NEWEST, DISCONNECT)
+    MAX_SIZE = 5000
+
+    def __init__(self, buffer, max_size=MAX_SIZE, policy=DROP_OLDEST):
+
+        self.buffer = buffer
+        # Lines the ring buffer has overwritten cannot be queued anyway
+        self.max_size = min(max_size, buffer.size)
+        self.policy = policy
+
+        self.cursor = buffer.head # Next line to read
+        self.seen = buffer.head # Lines before this are accounted for
+        self.size = 0
+        self.skips = collections.deque() # (start, end) ranges dropped by DROP_NEWEST
+        self.dropped = 0
+        self.overflowed = False
+
+
+    def update(self):
+        '''
+        Queue the lines that reached the ring buffer since the last call
+        '''
+        head = self.buffer.head
+        self.size += self._queue(head)
+        self.seen = head
+
+        excess = self.size - self.max_size
+        if excess <= 0: return
+
+        if self.policy == self.DISCONNECT:
+            self.overflowed = True
+            return
+
+        self._drop(excess, head)
+        self.size = self.max_size
+        self.dropped += excess
+
+
+    def _queue(self, head):
+        '''
+        Queue the lines from seen up to head, returns how many were queued
+        '''
+        return head - self.seen
+
+
+    def _drop(self, excess, head):
+        if self.policy == self.DROP_OLDEST:
+            self.cursor += excess
+        else:
+            start = head - excess
+            if self.skips and self.skips[-1][1] == start: start = self.skips.pop()[0]
+            self.skips.append((start, head))
+
+
+    def _drop_overwritten(self):
+        '''
+        With DROP_NEWEST a stalled client can still be lapped by the ring buffer
+        '''
+        oldest = self.buffer.oldest
+        if self.cursor >= oldest: return
+
+        lost = oldest - self.cursor
+        while self.skips and self.skips[0][0] < oldest:
+            start, end = self.skips.popleft()
+            lost -= min(end, oldest) - start
+            if end > oldest:
+                self.skips.appendleft((oldest, end))
+                break
+
+        self.cursor = oldest
+        self.size -= lost
+        self.dropped += lost
+
+
+    def read(self, limit):
+        self.update()
+        self._drop_overwritten()
+
+        lines = list()
+        while len(lines) < limit and self.size > 0:
+            if self.skips and self.cursor == self.skips[0][0]:
+                self.cursor = self.skips.popleft()[1]
+                continue
+
+            end = self.skips[0][0] if self.skips else self.buffer.head
+            got, self.cursor, _ = self.buffer.read(self.cursor, min(limit - len(lines), end - self.cursor))
+            if not got: break
+
+            lines.extend(got)
+            self.size -= len(got)
+
+        return lines
+
+
+class FilteredTailQueue(TailQueue):
+    '''
+    A TailQueue of only the lines match is true for, so the lines a client
+    filters out never count against max_size, towards dropped or towards
+    disconnecting it. Matching lines are picked as they reach the ring
+    buffer and queued by sequence number.
+
+    >>> ring = RingBuffer(100)
+    >>> q = FilteredTailQueue(ring, lambda line: line % 5 == 0, 2, TailQueue.DROP_OLDEST)
+    >>> ring.extend(range(1, 10)); q.update()
+    >>> q.read(10), q.dropped
+    ([5], 0)
+    >>> ring.extend(range(10, 21)); q.update()
+    >>> q.read(10), q.dropped
+    ([15, 20], 1)
+    >>> q = FilteredTailQueue(ring, lambda line: line == 21, 1, TailQueue.DISCONNECT)
+    >>> ring.extend(range(21, 31)); q.update()
+    >>> q.overflowed, q.read(10)
+    (False, [21])
+    '''
+
+    def __init__(self, buffer, match, max_size=TailQueue.MAX_SIZE, policy=TailQueue.DROP_OLDEST):
+
+        super().__init__(buffer, max_size, policy)
+        self.match = match
+        # Sequence numbers of the matching lines queued
+        self.queued = collections.deque()
+
+
+    def _queue(self, head):
+        buffer = self.buffer
+        matched = [i for i in range(max(self.seen, buffer.oldest), head)
+                    if self.match(buffer.lines[i % buffer.size])]
+        self.queued.extend(matched)
+        return len(matched)
+
+
+    def _drop(self, excess, head):
+        drop = self.queued.popleft if self.policy == self.DROP_OLDEST else self.queued.pop
+        for i in range(excess): drop()
+
+
+    def _drop_overwritten(self):
+        oldest = self.buffer.oldest
+        lost = 0
+        while self.queued and self.queued[0] < oldest:
+            self.queued.popleft()
+            lost += 1
+
+        self.size -= lost
+        self.dropped += lost
+
+
+    def read(self, limit):
+        self.update()
+        self._drop_overwritten()
+
+        lines = list()
+        while self.queued and len(lines) < limit:
+            i = self.queued.popleft()
+            lines.append(self.buffer.lines[i % self.buffer.size])
+
+        self.size -= len(lines)
+        return lines
+
+
+class FlushPolicy():
+    '''
+    When a tail client's pending lines are written out as one chunk: as soon as
+    there are max_lines of them or they add up to max_bytes, and otherwise
+    max_delay seconds after the first of them arrived.
+    The limits also cap how much a single client keeps in memory.
+    '''
+    MAX_LINES = 1000
+    MAX_BYTES = 1024 * 1024
+    MAX_DELAY = 0.1
+
+    def __init__(self, max_lines=MAX_LINES, max_bytes=MAX_BYTES, max_delay=MAX_DELAY):
+        self.max_lines = max_lines
+        self.max_bytes = max_bytes
+        self.max_delay = max_delay
+
+
+    def is_due(self, batch, time_left):
+        return (len(batch) >= self.max_lines
+                or batch.nbytes >= self.max_bytes
+                or time_left <= 0)
+
+
+class Batch(list):
+    '''
+    Encoded records waiting to be written to a client, with their total size
+    '''
+    def __init__(self):
+        super().__init__()
+        self.nbytes = 0
+
+
+    def append(self, record):
+        super().append(record)
+        self.nbytes += len(record)
+
+
+class TailLogsHandler(tornado.web.RequestHandler):
+    '''
+    Streams the logs of a cluster without blocking the IOLoop.
+    Lines are written in the same format kwikapi uses for streaming responses,
+    optional filters (see TailFilter) are applied before anything is buffered.
+    A client that cannot keep up is handled by its drop policy (see TailQueue),
+    the number of lines it missed is sent along in a 'dropped' field.
+    Sharded masters redirect the tail of a cluster they do not own to its owner.
+    Sample url:
+    'http://localhost:1088/logagg/v1/tail_logs?cluster_name=logagg&cluster_passwd=xxxx&level=error&field=data.status=500&drop_policy=drop_oldest'
+    '''
+
+    KEEPALIVE = json.dumps({'success': True, 'result': ''}) + '\n'
+
+    def initialize(self, master, log, flush_policy, max_queue=TailQueue.MAX_SIZE, drop_policy=TailQueue.DROP_OLDEST):
+        self.master = master
+        self.log = log
+        self.flush_policy = flush_policy
+        self.max_queue = max_queue
+        self.drop_policy = drop_policy
+        self.cluster_tail = None
+        self.queue = None
+        self.reported_dropped = 0
+        self.filter = None
+        self.client_closed = False
+        self.wakeup = tornado.locks.Event()
+
+
+    @staticmethod
+    def _unquote(value):
+        '''
+        Read a query argument the way kwikapi does, so quoted values work too
+        '''
+        try:
+            evaluated = ast.literal_eval(value)
+        except (ValueError, SyntaxError):
+            return value
+
+        return evaluated if isinstance(evaluated, str) else value
+
+
+    def _get_param(self, name, *default):
+        value = self.get_query_argument(name, *default)
+        return value if value is None else self._unquote(value)
+
+
+    def _write_record(self, record):
+        self.write(json.dumps(record) + '\n')
+
+
+    def wake(self):
+        if self.queue: self.queue.update()
+        self.wakeup.set()
+
+
+    def on_connection_close(self):
+        self.log.debug('stream_closed')
+        self.client_closed = True
+        self.wake()
+
+
+    def _fill_batch(self, batch):
+        '''
+        Move lines from the queue into the batch until the flush
+        policy's size limits are reached or the client has caught up
+        '''
+        policy = self.flush_policy
+        got_lines = False
+
+        while len(batch) < policy.max_lines and batch.nbytes < policy.max_bytes:
+            lines = self.queue.read(policy.max_lines - len(batch))
+            if not lines: break
+
+            got_lines = True
+            for line in lines:
+                batch.append(json.dumps({'success': True, 'result': line.raw.decode('utf-8') + '\n'}) + '\n')
+
+        return got_lines
+
+
+    def _report_dropped(self):
+        dropped = self.queue.dropped - self.reported_dropped
+        if not dropped: return
+
+        self.log.warn('slow_tail_client_lines_dropped',
+                    cluster=self.cluster_tail.cluster_name,
+                    policy=self.queue.policy,
+                    dropped=dropped)
+        self._write_record({'success': True, 'result': '', 'dropped': dropped})
+        self.reported_dropped = self.queue.dropped
+
+
+    async def _write_chunk(self, chunk):
+        '''
+        Write a chunk out after any dropped lines report and wait for it
+        to be flushed, False if the client went away meanwhile
+        '''
+        self._report_dropped()
+        self.write(chunk)
+        try:
+            await self.flush()
+        except StreamClosedError:
+            return False
+
+        return True
+
+
+    async def _send_lines(self):
+        '''
+        Forward lines from the client's queue until the client goes away,
+        writing them out in batches as the flush policy dictates.
+        Waiting on flush means tornado only ever holds one batch for a client,
+        a client that falls behind fills up its queue instead.
+        '''
+        policy = self.flush_policy
+        ioloop = tornado.ioloop.IOLoop.current()
+        batch = Batch()
+        deadline = None
+
+        while True:
+            try:
+                await self.wakeup.wait(timeout=deadline)
+            except gen.TimeoutError:
+                pass
+            self.wakeup.clear()
+
+            if self.client_closed: return
+            if self.cluster_tail.error:
+                self._write_record({'success': False, 'details': self.cluster_tail.error})
+                return
+            if self.queue.overflowed:
+                self.log.warn('slow_tail_client_disconnected', cluster=self.cluster_tail.cluster_name)
+                self._write_record({'success': False,
+                                    'details': 'Disconnected for reading logs too slowly',
+                                    'dropped': self.queue.size})
+                return
+
+            got_lines = self._fill_batch(batch)
+
+            if not batch:
+                # Woken up by an nsq_api keep-alive, pass it on right away and on its own
+                if not got_lines and not await self._write_chunk(self.KEEPALIVE): return
+                continue
+
+            if deadline is None: deadline = ioloop.time() + policy.max_delay
+            if not policy.is_due(batch, deadline - ioloop.time()): continue
+
+            self.master.metrics.inc('logagg_master_tail_lines_total', len(batch), cluster=self.cluster_tail.cluster_name)
+            self.master.metrics.inc('logagg_master_tail_bytes_total', batch.nbytes, cluster=self.cluster_tail.cluster_name)
+            chunk = ''.join(batch)
+            batch = Batch()
+            deadline = None
+            if not await self._write_chunk(chunk): return
+
+            # The batch was full, do not wait for more lines to pick up the rest
+            if self.queue.size: self.wakeup.set()
+
+
+    async def get(self):
+        cluster_name = self._get_param('cluster_name')
+        cluster_passwd = self._get_param('cluster_passwd')
+
+        # Other processes may have moved the cluster since it was cached
+        shared = self.master.clusters.shared
+        found, cluster = (False, None) if shared else self.master.clusters.cached(cluster_name)
+        if not found:
+            try:
+                cluster = await self.master.mongo.run('clusters.get', self.master.clusters.get, cluster_name, shared)
+            except MongoTimeout as e:
+                self._write_record({'success': False, 'details': str(e)})
+                return
+        if not cluster:
+            self._write_record({'success': False, 'details': 'Cluster not found'})
+            return
+        if cluster['cluster_passwd'] != cluster_passwd:
+            self._write_record({'success': False, 'details': 'Authentication failed'})
+            return
+
+        owner = self.master.membership.owner(cluster_name) if self.master.membership else None
+        # Only once, masters may disagree on the owner for a moment while one joins or leaves
+        if owner and not self.get_query_argument('redirected', None):
+            self.redirect('http://{}:{}{}&redirected=true'.format(owner['host'], owner['port'], self.request.uri))
+            return
+
+        try:
+            self.filter = TailFilter(level=self._get_param('level', None),
+                                    host=self._get_param('host', None),
+                                    namespace=self._get_param('namespace', None),
+                                    fields=[self._unquote(f) for f in self.get_query_arguments('field')],
+                                    regex=self._get_param('regex', None))
+        except InvalidArgument as e:
+            self._write_record({'success': False, 'details': 'Invalid filter {}'.format(e)})
+            return
+
+        drop_policy = self._get_param('drop_policy', self.drop_policy)
+        if drop_policy not in TailQueue.POLICIES:
+            self._write_record({'success': False, 'details': 'Invalid drop policy "{}"'.format(drop_policy)})
+            return
+
+        self.set_header('Content-Type', 'application/json')
+        self.cluster_tail = self.master.tail_multiplexer.attach(cluster, self)
+        if self.filter.active:
+            # Lines the client filters out are never queued for it
+            self.queue = FilteredTailQueue(self.cluster_tail.buffer, lambda line: self.filter.match(line.record),
+                                            self.max_queue, drop_policy)
+        else:
+            self.queue = TailQueue(self.cluster_tail.buffer, self.max_queue, drop_policy)
+        try:
+            await self._send_lines()
+        finally:
+            self.master.tail_multiplexer.detach(self.cluster_tail, self)